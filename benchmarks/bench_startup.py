@@ -0,0 +1,135 @@
+"""
+Checks the startup cost of the bitman CLI with `python -X importtime`. Every command is started
+a few times and the fastest import time (without the modules every interpreter imports) is
+compared against a budget. Commands which only print help must not import rich. Exits with
+status 1 on regressions. Run from the repository root:
+
+    python3 benchmarks/bench_startup.py --max-import-ms 40 --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname, join
+from typing import NamedTuple
+
+SOURCE_PATH = join(dirname(dirname(abspath(__file__))), 'src')
+
+# Commands whose startup is measured, together with modules they must not import
+COMMANDS: list[tuple[list[str], tuple[str, ...]]] = [
+    (['--help'], ('rich',)),
+    (['sync', '--help'], ('rich',)),
+    (['firewall', 'export', '--help'], ('rich',)),
+]
+
+
+class StartupResult(NamedTuple):
+    command: str
+    wall_seconds: float
+    import_seconds: float
+    modules: int
+    slowest_imports: list[tuple[str, float]]
+    forbidden_imports: list[str]
+
+
+def interpreter_modules() -> set[str]:
+    """Returns the modules every interpreter imports on startup, they aren't counted for bitman"""
+    result = _importtime(['-c', 'pass'])
+    return {name.strip() for name, _ in _parsed_importtime(result.stderr)} | {'runpy'}
+
+
+def measure(arguments: list[str],
+            forbidden: tuple[str, ...],
+            baseline: set[str],
+            repeat: int) -> StartupResult:
+    """Starts bitman `repeat` times and keeps the run with the lowest import time"""
+    best: StartupResult | None = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = _importtime(['-m', 'bitman', *arguments])
+        wall_seconds = time.perf_counter() - start
+
+        imports = [(name, cumulative) for name, cumulative in _parsed_importtime(result.stderr)
+                   if name.strip() not in baseline]
+        top_level = [(name.strip(), cumulative) for name, cumulative in imports
+                     if not name.startswith('  ')]
+        startup = StartupResult(
+            ' '.join(arguments),
+            wall_seconds,
+            sum(cumulative for _, cumulative in top_level),
+            len(imports),
+            sorted(top_level, key=lambda entry: entry[1], reverse=True)[:5],
+            sorted({name.strip() for name, _ in imports
+                    if name.strip().split('.', 1)[0] in forbidden})
+        )
+        if best is None or startup.import_seconds < best.import_seconds:
+            best = startup
+    return best
+
+
+def _importtime(arguments: list[str]) -> subprocess.CompletedProcess[str]:
+    return subprocess.run(
+        [sys.executable, '-X', 'importtime', *arguments],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        encoding='utf-8',
+        check=False,
+        env={**os.environ, 'PYTHONPATH': SOURCE_PATH}
+    )
+
+
+def _parsed_importtime(output: str) -> list[tuple[str, float]]:
+    """Returns the name (indented by depth) and cumulative seconds of every imported module"""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|', 2)
+        # The name is preceded by one space, nested imports by two more per level
+        imports.append((name[1:], int(cumulative) / 1_000_000))
+    return imports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Checks the startup cost of the bitman CLI')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='How often every command is started, the fastest run is reported')
+    parser.add_argument('--max-import-ms', type=float, default=40,
+                        help='Fail if importing takes longer than this for any command')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    baseline = interpreter_modules()
+    results = [measure(arguments, forbidden, baseline, args.repeat)
+               for arguments, forbidden in COMMANDS]
+
+    failed = False
+    for result in results:
+        print(f'bitman {result.command}: {result.import_seconds * 1000:.1f} ms imports '
+              f'({result.modules} modules), {result.wall_seconds * 1000:.1f} ms wall')
+        for name, seconds in result.slowest_imports:
+            print(f'    {seconds * 1000:7.1f} ms  {name}')
+        if result.forbidden_imports:
+            failed = True
+            print(f'    imports modules it must not: {", ".join(result.forbidden_imports)}')
+        if result.import_seconds * 1000 > args.max_import_ms:
+            failed = True
+            print(f'    exceeds the import budget of {args.max_import_ms:.1f} ms')
+
+    if args.output is not None:
+        with open(args.output, 'wt', encoding='utf-8') as output_file:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': [result._asdict() for result in results],
+            }, output_file, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
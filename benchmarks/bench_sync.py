@@ -0,0 +1,345 @@
+"""
+Benchmarks the status computation and config parsing of bitman against synthetic systems.
+
+Commands are answered by a stub command runner instead of pacman, systemctl and ufw, so results
+don't depend on the machine's packages and every command that would have spawned a process is
+counted. Run from the repository root:
+
+    PYTHONPATH=src python3 benchmarks/bench_sync.py --output results.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+from collections import Counter
+from datetime import datetime, timezone
+from os.path import join
+from subprocess import CompletedProcess
+from typing import Any, Callable, NamedTuple
+
+from rich.console import Console
+from rich.table import Table
+
+from bitman.config.loader import config_loader
+from bitman.config.system_config import SystemConfig
+from bitman.fingerprint import sync_fingerprint
+from bitman.git import GitRepository
+from bitman.nft import Nft
+from bitman.package.index import PackageIndex
+from bitman.package.pacman import Pacman
+from bitman.package.yay import Yay
+from bitman.runner import CommandRunner, set_command_runner
+from bitman.service import Systemd
+from bitman.state import SyncState
+from bitman.sync import Sync, SyncScope
+from bitman.ufw import Ufw
+
+RESULTS_VERSION = 1
+
+
+class Scale(NamedTuple):
+    packages: int
+    services: int
+    ufw_rules: int
+
+
+SCALES = {
+    'small': Scale(packages=100, services=20, ufw_rules=50),
+    'medium': Scale(packages=2_000, services=200, ufw_rules=1_000),
+    'large': Scale(packages=20_000, services=500, ufw_rules=5_000),
+}
+
+
+class PhaseResult(NamedTuple):
+    scale: str
+    phase: str
+    seconds: float
+    spawns: int
+    peak_memory: int
+
+
+class Phase(NamedTuple):
+    name: str
+    # Builds everything the phase needs, which isn't measured
+    setup: Callable[[], Any]
+    run: Callable[[Any], None]
+
+
+class SyntheticSystem:
+    """A generated config directory together with the system state the stub runner reports"""
+
+    def __init__(self, scale: Scale, directory: str, seed: int = 0):
+        generator = random.Random(seed)
+        self.config_directory = join(directory, 'config')
+        self.cache_directory = join(directory, 'cache')
+        self.state_directory = join(directory, 'state')
+        # Only the mtime of pacman's local db matters for the package index
+        self.local_db_directory = join(directory, 'local')
+        for path in (self.config_directory, self.cache_directory, self.state_directory,
+                     self.local_db_directory):
+            os.makedirs(path)
+
+        packages = [f'package-{index:05d}' for index in range(scale.packages)]
+        aur_count = max(1, scale.packages // 20)
+        arch_packages, aur_packages = packages[aur_count:], packages[:aur_count]
+        # 90% of the configured packages are installed, plus 10% unconfigured ones
+        extra = [f'extra-{index:05d}' for index in range(scale.packages // 10)]
+        self.foreign = [package for package in aur_packages if generator.random() < 0.9]
+        self.explicit = [package for package in arch_packages if generator.random() < 0.9] \
+            + extra + self.foreign
+        self.installed = set(self.explicit)
+
+        services = [(f'service-{index:04d}.service', generator.random() < 0.2,
+                     'enable' if generator.random() < 0.7 else 'disable')
+                    for index in range(scale.services)]
+        self.enabled = {(name, user) for name, user, _ in services if generator.random() < 0.5}
+
+        rules = [(str(1000 + index), generator.choice(['tcp', 'udp', 'any']),
+                  generator.choice(['allow', 'deny']),
+                  'any' if generator.random() < 0.5 else f'10.{index % 250}.0.0/16')
+                 for index in range(scale.ufw_rules)]
+        # 95% of the configured rules exist, plus 5% which should be deleted
+        active_rules = [rule for rule in rules if generator.random() < 0.95] \
+            + [(str(40000 + index), 'tcp', 'allow', 'any')
+               for index in range(scale.ufw_rules // 20)]
+
+        # The sync databases have a newer version of 10% of the repository packages
+        self.repository = [(package, '1.0-2' if generator.random() < 0.1 else '1.0-1')
+                           for package in arch_packages + extra]
+
+        self._write('arch.packages', arch_packages)
+        self._write('aur.packages', aur_packages)
+        self._write('services.conf', [
+            '[system]', *[f'{state} {name}' for name, user, state in services if not user],
+            '[user]', *[f'{state} {name}' for name, user, state in services if user],
+        ])
+        self._write('ufw.conf', [
+            '[default]', 'deny incoming', 'allow outgoing',
+            '[rules]', *[f'in\t{rule}\t{port}\t{proto}\t{from_ip}'
+                         for port, proto, rule, from_ip in rules],
+        ])
+
+        self.verbose_status = 'Status: active\nLogging: on (low)\n' \
+            'Default: deny (incoming), allow (outgoing), disabled (routed)\n'
+        self.numbered_status = 'Status: active\n\n' \
+            '     To                         Action      From\n' \
+            '     --                         ------      ----\n' \
+            + ''.join(_ufw_status_line(index, rule)
+                      for index, rule in enumerate(active_rules, start=1))
+
+    def _write(self, file_name: str, lines: list[str]) -> None:
+        with open(join(self.config_directory, file_name), 'wt', encoding='utf-8') as config_file:
+            config_file.write('\n'.join(lines) + '\n')
+
+
+def _ufw_status_line(index: int, rule: tuple[str, str, str, str]) -> str:
+    port, proto, action, from_ip = rule
+    port_proto = port if proto == 'any' else f'{port}/{proto}'
+    from_ip = 'Anywhere' if from_ip == 'any' else from_ip
+    return f'[{index:>2}] {port_proto:<26} {action.upper()} IN    {from_ip}\n'
+
+
+class SyntheticCommandRunner(CommandRunner):
+    """Answers the commands of the status computation from a synthetic system"""
+
+    def __init__(self, system: SyntheticSystem):
+        self._system = system
+        self.spawns: Counter[str] = Counter()
+
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        self.spawns[argv[0]] += 1
+        match argv:
+            case ['pacman', '-Q']:
+                return _completed(argv, _package_list(self._system.explicit))
+            case ['pacman', '-Qe']:
+                return _completed(argv, _package_list(self._system.explicit))
+            case ['pacman', '-Qm']:
+                return _completed(argv, _package_list(self._system.foreign))
+            case ['pacman', '-Sl']:
+                return _completed(argv, ''.join(f'core {package} {version}\n'
+                                                for package, version in self._system.repository))
+            case ['pacman', '-Q', package]:
+                return _completed(argv, '', 0 if package in self._system.installed else 1)
+            case ['systemctl', *args]:
+                user = '--user' in args
+                enabled = (args[-1], user) in self._system.enabled
+                if 'is-enabled' in args:
+                    return _completed(argv, 'enabled\n' if enabled else 'disabled\n',
+                                      0 if enabled else 1)
+                return _completed(argv, '', 0 if enabled else 3)
+            case ['ufw', 'status', 'verbose']:
+                return _completed(argv, self._system.verbose_status)
+            case ['ufw', 'status', 'numbered']:
+                return _completed(argv, self._system.numbered_status)
+        raise ValueError(f'Unexpected command in benchmark: {argv}')
+
+
+def _package_list(packages: list[str]) -> str:
+    return ''.join(f'{package} 1.0-1\n' for package in packages)
+
+
+def _completed(argv: list[str], stdout: str, returncode: int = 0) -> CompletedProcess[str]:
+    return CompletedProcess(argv, returncode, stdout, '')
+
+
+def phases(system: SyntheticSystem) -> list[Phase]:
+    def cold_config() -> SystemConfig:
+        config_loader().invalidate()
+        shutil.rmtree(system.cache_directory)
+        os.makedirs(system.cache_directory)
+        return SystemConfig(system.config_directory, system.cache_directory)
+
+    def snapshot_config() -> SystemConfig:
+        config_loader().invalidate()
+        return SystemConfig(system.config_directory, system.cache_directory)
+
+    def loaded_config() -> SystemConfig:
+        system_config = SystemConfig(system.config_directory, system.cache_directory)
+        list(system_config.arch_packages())
+        return system_config
+
+    def package_index() -> PackageIndex:
+        return PackageIndex([join(system.state_directory, 'package-index.json')],
+                            system.local_db_directory)
+
+    def sync(index: PackageIndex | None = None) -> Sync:
+        return Sync(loaded_config(), Pacman(index or package_index()), Yay(), Systemd(), Ufw(),
+                    Nft(), GitRepository(system.config_directory),
+                    SyncState(system.state_directory))
+
+    def unindexed_sync() -> Sync:
+        index = package_index()
+        for file_path in glob.glob(join(system.state_directory, 'package-index.json*')):
+            os.remove(file_path)
+        return sync(index)
+
+    def indexed_sync() -> Sync:
+        package_index().packages()
+        return sync()
+
+    def synced_sync() -> Sync:
+        # As after a successful full sync: neither the system nor the config changed since
+        synced = sync()
+        SyncState(system.state_directory).set_synced_fingerprint(
+            ['packages', 'services', 'ufw'], sync_fingerprint(loaded_config().config_files()))
+        return synced
+
+    def outdated() -> tuple[Pacman, list[str]]:
+        pacman = Pacman(package_index())
+        pacman.index.packages()
+        return pacman, list(loaded_config().arch_packages())
+
+    def ufw() -> tuple[Ufw, list]:
+        return Ufw(), list(loaded_config().ufw_rules())
+
+    return [
+        Phase('config_parse', cold_config, lambda config: list(config.arch_packages())),
+        Phase('config_snapshot', snapshot_config, lambda config: list(config.arch_packages())),
+        Phase('package_status', unindexed_sync, lambda sync: sync.package_status()),
+        Phase('package_status_indexed', indexed_sync, lambda sync: sync.package_status()),
+        Phase('outdated_packages', outdated,
+              lambda setup: setup[0].outdated_packages(setup[1])),
+        Phase('service_status', sync, lambda sync: sync.service_status()),
+        Phase('ufw_missing_rules', ufw, lambda setup: setup[0].missing_rules(setup[1])),
+        Phase('ufw_rules_to_delete', ufw, lambda setup: setup[0].rules_to_delete(setup[1])),
+        Phase('status_unchanged', synced_sync, lambda sync: sync.status_report(SyncScope(
+            Namespace(packages=False, services=False, ufw=False)))),
+    ]
+
+
+def measure(scale_name: str,
+            phase: Phase,
+            runner: SyntheticCommandRunner,
+            repeat: int) -> PhaseResult:
+    """Returns the best wall time of all repetitions, spawns and peak memory of a single run"""
+    best = float('inf')
+    spawns = 0
+    for _ in range(repeat):
+        state = phase.setup()
+        runner.spawns.clear()
+        start = time.perf_counter()
+        phase.run(state)
+        best = min(best, time.perf_counter() - start)
+        spawns = sum(runner.spawns.values())
+
+    # Memory is traced in a separate run, as tracing slows Python down considerably
+    state = phase.setup()
+    tracemalloc.start()
+    try:
+        phase.run(state)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return PhaseResult(scale_name, phase.name, best, spawns, peak_memory)
+
+
+def run_benchmarks(scale_names: list[str], repeat: int, console: Console) -> list[PhaseResult]:
+    results = []
+    for scale_name in scale_names:
+        with tempfile.TemporaryDirectory(prefix='bitman-bench-') as directory:
+            system = SyntheticSystem(SCALES[scale_name], directory)
+            runner = SyntheticCommandRunner(system)
+            set_command_runner(runner)
+            for phase in phases(system):
+                console.print(f'[dim]{scale_name}: {phase.name}')
+                results.append(measure(scale_name, phase, runner, repeat))
+    return results
+
+
+def print_results(results: list[PhaseResult], console: Console) -> None:
+    table = Table('Scale', 'Phase', 'Wall time', 'Spawns', 'Peak memory')
+    for result in results:
+        table.add_row(result.scale, result.phase, f'{result.seconds * 1000:.2f} ms',
+                      str(result.spawns), f'{result.peak_memory / 1024:.0f} KiB')
+    console.print(table)
+
+
+def results_json(results: list[PhaseResult]) -> dict:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, encoding='utf-8', check=False)
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'commit': commit.stdout.strip() or None,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scales': {name: SCALES[name]._asdict()
+                   for name in dict.fromkeys(result.scale for result in results)},
+        'results': [result._asdict() for result in results],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks bitman against synthetic systems')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=list(SCALES),
+                        help='The system sizes to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How often every phase is run, the best wall time is reported')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    console = Console(stderr=True)
+    results = run_benchmarks(args.scales, args.repeat, console)
+    print_results(results, console)
+    if args.output is not None:
+        with open(args.output, 'wt', encoding='utf-8') as output_file:
+            json.dump(results_json(results), output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
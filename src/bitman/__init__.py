@@ -1,36 +1,89 @@
+from __future__ import annotations
 from argparse import Namespace
+from functools import cached_property
+import json
 from os import path
-from rich.console import Console
-from rich.prompt import Prompt
+import sys
+from typing import TYPE_CHECKING
 
 from bitman.config import SYSTEM_CONFIG_PATH
-from bitman.config.system_config import SystemConfig
-from bitman.git import Git
-from bitman.package.pacman import Pacman
-from bitman.package.yay import Yay
-from bitman.package_sync import PackageSync
-from bitman.service import Systemd
-from bitman.services_sync import ServicesSync
-from bitman.setup import Setup
-from bitman.sync import Sync, SyncScope, PackageSyncStatus
-from bitman.ufw import Ufw
+
+if TYPE_CHECKING:
+    from rich.console import Console
+    from bitman.config.system_config import SystemConfig
+    from bitman.lock import RunLock, SyncRequest
+    from bitman.nft import Nft
+    from bitman.package.pacman import Pacman
+    from bitman.package.yay import Yay
+    from bitman.service import Systemd
+    from bitman.sync import Sync
+    from bitman.ufw import Ufw
 
 
 class Bitman:
-    def __init__(self):
-        self._system_config = SystemConfig()
-        self._pacman = Pacman()
-        self._ufw = Ufw()
-        self._yay = Yay()
-        self._systemd = Systemd()
-        self._sync = Sync(self._system_config, self._pacman, self._yay, self._systemd, self._ufw)
-        self._console = Console()
+    """
+    Processes the bitman commands. Backends (and rich) are imported and constructed on first use,
+    so every command only pays for what it needs.
+    """
+
+    config_directory: str = SYSTEM_CONFIG_PATH
+    _sync_runs = 0
+
+    @cached_property
+    def _console(self) -> Console:
+        from rich.console import Console
+        return Console()
+
+    @cached_property
+    def _system_config(self) -> SystemConfig:
+        from bitman.config.system_config import SystemConfig
+        return SystemConfig(self.config_directory)
+
+    @cached_property
+    def _pacman(self) -> Pacman:
+        from bitman.package.pacman import Pacman
+        return Pacman()
+
+    @cached_property
+    def _ufw(self) -> Ufw:
+        from bitman.ufw import Ufw
+        return Ufw()
+
+    @cached_property
+    def _yay(self) -> Yay:
+        from bitman.package.yay import Yay
+        return Yay()
+
+    @cached_property
+    def _systemd(self) -> Systemd:
+        from bitman.service import Systemd
+        return Systemd()
+
+    @cached_property
+    def _nft(self) -> Nft:
+        from bitman.nft import Nft
+        return Nft()
+
+    @cached_property
+    def _sync(self) -> Sync:
+        from bitman.git import GitRepository
+        from bitman.history import DurationHistory
+        from bitman.journal import SyncJournal
+        from bitman.paths import state_directory
+        from bitman.state import SyncState
+        from bitman.sync import Sync
+        return Sync(self._system_config, self._pacman, self._yay, self._systemd, self._ufw,
+                    self._nft, GitRepository(self.config_directory), SyncState(state_directory()),
+                    SyncJournal(state_directory()), DurationHistory(state_directory()))
 
     def init(self, _args: Namespace) -> None:
         """Initializes bitman on the system (pulls config repo to /etc/bitman)"""
+        from rich.prompt import Prompt
+        from bitman.git import Git
+
         pacman = self._pacman
         console = self._console
-        bitman_path = SYSTEM_CONFIG_PATH
+        bitman_path = self.config_directory
 
         if path.exists(bitman_path):
             console.print(
@@ -55,10 +108,7 @@ class Bitman:
 
         git = Git()
 
-        console.print('Cloning repository...')
-        repo = git.clone(config_repo, bitman_path)
-
-        branches = repo.branches()
+        branches = git.remote_branches(config_repo)
         console.print('Available branches:', style='yellow')
         console.print(
             *[f'[bold]·[/bold] {branch}' for branch in branches], sep='\n')
@@ -66,43 +116,229 @@ class Bitman:
         selected_branch = Prompt.ask('Which branch should be used? (type its name)',
                                      choices=branches, show_choices=False)
 
-        if selected_branch != repo.active_branch():
-            console.print(f'Switching branch to {selected_branch}...')
-            repo.change_branch(selected_branch)
-
-            console.print('Pulling...')
-            repo.pull()
+        console.print('Cloning repository...')
+        git.clone(config_repo, bitman_path, branch=selected_branch)
 
         console.print('You\'re ready to go!', style='bold green')
 
     def sync(self, args: Namespace) -> None:
         """Processes bitman sync command"""
+        from bitman.sync import SyncScope
 
         scope = SyncScope(args)
-        if args.status:
-            if scope.packages:
-                status = self._sync.package_status()
-                sync = PackageSync(status, self._console)
-                sync.print_status()
-
-            if scope.services:
-                status = self._sync.service_status()
-                sync = ServicesSync(status, self._console)
-                sync.print_status(self._systemd, self._system_config)
-
-            if scope.ufw:
-                self._print_ufw_status()
+        if args.status and args.format == 'json':
+            report = self._sync.status_report(scope, args.force)
+            sys.stdout.write(json.dumps(report.to_json(), indent=2) + '\n')
+        elif args.status:
+            self._sync.print_status(scope, args.force)
+        elif args.plan:
+            plan = self._sync.plan(scope, args.upgrade)
+            self._sync.print_plan(plan)
+            plan.save(args.plan)
+            self._console.print(f'Plan written to [bold]{args.plan}[/bold]')
+        elif args.apply:
+            from bitman.plan import SyncPlan
+            with self._run_lock().hold(self._print_waiting):
+                self._sync.apply(SyncPlan.load(args.apply))
+        elif args.resume:
+            with self._run_lock().hold(self._print_waiting):
+                self._sync.resume()
+        else:
+            from bitman.lock import SyncRequest
+            from bitman.prompt import is_interactive
+            request = SyncRequest(scope.subsystems(), args.pull, args.full, args.force,
+                                  args.upgrade, path.abspath(self.config_directory),
+                                  is_interactive())
+            if not self._run_lock().run_coalesced(request, self._run_sync):
+                self._console.print('A sync is already running, it will sync again once it '
+                                    'finished', style='yellow')
+
+    def _run_sync(self, request: SyncRequest) -> None:
+        from bitman.prompt import set_interactive
+        from bitman.sync import SyncScope
+
+        if self._sync_runs > 0:
+            self._console.print('Syncing again for the requests which arrived during the sync',
+                                style='yellow')
+        # Backends and the config cache what they read, every run starts from scratch with the
+        # config and interactivity of whoever requested it
+        for name in ('_system_config', '_pacman', '_yay', '_systemd', '_ufw', '_nft', '_sync'):
+            self.__dict__.pop(name, None)
+        self.config_directory = request.config_directory
+        set_interactive(request.interactive)
+        self._sync_runs += 1
+
+        if request.pull:
+            self._pull_config()
+        scope = SyncScope(Namespace(packages='packages' in request.subsystems,
+                                    services='services' in request.subsystems,
+                                    ufw='ufw' in request.subsystems))
+        self._sync.run(scope, request.full, request.force, request.upgrade)
+
+    def _run_lock(self) -> RunLock:
+        from bitman.lock import RunLock
+        from bitman.paths import state_directory
+        return RunLock(state_directory())
+
+    def _print_waiting(self) -> None:
+        self._console.print('Waiting for the running sync to finish...', style='yellow')
+
+    def _pull_config(self) -> None:
+        from bitman.git import GitRepository
+        if GitRepository(self.config_directory).pull():
+            self._console.print('Pulled config changes', style='yellow')
         else:
-            self._sync.run(scope)
+            self._console.print('Config is up to date', style='green')
 
-    def _print_ufw_status(self) -> None:
-        self._sync.print_ufw_status()
+    def history(self, args: Namespace) -> None:
+        """Prints which sync steps took the most time across runs"""
+        from bitman.history import DurationHistory, format_duration
+        from bitman.paths import state_directory
+
+        entries = DurationHistory(state_directory()).entries()[:args.limit]
+        if args.format == 'json':
+            sys.stdout.write(json.dumps([entry._asdict() for entry in entries], indent=2) + '\n')
+            return
+        if len(entries) == 0:
+            self._console.print('No sync durations recorded yet', style='yellow')
+            return
+
+        from rich.table import Table
+        table = Table('Step', 'Runs', 'Usually', 'Last', 'Total')
+        for entry in entries:
+            table.add_row(entry.key, str(entry.runs), format_duration(entry.median),
+                          format_duration(entry.last), format_duration(entry.total))
+        self._console.print(table)
+
+    def firewall_export(self, args: Namespace) -> None:
+        """Writes the configured firewall rules as nftables ruleset"""
+        from bitman.nft_sync import NftSync
+        sync = NftSync(self._nft, self._console, self._system_config)
+        ruleset = sync.compiled_ruleset().render()
+
+        if args.check:
+            self._nft.check(ruleset)
+
+        if args.output:
+            with open(args.output, 'wt', encoding='utf-8') as output_file:
+                output_file.write(ruleset)
+        else:
+            sys.stdout.write(ruleset)
+
+    def metrics(self, args: Namespace) -> None:
+        """Writes drift counts and status durations to a node_exporter textfile"""
+        from bitman.metrics import render_textfile, write_textfile
+        from bitman.sync import SyncScope
+
+        report = self._sync.status_report(SyncScope(args))
+        if args.textfile:
+            write_textfile(args.textfile, report)
+        else:
+            sys.stdout.write(render_textfile(report))
+
+    def index_install_hook(self, _args: Namespace) -> None:
+        """Installs the ALPM hook which keeps the package index up to date"""
+        from bitman.package.index import ALPM_HOOK_PATH, alpm_hook, insecure_hook_paths
+        from bitman.runner import command_runner
+
+        source_path = path.dirname(path.dirname(path.abspath(__file__)))
+        # The hook runs as root, anyone who can change its code would become root
+        insecure = insecure_hook_paths(source_path)
+        if len(insecure) > 0:
+            self._console.print(
+                'The hook runs bitman as root, but these paths aren\'t owned by root or are '
+                'writable by other users, install bitman system-wide first:', style='red')
+            self._console.print(*[f'[bold]·[/bold] {insecure_path}' for insecure_path in insecure],
+                                sep='\n', highlight=False)
+            return
+        result = command_runner().run(['tee', ALPM_HOOK_PATH], input=alpm_hook(source_path),
+                                      privileged=True)
+        result.check_returncode()
+        self._pacman.index.rebuild()
+        self._console.print(f'Installed [bold]{ALPM_HOOK_PATH}[/bold]', style='green')
+
+    def index_rebuild(self, _args: Namespace) -> None:
+        """Rebuilds the package index from pacman"""
+        self._pacman.index.rebuild()
+
+    def cache_prune(self, args: Namespace) -> None:
+        """
+        Removes cached package files which neither installed nor configured packages reference,
+        keeping `args.keep` previous versions of each
+        """
+        from bitman.package.cache import format_size
+        from bitman.package.pacman import wait_for_pacman_lock
+        from bitman.prompt import confirm
+
+        configured = [*self._system_config.arch_packages(), *self._system_config.aur_packages()]
+        prunable = self._pacman.prunable_cache(configured, args.keep)
+        if len(prunable) == 0:
+            self._console.print('The package cache only contains referenced versions, nothing to '
+                                'do', style='green')
+            return
+
+        self._console.print('The following cached packages will be removed:', style='red')
+        self._console.print(*[f'[bold]·[/bold] {package.name} {package.version}'
+                              for package in prunable], sep='\n', highlight=False)
+        size = format_size(sum(package.size for package in prunable))
+        self._console.print(f'\n{len(prunable)} files, {size}')
+        if not confirm('Do you want to continue?', non_interactive_answer=True):
+            return
+
+        # A running sync or transaction may be about to install one of the files
+        with self._run_lock().hold(self._print_waiting):
+            wait_for_pacman_lock()
+            self._pacman.remove_cached(prunable)
+        self._console.print(f'Removed {len(prunable)} cached packages, freed {size}',
+                            style='green')
+
+    def agent_run(self, args: Namespace) -> None:
+        """Runs the bitman agent until it is terminated"""
+        from bitman.agent import Agent, agent_socket_path
+        socket_path = args.socket if args.socket is not None else agent_socket_path()
+        Agent(socket_path, self.config_directory, args.interval).run()
+
+    def agent_query(self, args: Namespace) -> None:
+        """Prints the answer of the running agent to a status or plan query"""
+        from bitman.agent import query_agent
+        response = query_agent(args.query, args.socket)
+        if args.query == 'plan' and args.output:
+            with open(args.output, 'wt', encoding='utf-8') as output_file:
+                json.dump(response, output_file, indent=2)
+        else:
+            sys.stdout.write(json.dumps(response, indent=2) + '\n')
+
+    def image_build(self, args: Namespace) -> None:
+        """Provisions several alternate roots concurrently"""
+        from bitman.image import ImageBuilder
+        ImageBuilder(self.config_directory, self._console, args.jobs).build(args.roots)
 
     def install(self, args: Namespace) -> None:
-        """Processes bitman user install command"""
-        print("Not implemented", args)
+        """
+        Adds packages to the config, commits them and installs only them (with their hooks)
+        instead of syncing the whole system
+        """
+        from bitman.git import GitRepository
+
+        packages = list(dict.fromkeys(args.packages))
+        configured = set(self._system_config.aur_packages() if args.aur
+                         else self._system_config.arch_packages())
+        added = [package for package in packages if package not in configured]
+        if len(added) < len(packages):
+            self._console.print('Already configured: ' + ', '.join(
+                package for package in packages if package in configured), style='green')
+
+        with self._run_lock().hold(self._print_waiting):
+            if len(added) > 0:
+                file_path = self._system_config.add_packages(added, args.aur)
+                commit = GitRepository(self.config_directory).commit(
+                    [file_path], f'Install {", ".join(added)}{" (AUR)" if args.aur else ""}')
+                self._console.print(f'Added {", ".join(added)} to [bold]{file_path}[/bold] '
+                                    f'({commit[:10]})')
+            self._sync.install([] if args.aur else packages, packages if args.aur else [])
 
     def setup(self, args: Namespace) -> None:
         """Setup user files"""
-        setup = Setup(self._system_config, self._systemd)
+        from bitman.setup import Setup
+        setup = Setup(self._system_config)
         setup.run()
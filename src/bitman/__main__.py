@@ -1,5 +1,11 @@
 import argparse
+import sys
 import bitman
+from bitman.prompt import set_interactive
+from bitman.root import set_target_root
+from bitman.runner import RecordingCommandRunner, ReplayCommandRunner, TracingCommandRunner, \
+    command_runner, set_command_runner
+from bitman.trace import enable_tracing, span
 
 app = bitman.Bitman()
 
@@ -7,6 +13,23 @@ parser = argparse.ArgumentParser(
     prog='bitman',
     description='A declarative package manager for Arch Linux'
 )
+parser.add_argument('--record', metavar='FILE',
+                    help='Record all executed commands with their output and duration to a fixture')
+parser.add_argument('--replay', metavar='FILE',
+                    help='Answer all commands from a recorded fixture instead of executing them')
+parser.add_argument('--replay-realtime', action='store_true',
+                    help='Let replayed commands take as long as they did when they were recorded')
+parser.add_argument('--trace', metavar='FILE',
+                    help='Write a Chrome trace of all phases, commands and hooks to this file')
+parser.add_argument('--profile', action='store_true',
+                    help='Profile the run with cProfile and print the functions taking most time')
+parser.add_argument('--non-interactive', action='store_true',
+                    help='Never prompt: confirmations of the requested changes are accepted, '
+                    'UFW is not enabled just to query its state')
+parser.add_argument('--root', metavar='DIR',
+                    help='Provision the system below DIR instead of the live host, like pacstrap')
+parser.add_argument('--config', metavar='DIR',
+                    help='Read the bitman config from DIR instead of /etc/bitman')
 subparsers = parser.add_subparsers()
 
 init_parser = subparsers.add_parser('init', help='Initializes the bitman config in /etc/bitman')
@@ -19,7 +42,8 @@ user_subparsers = user_parser.add_subparsers()
 user_setup_parser = user_subparsers.add_parser('setup', help='Setup bitman for this user')
 user_setup_parser.set_defaults(func=app.setup)
 
-user_install_parser = user_subparsers.add_parser('install', help='Install packages for user branch')
+user_install_parser = user_subparsers.add_parser(
+    'install', help='Adds packages to the config, commits them and installs only these packages')
 user_install_parser.add_argument('--aur', help='Install packages from the AUR', action='store_true')
 user_install_parser.add_argument('packages', nargs='+', help='The packages you want to install')
 user_install_parser.set_defaults(func=app.install, scope='user')
@@ -28,9 +52,141 @@ sync_parser = subparsers.add_parser('sync', help='Sync Commands')
 sync_parser.add_argument('--packages', action='store_true', help='Only sync packages')
 sync_parser.add_argument('--services', action='store_true', help='Only sync services')
 sync_parser.add_argument('--ufw', action='store_true', help='Only sync ufw rules')
+sync_parser.add_argument('--pull', action='store_true',
+                         help='Pull the config repository before syncing if it has new commits')
+sync_parser.add_argument('--full', action='store_true',
+                         help='Sync all subsystems, even if neither they nor their config changed '
+                              'since the last sync')
+sync_parser.add_argument('--force', action='store_true',
+                         help='Check the system even if neither it nor the config changed since '
+                         'the last successful sync')
+sync_parser.add_argument('--upgrade', action='store_true',
+                         help='Upgrade the system if configured packages are outdated')
 sync_parser.add_argument('--status', action='store_true',
                          help='List which packages are missing and which are additionally installed compared to bitman configuration')
+sync_parser.add_argument('--plan', metavar='FILE',
+                         help='Compute all changes and write them to a plan file instead of applying them')
+sync_parser.add_argument('--apply', metavar='FILE',
+                         help='Apply a plan file, if the system did not change since it was created')
+sync_parser.add_argument('--resume', action='store_true',
+                         help='Continue the last sync which did not finish, skipping the steps it '
+                         'already completed')
+sync_parser.add_argument('--format', choices=['text', 'json'], default='text',
+                         help='Output format of --status, json implies --non-interactive')
 sync_parser.set_defaults(func=app.sync)
 
+metrics_parser = subparsers.add_parser(
+    'metrics', help='Writes drift counts and durations in the Prometheus text format')
+metrics_parser.add_argument('--packages', action='store_true', help='Only check packages')
+metrics_parser.add_argument('--services', action='store_true', help='Only check services')
+metrics_parser.add_argument('--ufw', action='store_true', help='Only check ufw rules')
+metrics_parser.add_argument('--textfile', metavar='FILE',
+                            help='Write the metrics atomically to this node_exporter textfile '
+                            'instead of stdout')
+metrics_parser.set_defaults(func=app.metrics, non_interactive=True)
+
+history_parser = subparsers.add_parser(
+    'history', help='Shows which packages, hooks and phases took the most time across syncs')
+history_parser.add_argument('--limit', type=int, default=25,
+                            help='Only show this many steps, the most expensive ones first')
+history_parser.add_argument('--format', choices=['text', 'json'], default='text',
+                            help='Output format')
+history_parser.set_defaults(func=app.history)
+
+image_parser = subparsers.add_parser('image', help='Image Commands')
+image_subparsers = image_parser.add_subparsers()
+
+image_build_parser = image_subparsers.add_parser(
+    'build', help='Provisions several roots from the config concurrently')
+image_build_parser.add_argument('--jobs', '-j', type=int, default=4,
+                                help='How many roots are provisioned at the same time')
+image_build_parser.add_argument('roots', nargs='+', metavar='ROOT',
+                                help='The root directories to provision')
+image_build_parser.set_defaults(func=app.image_build)
+
+index_parser = subparsers.add_parser(
+    'index', help='Manages the index of installed packages bitman reads instead of pacman')
+index_subparsers = index_parser.add_subparsers()
+
+index_hook_parser = index_subparsers.add_parser(
+    'install-hook', help='Installs the pacman hook which updates the index after transactions')
+index_hook_parser.set_defaults(func=app.index_install_hook)
+
+index_rebuild_parser = index_subparsers.add_parser(
+    'rebuild', help='Rebuilds the index from pacman')
+index_rebuild_parser.set_defaults(func=app.index_rebuild)
+
+cache_parser = subparsers.add_parser('cache', help='Manages the pacman package cache')
+cache_subparsers = cache_parser.add_subparsers()
+
+cache_prune_parser = cache_subparsers.add_parser(
+    'prune', help='Removes cached packages which neither installed nor configured packages use')
+cache_prune_parser.add_argument('--keep', type=int, default=1, metavar='N',
+                                help='Keep this many versions older than the used one of each '
+                                'package')
+cache_prune_parser.set_defaults(func=app.cache_prune)
+
+agent_parser = subparsers.add_parser(
+    'agent', help='Keeps the system state in memory and answers status and plan queries')
+agent_parser.add_argument('--socket', metavar='PATH',
+                          help='The socket of the agent, defaults to agent.sock in /run/bitman')
+agent_subparsers = agent_parser.add_subparsers()
+
+agent_run_parser = agent_subparsers.add_parser('run', help='Runs the agent in the foreground')
+agent_run_parser.add_argument('--interval', type=float, default=15 * 60, metavar='SECONDS',
+                              help='Refresh everything this often, even without change events')
+agent_run_parser.set_defaults(func=app.agent_run, non_interactive=True)
+
+agent_status_parser = agent_subparsers.add_parser(
+    'status', help='Prints the status known to the running agent as JSON')
+agent_status_parser.set_defaults(func=app.agent_query, query='status')
+
+agent_plan_parser = agent_subparsers.add_parser(
+    'plan', help='Writes a plan of the running agent, which can be applied with sync --apply')
+agent_plan_parser.add_argument('--output', '-o', metavar='FILE',
+                               help='Write the plan to this file instead of stdout')
+agent_plan_parser.set_defaults(func=app.agent_query, query='plan')
+
+firewall_parser = subparsers.add_parser('firewall', help='Firewall Commands')
+firewall_subparsers = firewall_parser.add_subparsers()
+
+firewall_export_parser = firewall_subparsers.add_parser(
+    'export', help='Prints the firewall config compiled into an nftables ruleset')
+firewall_export_parser.add_argument('--output', '-o', help='Write the ruleset to this file')
+firewall_export_parser.add_argument('--check', action='store_true',
+                                    help='Validate the ruleset with nft -c before writing it')
+firewall_export_parser.set_defaults(func=app.firewall_export)
+
 args = parser.parse_args()
-args.func(args)
+if args.root is not None:
+    set_target_root(args.root)
+if args.config is not None:
+    app.config_directory = args.config
+if args.non_interactive or getattr(args, 'format', 'text') == 'json':
+    set_interactive(False)
+if args.record is not None:
+    set_command_runner(RecordingCommandRunner(args.record))
+elif args.replay is not None:
+    set_command_runner(ReplayCommandRunner(args.replay, args.replay_realtime))
+
+tracer = None
+if args.trace is not None:
+    tracer = enable_tracing()
+    set_command_runner(TracingCommandRunner(command_runner()))
+
+profile = None
+if args.profile:
+    import cProfile
+    profile = cProfile.Profile()
+try:
+    with span(' '.join(sys.argv[1:]) or 'bitman', 'run'):
+        if profile is not None:
+            profile.runcall(args.func, args)
+        else:
+            args.func(args)
+finally:
+    if tracer is not None:
+        tracer.save(args.trace)
+    if profile is not None:
+        import pstats
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('tottime').print_stats(25)
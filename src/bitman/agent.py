@@ -0,0 +1,312 @@
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+from argparse import Namespace
+from os.path import dirname, expanduser, join, relpath
+from subprocess import CalledProcessError
+
+from bitman.config import SYSTEM_CONFIG_PATH
+from bitman.config.system_config import SystemConfig
+from bitman.fingerprint import PACMAN_LOCAL_DB_PATH, PACMAN_SYNC_DB_PATH, UFW_RULES_FILES, \
+    observed_state_fingerprint
+from bitman.git import GitRepository
+from bitman.inotify import IN_DELETE, IN_MOVED_FROM, Inotify, InotifyEvent
+from bitman.nft import Nft
+from bitman.nft_sync import NftSync
+from bitman.package.pacman import PACMAN_LOCK_PATH, Pacman
+from bitman.package.yay import Yay
+from bitman.paths import runtime_directory, state_directory
+from bitman.plan import SyncPlan
+from bitman.service import Systemd
+from bitman.state import Subsystem, SyncState
+from bitman.status import StatusReport
+from bitman.sync import Sync, SyncScope, subsystems_of
+from bitman.ufw import Ufw
+
+# Directories whose changes alter which units are enabled
+UNIT_WANTS_PATHS = ['/etc/systemd/system', '/etc/systemd/user', '~/.config/systemd/user']
+UFW_CONFIG_PATH = '/etc/ufw'
+
+SUBSYSTEMS: tuple[Subsystem, ...] = ('packages', 'services', 'ufw')
+# Events arrive in bursts (a pacman transaction touches hundreds of files), the state is only
+# recomputed once a burst is over
+DEBOUNCE_SECONDS = 0.5
+DEFAULT_INTERVAL_SECONDS = 15 * 60
+
+
+def agent_socket_path() -> str:
+    """Returns the path of the socket the agent answers queries on"""
+    return join(runtime_directory(), 'agent.sock')
+
+
+class Agent:
+    """
+    Keeps the desired and the actual system state in memory and answers status and plan queries
+    over a Unix socket. Changes of the config, the pacman database, the enabled units and the UFW
+    rules are watched with inotify and only the affected subsystems are recomputed. The nftables
+    ruleset can't be watched, it is (like everything else) refreshed every `interval` seconds.
+    """
+
+    def __init__(self,
+                 socket_path: str,
+                 config_directory: str = SYSTEM_CONFIG_PATH,
+                 interval: float = DEFAULT_INTERVAL_SECONDS):
+        self._socket_path = socket_path
+        self._config_directory = config_directory
+        self._interval = interval
+        self._report = StatusReport(None, None, None, None, None, {})
+        self._fingerprint: str | None = None
+        self._commit: str | None = None
+        self._updated: dict[str, float] = {}
+        self._errors: dict[str, str] = {}
+        self._dirty: set[str] = set()
+        self._last_event = 0.0
+        self._last_full_refresh = float('-inf')
+
+    def run(self) -> None:
+        """Serves queries until the process is terminated"""
+        signal.signal(signal.SIGTERM, _exit)
+        inotify = Inotify()
+        self._watch(inotify)
+        server = self._listen()
+        selector = selectors.DefaultSelector()
+        selector.register(inotify, selectors.EVENT_READ)
+        selector.register(server, selectors.EVENT_READ)
+        _log(f'Listening on {self._socket_path}')
+
+        try:
+            while True:
+                now = time.monotonic()
+                if now - self._last_full_refresh >= self._interval:
+                    self._dirty.update(SUBSYSTEMS)
+                    self._dirty.add('commit')
+                    self._last_full_refresh = now
+                if self._refreshable() and now - self._last_event >= DEBOUNCE_SECONDS:
+                    self._refresh()
+
+                for key, _ in selector.select(self._timeout()):
+                    if key.fileobj is inotify:
+                        self._on_events(inotify.read_events())
+                    else:
+                        self._serve(server)
+        finally:
+            selector.close()
+            server.close()
+            inotify.close()
+            os.unlink(self._socket_path)
+
+    def _watch(self, inotify: Inotify) -> None:
+        inotify.add_watch(self._config_directory, recursive=True)
+        inotify.add_watch(dirname(PACMAN_LOCAL_DB_PATH))
+        inotify.add_watch(PACMAN_LOCAL_DB_PATH)
+        inotify.add_watch(PACMAN_SYNC_DB_PATH)
+        for unit_path in UNIT_WANTS_PATHS:
+            inotify.add_watch(expanduser(unit_path), recursive=True)
+        inotify.add_watch(UFW_CONFIG_PATH)
+        for rules_file in UFW_RULES_FILES:
+            if not rules_file.startswith(f'{UFW_CONFIG_PATH}/'):
+                inotify.add_watch(dirname(rules_file))
+
+    def _listen(self) -> socket.socket:
+        os.makedirs(dirname(self._socket_path), exist_ok=True)
+        if os.path.exists(self._socket_path):
+            try:
+                query_agent('ping', self._socket_path)
+            except AgentNotRunningException:
+                os.unlink(self._socket_path)
+            else:
+                raise AgentException(f'An agent is already listening on {self._socket_path}')
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+        server.listen()
+        return server
+
+    def _on_events(self, events: list[InotifyEvent]) -> None:
+        for event in events:
+            affected = self._affected_by(event)
+            if affected:
+                self._dirty.update(affected)
+                self._last_event = time.monotonic()
+
+    def _affected_by(self, event: InotifyEvent) -> set[str]:
+        """Returns which parts of the state an event invalidates"""
+        if event.directory == '':
+            # The event queue overflowed, changes may have been lost
+            return {*SUBSYSTEMS, 'commit'}
+
+        if event.path.startswith(f'{self._config_directory}/'):
+            file_path = relpath(event.path, self._config_directory)
+            if file_path.split('/', 1)[0] == '.git':
+                return {'commit'}
+            return set(subsystems_of(file_path))
+
+        if event.directory == dirname(PACMAN_LOCAL_DB_PATH):
+            # A transaction is over once pacman removes its lock, packages may have brought units
+            if event.name == 'db.lck' and event.mask & (IN_DELETE | IN_MOVED_FROM):
+                return {'packages', 'services'}
+            return set()
+        if event.path.startswith(PACMAN_LOCAL_DB_PATH):
+            return {'packages', 'services'}
+        if event.path.startswith(PACMAN_SYNC_DB_PATH):
+            # Refreshed sync databases only change which packages are outdated
+            return {'packages'}
+
+        if event.path in UFW_RULES_FILES or event.directory == UFW_CONFIG_PATH:
+            return {'ufw'}
+        if any(event.path.startswith(expanduser(unit_path)) for unit_path in UNIT_WANTS_PATHS):
+            return {'services'}
+        return set()
+
+    def _timeout(self) -> float:
+        now = time.monotonic()
+        timeout = self._last_full_refresh + self._interval - now
+        if self._refreshable():
+            timeout = min(timeout, self._last_event + DEBOUNCE_SECONDS - now)
+        return max(0.0, timeout)
+
+    def _refreshable(self) -> set[str]:
+        """Returns the dirty parts of the state which can be recomputed right now"""
+        if os.path.exists(PACMAN_LOCK_PATH):
+            # Packages are refreshed once the running transaction removed its lock
+            return self._dirty.difference({'packages', 'services'})
+        return set(self._dirty)
+
+    def _refresh(self) -> None:
+        """Recomputes the dirty parts of the state"""
+        dirty = self._refreshable()
+        self._dirty.difference_update(dirty)
+        subsystems = [subsystem for subsystem in SUBSYSTEMS if subsystem in dirty]
+
+        sync = self._new_sync()
+        refreshed = []
+        for subsystem in subsystems:
+            try:
+                report = sync.status_report(SyncScope(Namespace(
+                    packages=subsystem == 'packages',
+                    services=subsystem == 'services',
+                    ufw=subsystem == 'ufw'
+                )))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                self._errors[subsystem] = str(e) or type(e).__name__
+                _log(f'Refreshing {subsystem} failed: {self._errors[subsystem]}')
+                continue
+            self._merge(subsystem, report)
+            self._errors.pop(subsystem, None)
+            self._updated[subsystem] = time.time()
+            refreshed.append(subsystem)
+
+        if subsystems or 'commit' in dirty:
+            self._commit = self._config_commit()
+            self._fingerprint = observed_state_fingerprint()
+        if refreshed:
+            _log(f'Refreshed {", ".join(refreshed)}')
+
+    def _merge(self, subsystem: str, report: StatusReport) -> None:
+        durations = {**self._report.durations, **report.durations}
+        if subsystem == 'packages':
+            self._report = self._report._replace(packages=report.packages, durations=durations)
+        elif subsystem == 'services':
+            self._report = self._report._replace(services=report.services, durations=durations)
+        else:
+            self._report = self._report._replace(
+                firewall_backend=report.firewall_backend, ufw=report.ufw,
+                nftables=report.nftables, durations=durations)
+
+    def _new_sync(self) -> Sync:
+        # Backends cache command output and the config caches its resolved layers, every refresh
+        # starts from scratch
+        return Sync(SystemConfig(self._config_directory), Pacman(), Yay(), Systemd(), Ufw(), Nft(),
+                    GitRepository(self._config_directory), SyncState(state_directory()))
+
+    def _config_commit(self) -> str | None:
+        try:
+            return GitRepository(self._config_directory).head_commit()
+        except (CalledProcessError, OSError):
+            return None
+
+    def _serve(self, server: socket.socket) -> None:
+        connection, _ = server.accept()
+        with connection:
+            connection.settimeout(5)
+            try:
+                with connection.makefile('rb') as request_file:
+                    request = json.loads(request_file.readline())
+                response = self._answer(request.get('query'))
+            except (OSError, ValueError, AttributeError) as e:
+                response = {'error': f'Invalid request: {e}'}
+            try:
+                connection.sendall(json.dumps(response).encode() + b'\n')
+            except OSError:
+                pass
+
+    def _answer(self, query: str | None) -> dict:
+        if query == 'ping':
+            return {'pong': True}
+        if query not in ('status', 'plan'):
+            return {'error': f'Unknown query: {query}'}
+
+        # Queries never wait for the debounce, but a running pacman transaction is not awaited
+        if self._refreshable():
+            self._refresh()
+
+        if query == 'status':
+            return {
+                **self._report.to_json(),
+                'fingerprint': self._fingerprint,
+                'config_commit': self._commit,
+                'updated': self._updated,
+                'stale': sorted(self._dirty),
+                'errors': self._errors,
+            }
+        return self._plan().to_json()
+
+    def _plan(self) -> SyncPlan:
+        nftables = None
+        if self._report.nftables is not None and not self._report.nftables.is_empty():
+            sync = NftSync(Nft(), None, SystemConfig(self._config_directory))
+            nftables = sync.compiled_ruleset().render()
+        return SyncPlan(self._fingerprint, self._commit, self._report.packages,
+                        self._report.services, self._report.ufw, nftables)
+
+
+def query_agent(query: str, socket_path: str | None = None) -> dict:
+    """Sends a query to the running agent and returns its answer"""
+    socket_path = agent_socket_path() if socket_path is None else socket_path
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+            connection.sendall(json.dumps({'query': query}).encode() + b'\n')
+            with connection.makefile('rb') as response_file:
+                response = json.loads(response_file.readline())
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise AgentNotRunningException(f'No agent is listening on {socket_path}') from e
+    except (OSError, ValueError) as e:
+        raise AgentException(f'The agent did not answer: {e}') from e
+
+    if 'error' in response:
+        raise AgentException(response['error'])
+    return response
+
+
+def _log(message: str) -> None:
+    print(message, file=sys.stderr, flush=True)
+
+
+def _exit(_signal: int, _frame) -> None:
+    raise SystemExit(0)
+
+
+class AgentException(BaseException):
+    pass
+
+
+class AgentNotRunningException(AgentException):
+    pass
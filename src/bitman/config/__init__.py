@@ -1 +1,13 @@
 SYSTEM_CONFIG_PATH = '/etc/bitman'
+
+# Files bitman reads from the config repository (including those of layers), as sparse checkout
+# patterns
+CONFIG_FILE_PATTERNS = [
+    'layers.conf',
+    'arch.packages',
+    'aur.packages',
+    'services.conf',
+    'ufw.conf',
+    'hooks/',
+    'user/',
+]
@@ -0,0 +1,279 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+from os.path import dirname, isdir, isfile, join
+from typing import Callable
+
+from .ufw_rule import DefaultUfwRule, UfwConfigParseException
+
+LAYERS_FILE = 'layers.conf'
+HOOKS_DIRECTORY = 'hooks'
+LAYER_VERSION = 1
+# Resolved layers unused for this long are removed, concurrent processes may still use newer ones
+LAYER_MAX_AGE = 24 * 60 * 60
+
+# Every file is kept as its sections of entries by key, files without sections only have the ''
+# section
+LayerState = dict[str, dict[str, dict[str, str]]]
+
+
+def _line_key(line: str) -> str:
+    return line
+
+
+def _service_key(line: str) -> str:
+    return line.split(maxsplit=1)[-1]
+
+
+def _ufw_rule_key(line: str) -> str:
+    return '\t'.join(part.strip() for part in line.split('\t'))
+
+
+def _default_ufw_rule_key(line: str) -> str:
+    try:
+        return DefaultUfwRule.fromBitmanConfig(line).type
+    except UfwConfigParseException:
+        return line
+
+
+def _replace_key(_line: str) -> str:
+    return ''
+
+
+# How entries of each layered file are identified: a later layer replaces entries with the same
+# key and a line prefixed with '-' removes them
+LAYERED_FILES: dict[str, dict[str, Callable[[str], str]] | None] = {
+    'arch.packages': None,
+    'aur.packages': None,
+    join('user', 'symlinks'): None,
+    'services.conf': {'system': _service_key, 'user': _service_key},
+    'ufw.conf': {'backend': _replace_key, 'default': _default_ufw_rule_key, 'rules': _ufw_rule_key},
+}
+
+
+class LayeredConfig:
+    """
+    Resolves a base config with overlay layers (e.g. base → role → host) listed in layers.conf.
+    The resolved state after each layer is memoized by a hash of that layer's contents and of all
+    layers below it, so only changed layers and the ones above them are recomputed.
+    """
+
+    def __init__(self, config_directory: str, cache_directory: str):
+        self._config_directory = config_directory
+        # Every config has its own cache, so resolving one config never touches another one
+        config_key = hashlib.sha256(os.path.abspath(config_directory).encode()).hexdigest()
+        self._cache_directory = join(cache_directory, 'layers', config_key[:32])
+
+    def is_layered(self) -> bool:
+        """Returns whether the config defines any layers"""
+        return isfile(join(self._config_directory, LAYERS_FILE))
+
+    def layers(self) -> list[str]:
+        """Returns the directories of all existing layers, base layer first"""
+        layers = [self._config_directory]
+        hostname = socket.gethostname()
+        try:
+            with open(join(self._config_directory, LAYERS_FILE), 'rt', encoding='utf-8') as file:
+                for line in file:
+                    line = line.strip()
+                    if line.startswith('#') or line == '':
+                        continue
+                    layer = join(self._config_directory, line.replace('{hostname}', hostname))
+                    if isdir(layer):
+                        layers.append(layer)
+        except IOError:
+            pass
+        return layers
+
+    def resolve(self) -> str:
+        """Resolves all layers and returns the directory containing the resolved config"""
+        layers = self.layers()
+        keys = []
+        key = f'bitman-layers-{LAYER_VERSION}'
+        for layer in layers:
+            key = hashlib.sha256(f'{key}\0{_layer_hash(layer)}'.encode()).hexdigest()
+            keys.append(key)
+
+        resolved_directory = join(self._cache_directory, f'resolved-{keys[-1]}')
+        if isdir(resolved_directory):
+            # Marks the resolved layers as used, so other processes don't prune them
+            _touch(resolved_directory)
+            return resolved_directory
+
+        state: LayerState = {}
+        hooks: dict[str, str] = {}
+        start = 0
+        for index in range(len(keys) - 1, -1, -1):
+            cached = self._read_state(keys[index])
+            if cached is not None:
+                state, hooks = cached
+                _touch(join(self._cache_directory, f'layer-{keys[index]}.json'))
+                start = index + 1
+                break
+
+        for index in range(start, len(layers)):
+            _apply_layer(state, hooks, layers[index])
+            self._write_state(keys[index], state, hooks)
+
+        try:
+            self._materialize(resolved_directory, state, hooks)
+        except OSError:
+            # The cache can't be written, the config is resolved for this process only
+            return self._materialize_temporary(state, hooks)
+        self._prune(keys)
+        return resolved_directory
+
+    def _prune(self, keys: list[str]) -> None:
+        """Removes the layers of this config which weren't used for `LAYER_MAX_AGE` seconds"""
+        current = {f'layer-{key}.json' for key in keys}
+        current.add(f'resolved-{keys[-1]}')
+        stale = time.time() - LAYER_MAX_AGE
+        try:
+            entries = list(os.scandir(self._cache_directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name in current or entry.stat(follow_symlinks=False).st_mtime > stale:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # Pruned by another process
+                pass
+
+    def _read_state(self, key: str) -> tuple[LayerState, dict[str, str]] | None:
+        try:
+            with open(join(self._cache_directory, f'layer-{key}.json'), 'rt',
+                      encoding='utf-8') as state_file:
+                data = json.load(state_file)
+        except (IOError, ValueError):
+            return None
+        return data['files'], data['hooks']
+
+    def _write_state(self, key: str, state: LayerState, hooks: dict[str, str]) -> None:
+        """Memoizes the state after a layer, nothing is memoized if the cache can't be written"""
+        state_path = join(self._cache_directory, f'layer-{key}.json')
+        temp_path = f'{state_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self._cache_directory, exist_ok=True)
+            with open(temp_path, 'wt', encoding='utf-8') as state_file:
+                json.dump({'files': state, 'hooks': hooks}, state_file, separators=(',', ':'))
+            os.replace(temp_path, state_path)
+        except OSError:
+            _remove(temp_path)
+
+    def _materialize_temporary(self, state: LayerState, hooks: dict[str, str]) -> str:
+        """Writes the resolved config into a temporary directory, removed when bitman exits"""
+        import tempfile
+        directory = join(tempfile.mkdtemp(prefix='bitman-layers-'), 'resolved')
+        atexit.register(shutil.rmtree, dirname(directory), ignore_errors=True)
+        self._materialize(directory, state, hooks)
+        return directory
+
+    def _materialize(self, directory: str, state: LayerState, hooks: dict[str, str]) -> None:
+        temp_directory = f'{directory}.{os.getpid()}.tmp'
+        try:
+            self._write_files(temp_directory, state, hooks)
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            # Another process resolved the same layers concurrently
+            if not isdir(directory):
+                raise
+
+    def _write_files(self, directory: str, state: LayerState, hooks: dict[str, str]) -> None:
+        os.makedirs(join(directory, 'user'), exist_ok=True)
+        os.makedirs(join(directory, HOOKS_DIRECTORY), exist_ok=True)
+
+        for file_name, sections in state.items():
+            with open(join(directory, file_name), 'wt', encoding='utf-8') as file:
+                for section, lines in sections.items():
+                    if section != '':
+                        file.write(f'[{section}]\n')
+                    file.writelines(f'{line}\n' for line in lines.values())
+
+        for hook_name, hook_path in hooks.items():
+            os.symlink(hook_path, join(directory, HOOKS_DIRECTORY, hook_name))
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _layer_hash(layer: str) -> str:
+    digest = hashlib.sha256()
+    for file_name in LAYERED_FILES:
+        digest.update(f'\0{file_name}\0'.encode())
+        try:
+            with open(join(layer, file_name), 'rb') as file:
+                digest.update(file.read())
+        except IOError:
+            digest.update(b'\0missing')
+    digest.update(b'\0hooks\0')
+    digest.update('\0'.join(sorted(_hook_names(layer))).encode())
+    return digest.hexdigest()
+
+
+def _hook_names(layer: str) -> list[str]:
+    try:
+        return [entry.name for entry in os.scandir(join(layer, HOOKS_DIRECTORY)) if entry.is_file()]
+    except IOError:
+        return []
+
+
+def _apply_layer(state: LayerState, hooks: dict[str, str], layer: str) -> None:
+    for file_name, section_keys in LAYERED_FILES.items():
+        try:
+            with open(join(layer, file_name), 'rt', encoding='utf-8') as file:
+                lines = file.read().splitlines()
+        except IOError:
+            continue
+
+        sections = state.setdefault(file_name, {})
+        current_section = ''
+        for line in lines:
+            line = line.strip()
+            if line.startswith('#') or line == '':
+                continue
+            if section_keys is not None and line.startswith('['):
+                current_section = line.lower().removeprefix('[').removesuffix(']').strip()
+                continue
+            if section_keys is None:
+                key = _line_key
+            elif current_section in section_keys:
+                key = section_keys[current_section]
+            else:
+                continue
+            _merged(sections.setdefault(current_section, {}), line, key)
+
+    for hook_name in _hook_names(layer):
+        hooks[hook_name] = join(layer, HOOKS_DIRECTORY, hook_name)
+
+
+def _merged(entries: dict[str, str], line: str, key: Callable[[str], str]) -> None:
+    if line.startswith('-'):
+        entries.pop(key(line.removeprefix('-').strip()), None)
+        return
+    entries[key(line)] = line
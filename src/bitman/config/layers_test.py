@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from bitman.config.layers import LayeredConfig
+
+
+class LayeredConfigTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._config = join(self._directory, 'config')
+        self._write('layers.conf', 'roles/web\n')
+        self._write('arch.packages', 'vim\nnano\n')
+        self._write(join('roles', 'web', 'arch.packages'), '-nano\nnginx\n')
+        self._write(join('roles', 'web', 'hooks', 'nginx'), '#!/bin/sh\n')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_resolve(self):
+        cache = join(self._directory, 'cache')
+        resolved = LayeredConfig(self._config, cache).resolve()
+
+        self.assertTrue(resolved.startswith(cache))
+        self._assert_resolved(resolved)
+        self.assertEqual(LayeredConfig(self._config, cache).resolve(), resolved)
+
+    def test_resolve_without_writable_cache(self):
+        # A file in place of the cache directory can't be written to, not even by root
+        cache = join(self._directory, 'cache')
+        with open(cache, 'wt', encoding='utf-8'):
+            pass
+
+        resolved = LayeredConfig(self._config, cache).resolve()
+
+        self.assertFalse(resolved.startswith(cache))
+        self._assert_resolved(resolved)
+
+    def _assert_resolved(self, resolved: str) -> None:
+        with open(join(resolved, 'arch.packages'), 'rt', encoding='utf-8') as packages_file:
+            self.assertEqual(packages_file.read().split(), ['vim', 'nginx'])
+        self.assertEqual(os.listdir(join(resolved, 'hooks')), ['nginx'])
+
+    def _write(self, file_path: str, content: str) -> None:
+        file_path = join(self._config, file_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wt', encoding='utf-8') as file:
+            file.write(content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+from os import stat
+from typing import Callable, Literal, NamedTuple, TypeVar
+
+from .service_config import ServiceConfig, ServiceConfigParseException
+from .ufw_rule import DefaultUfwRule, UfwRule, UfwConfigParseException
+
+T = TypeVar('T')
+
+
+class ServicesConfig(NamedTuple):
+    system: tuple[ServiceConfig, ...]
+    user: tuple[ServiceConfig, ...]
+
+
+class UfwConfig(NamedTuple):
+    backend: Literal['ufw', 'nftables']
+    default_rules: tuple[DefaultUfwRule, ...]
+    rules: tuple[UfwRule, ...]
+
+
+class ConfigLoader:
+    """
+    Reads every config file once, parses all of its sections in a single pass and memoizes the
+    result for the lifetime of the process. Entries are invalidated when the file changes on disk.
+    """
+
+    def __init__(self):
+        self._cache: dict[tuple[str, str], tuple[tuple[int, int, int], object]] = {}
+
+    def lines(self, file_path: str) -> tuple[str, ...]:
+        """Returns all non-empty, non-comment lines of a file, or nothing if it doesn't exist"""
+        try:
+            return self._memoized('lines', file_path, _parsed_lines)
+        except IOError:
+            return ()
+
+    def services(self, file_path: str) -> ServicesConfig:
+        """Returns the `[system]` and `[user]` sections of services.conf"""
+        try:
+            return self._memoized('services', file_path, _parsed_services)
+        except IOError:
+            return ServicesConfig((), ())
+
+    def ufw(self, file_path: str) -> UfwConfig:
+        """Returns the `[backend]`, `[default]` and `[rules]` sections of ufw.conf"""
+        return self._memoized('ufw', file_path, _parsed_ufw)
+
+    def invalidate(self) -> None:
+        """Drops all memoized files"""
+        self._cache.clear()
+
+    def _memoized(self, kind: str, file_path: str, parse: Callable[[str, list[str]], T]) -> T:
+        file_stat = stat(file_path)
+        key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+        cached = self._cache.get((kind, file_path))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with open(file_path, 'rt', encoding='utf-8') as config_file:
+            parsed = parse(file_path, config_file.read().splitlines())
+        self._cache[(kind, file_path)] = (key, parsed)
+        return parsed
+
+
+def _parsed_lines(_file_path: str, lines: list[str]) -> tuple[str, ...]:
+    result = []
+    for line in lines:
+        line = line.strip()
+        if not line.startswith('#') and len(line) > 0:
+            result.append(line)
+    return tuple(result)
+
+
+def _sections(lines: list[str], names: tuple[str, ...]) -> dict[str, list[tuple[int, str]]]:
+    sections: dict[str, list[tuple[int, str]]] = {name: [] for name in names}
+    current: list[tuple[int, str]] | None = None
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if line.startswith('#') or line == '':
+            continue
+        if line.startswith('['):
+            current = sections.get(line.lower().removeprefix('[').removesuffix(']').strip())
+            continue
+        if current is not None:
+            current.append((line_number, line))
+    return sections
+
+
+def _parsed_services(file_path: str, lines: list[str]) -> ServicesConfig:
+    sections = _sections(lines, ('system', 'user'))
+    return ServicesConfig(
+        tuple(_parsed_service(file_path, number, line) for number, line in sections['system']),
+        tuple(_parsed_service(file_path, number, line) for number, line in sections['user'])
+    )
+
+
+def _parsed_service(file_path: str, line_number: int, line: str) -> ServiceConfig:
+    parts = line.split(maxsplit=1)
+    if len(parts) != 2 or parts[0] not in ('enable', 'disable'):
+        raise ServiceConfigParseException(
+            f'{file_path}:{line_number}: Invalid service config: {line}')
+    return ServiceConfig(parts[1], parts[0])
+
+
+def _parsed_ufw(file_path: str, lines: list[str]) -> UfwConfig:
+    sections = _sections(lines, ('backend', 'default', 'rules'))
+
+    backend = 'ufw'
+    for line_number, line in sections['backend']:
+        if line not in ('ufw', 'nftables'):
+            raise UfwConfigParseException(
+                f'{file_path}:{line_number}: Invalid firewall backend: {line}')
+        backend = line
+
+    return UfwConfig(
+        backend,
+        tuple(_parsed_ufw_line(file_path, number, line, DefaultUfwRule.fromBitmanConfig)
+              for number, line in sections['default']),
+        tuple(_parsed_ufw_line(file_path, number, line, UfwRule.fromBitmanConfig)
+              for number, line in sections['rules'])
+    )
+
+
+def _parsed_ufw_line(file_path: str, line_number: int, line: str, parse: Callable[[str], T]) -> T:
+    try:
+        return parse(line)
+    except UfwConfigParseException as e:
+        raise UfwConfigParseException(f'{file_path}:{line_number}: {e}') from e
+    except ValueError as e:
+        raise UfwConfigParseException(
+            f'{file_path}:{line_number}: Invalid UFW rule, expected 5 tab separated fields: {line}'
+        ) from e
+
+
+_loader = ConfigLoader()
+
+
+def config_loader() -> ConfigLoader:
+    """Returns the loader shared by the whole process"""
+    return _loader
@@ -5,3 +5,7 @@ from typing import Literal, NamedTuple
 class ServiceConfig(NamedTuple):
     service: str
     desired_state: Literal['enable', 'disable']
+
+
+class ServiceConfigParseException(BaseException):
+    pass
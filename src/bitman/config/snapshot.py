@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+from os.path import join
+from typing import Any, NamedTuple
+
+from bitman.paths import cache_directory
+from bitman.trace import span
+from .loader import ConfigLoader, ServicesConfig, UfwConfig, config_loader
+from .service_config import ServiceConfig
+from .ufw_rule import DefaultUfwRule, UfwRule
+
+SNAPSHOT_VERSION = 3
+
+
+class ConfigFiles(NamedTuple):
+    arch_packages: str
+    aur_packages: str
+    services: str
+    symlinks: str
+    ufw: str
+
+
+class ConfigSnapshot:
+    """
+    The parsed config files of one config. Every file is only hashed and parsed once it is needed,
+    so e.g. a broken ufw.conf doesn't affect syncing packages.
+    """
+
+    def __init__(self, store: 'ConfigSnapshotStore', snapshot_path: str, files: ConfigFiles,
+                 entries: dict[str, dict]):
+        self._store = store
+        self._snapshot_path = snapshot_path
+        self._files = files
+        self._entries = entries
+        self._parsed: dict[str, object] = {}
+
+    @property
+    def arch_packages(self) -> tuple[str, ...]:
+        return self._file('arch_packages')
+
+    @property
+    def aur_packages(self) -> tuple[str, ...]:
+        return self._file('aur_packages')
+
+    @property
+    def system_services(self) -> tuple[ServiceConfig, ...]:
+        return self._file('services').system
+
+    @property
+    def user_services(self) -> tuple[ServiceConfig, ...]:
+        return self._file('services').user
+
+    @property
+    def symlinks(self) -> tuple[str, ...]:
+        return self._file('symlinks')
+
+    @property
+    def ufw(self) -> UfwConfig | None:
+        return self._file('ufw')
+
+    def _file(self, name: str) -> Any:
+        if name not in self._parsed:
+            file_path = getattr(self._files, name)
+            content_hash = file_hash(file_path)
+            entry = self._entries.get(name)
+            if entry is not None and entry['hash'] == content_hash:
+                self._parsed[name] = _DESERIALIZERS[name](entry['value'])
+            else:
+                with span('config parse', 'config'):
+                    parsed = self._store.parse(name, file_path)
+                self._parsed[name] = parsed
+                self._entries[name] = {'hash': content_hash, 'value': _SERIALIZERS[name](parsed)}
+                self._store.write(self._snapshot_path, self._entries)
+        return self._parsed[name]
+
+
+class ConfigSnapshotStore:
+    """
+    Keeps the parsed config files of every config in a compact JSON file, each file keyed by a
+    hash of its contents. Later invocations only hash the files and skip parsing if nothing changed.
+    """
+
+    def __init__(self, directory: str, loader: ConfigLoader):
+        self._cache_directory = directory
+        self._loader = loader
+        self._memoized: dict[str, tuple[tuple, ConfigSnapshot]] = {}
+
+    def load(self, config_directory: str, files: ConfigFiles) -> ConfigSnapshot:
+        """Returns the snapshot of the files of a config, they are parsed only if needed"""
+        stat_key = tuple(_stat_key(file_path) for file_path in files)
+        memoized = self._memoized.get(config_directory)
+        if memoized is not None and memoized[0] == stat_key:
+            return memoized[1]
+
+        # A config is identified by its directory, as the files of a layered config move
+        config_key = hashlib.sha256(os.path.abspath(config_directory).encode()).hexdigest()
+        snapshot_path = join(self._cache_directory, f'config-{config_key[:32]}.json')
+        with span('config snapshot', 'config'):
+            snapshot = ConfigSnapshot(self, snapshot_path, files, self._read(snapshot_path))
+        self._memoized[config_directory] = (stat_key, snapshot)
+        return snapshot
+
+    def parse(self, name: str, file_path: str) -> Any:
+        """Parses a config file, a missing ufw.conf is None"""
+        if name == 'services':
+            return self._loader.services(file_path)
+        if name == 'ufw':
+            try:
+                return self._loader.ufw(file_path)
+            except IOError:
+                return None
+        return self._loader.lines(file_path)
+
+    def write(self, snapshot_path: str, entries: dict[str, dict]) -> None:
+        """Replaces the snapshot of a config"""
+        temp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self._cache_directory, exist_ok=True)
+            with open(temp_path, 'wt', encoding='utf-8') as snapshot_file:
+                json.dump({'version': SNAPSHOT_VERSION, 'files': entries}, snapshot_file,
+                          separators=(',', ':'))
+            os.replace(temp_path, snapshot_path)
+        except IOError:
+            # The snapshot is only a cache, bitman works the same without it
+            pass
+
+    def _read(self, snapshot_path: str) -> dict[str, dict]:
+        try:
+            with open(snapshot_path, 'rt', encoding='utf-8') as snapshot_file:
+                data = json.load(snapshot_file)
+        except (IOError, ValueError):
+            return {}
+        if data.get('version') != SNAPSHOT_VERSION:
+            return {}
+        return data['files']
+
+
+def config_hash(files: ConfigFiles) -> str:
+    """Returns a hash over the contents of all config files"""
+    digest = hashlib.sha256(f'bitman-config-{SNAPSHOT_VERSION}'.encode())
+    for name, file_path in zip(ConfigFiles._fields, files):
+        digest.update(f'\0{name}\0'.encode())
+        _update(digest, file_path)
+    return digest.hexdigest()
+
+
+def file_hash(file_path: str) -> str:
+    """Returns a hash over the contents of a config file"""
+    digest = hashlib.sha256()
+    _update(digest, file_path)
+    return digest.hexdigest()
+
+
+def _update(digest, file_path: str) -> None:
+    try:
+        with open(file_path, 'rb') as config_file:
+            digest.update(config_file.read())
+    except IOError:
+        digest.update(b'\0missing')
+
+
+def _stat_key(file_path: str) -> tuple[int, int, int] | None:
+    try:
+        file_stat = os.stat(file_path)
+    except IOError:
+        return None
+    return (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+
+
+def _serialized_ufw(ufw: UfwConfig | None) -> dict | None:
+    return None if ufw is None else {
+        'backend': ufw.backend,
+        'default': [[rule.type, rule.rule] for rule in ufw.default_rules],
+        'rules': [[rule.type, rule.rule, rule.proto, rule.port, rule.from_ip]
+                  for rule in ufw.rules],
+    }
+
+
+def _deserialized_ufw(ufw: dict | None) -> UfwConfig | None:
+    return None if ufw is None else UfwConfig(
+        ufw['backend'],
+        tuple(DefaultUfwRule(*rule) for rule in ufw['default']),
+        tuple(UfwRule(None, *rule) for rule in ufw['rules'])
+    )
+
+
+def _serialized_services(services: ServicesConfig) -> dict:
+    return {
+        'system': [[service.service, service.desired_state] for service in services.system],
+        'user': [[service.service, service.desired_state] for service in services.user],
+    }
+
+
+def _deserialized_services(services: dict) -> ServicesConfig:
+    return ServicesConfig(tuple(ServiceConfig(*service) for service in services['system']),
+                          tuple(ServiceConfig(*service) for service in services['user']))
+
+
+_SERIALIZERS = {
+    'arch_packages': list,
+    'aur_packages': list,
+    'services': _serialized_services,
+    'symlinks': list,
+    'ufw': _serialized_ufw,
+}
+_DESERIALIZERS = {
+    'arch_packages': tuple,
+    'aur_packages': tuple,
+    'services': _deserialized_services,
+    'symlinks': tuple,
+    'ufw': _deserialized_ufw,
+}
+
+
+_store: ConfigSnapshotStore | None = None
+
+
+def config_snapshot_store() -> ConfigSnapshotStore:
+    """Returns the snapshot store shared by the whole process"""
+    global _store
+    if _store is None:
+        _store = ConfigSnapshotStore(cache_directory(), config_loader())
+    return _store
@@ -1,20 +1,25 @@
+import os
 from os.path import join
-from typing import Generator
+from typing import Generator, Literal
 
 from bitman.config.service_config import ServiceConfig
+from bitman.paths import cache_directory
+from bitman.trace import span
 from . import SYSTEM_CONFIG_PATH
+from .layers import LayeredConfig
+from .loader import UfwConfig, config_loader
+from .snapshot import ConfigFiles, ConfigSnapshot, ConfigSnapshotStore, config_snapshot_store
 from .ufw_rule import UfwRule, DefaultUfwRule
 
 
 class SystemConfig:
-    def __init__(self):
-        self._config_directory = SYSTEM_CONFIG_PATH
-        self._arch_packages_path = join(self._config_directory, 'arch.packages')
-        self._aur_packages_path = join(self._config_directory, 'aur.packages')
-        self._services_path = join(self._config_directory, 'services.conf')
-        self._symlinks_file_path = join(self._config_directory, 'user', 'symlinks')
-        self._ufw_rules_path = join(self._config_directory, 'ufw.conf')
-        self._hooks_directory = join(self._config_directory, 'hooks')
+    def __init__(self, config_directory: str = SYSTEM_CONFIG_PATH, cache_path: str | None = None):
+        self._config_directory = config_directory
+        self._layered_config = LayeredConfig(
+            self._config_directory, cache_path if cache_path is not None else cache_directory())
+        self._resolved_directory: str | None = None
+        self._snapshot_store = config_snapshot_store() if cache_path is None \
+            else ConfigSnapshotStore(cache_path, config_loader())
 
     @property
     def user_config_directory(self) -> str:
@@ -23,107 +28,91 @@ class SystemConfig:
 
     def arch_packages(self) -> Generator[str, None, None]:
         """Yields all Arch packages defined in the bitman config"""
-        yield from self._packages(self._arch_packages_path)
+        yield from self._snapshot().arch_packages
 
     def aur_packages(self) -> Generator[str, None, None]:
         """Yields all AUR packages defined in the bitman config"""
-        yield from self._packages(self._aur_packages_path)
+        yield from self._snapshot().aur_packages
 
     def system_services(self) -> Generator[ServiceConfig, None, None]:
         """Returns list of configured system services"""
-        yield from self._parsed_services('system')
+        yield from self._snapshot().system_services
 
     def user_services(self) -> Generator[ServiceConfig, None, None]:
         """Returns list of configured user services"""
-        yield from self._parsed_services('user')
+        yield from self._snapshot().user_services
 
     def symlinks(self) -> Generator[str, None, None]:
         """Returns list of configured symlinks for user files"""
-        try:
-            with open(self._symlinks_file_path, 'rt', encoding='utf-8') as config_file:
-                for line in config_file:
-                    line = line.strip()
-                    if not line.startswith('#') and len(line) > 0:
-                        yield line
-        except IOError:
-            yield from []
+        yield from self._snapshot().symlinks
 
     def ufw_rules(self) -> Generator[UfwRule, None, None]:
         """Returns list of configured UFW rules"""
-        yield from self._parsed_ufw_rules()
+        yield from self._ufw_config().rules
 
-    def default_ufw_rules(self) -> Generator[UfwRule, None, None]:
+    def default_ufw_rules(self) -> Generator[DefaultUfwRule, None, None]:
         """Returns list of configured default UFW rules"""
-        yield from self._parsed_default_ufw_rules()
+        yield from self._ufw_config().default_rules
+
+    def firewall_backend(self) -> Literal['ufw', 'nftables']:
+        """Returns the configured firewall backend, defaults to UFW"""
+        ufw = self._snapshot().ufw
+        return 'ufw' if ufw is None else ufw.backend
+
+    def add_packages(self, packages: list[str], aur: bool = False) -> str:
+        """
+        Adds packages to the package list of the most specific layer (of the config itself if it
+        isn't layered), removals of them in that layer are dropped. Returns the changed file.
+        """
+        file_path = join(self._layered_config.layers()[-1],
+                         'aur.packages' if aur else 'arch.packages')
+        try:
+            with open(file_path, 'rt', encoding='utf-8') as packages_file:
+                lines = packages_file.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+
+        removals = {f'-{package}' for package in packages}
+        lines = [line for line in lines if line.strip() not in removals]
+        existing = {line.strip() for line in lines}
+        lines += [package for package in packages if package not in existing]
+
+        temp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wt', encoding='utf-8') as packages_file:
+            packages_file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, file_path)
+        return file_path
 
     def hooks_directory(self) -> str:
         """Returns path to hooks directory"""
-        return self._hooks_directory
-
-    def _parsed_ufw_rules(self):
-        with open(self._ufw_rules_path, 'rt', encoding='utf-8') as config_file:
-            is_rule_block = False
-            for line in config_file:
-                line = line.strip()
-                if line.startswith('#') or line == '':
-                    continue
-                if not is_rule_block and '[rules]' in line.lower():
-                    is_rule_block = True
-                    continue
-                if is_rule_block and line.startswith('['):
-                    break
-                if is_rule_block:
-                    yield UfwRule.fromBitmanConfig(line)
-
-    def _parsed_default_ufw_rules(self) -> Generator[DefaultUfwRule, None, None]:
-        with open(self._ufw_rules_path, 'rt', encoding='utf-8') as config_file:
-            is_rule_block = False
-            for line in config_file:
-                line = line.strip()
-                if line.startswith('#') or line == '':
-                    continue
-                if not is_rule_block and '[default]' in line.lower():
-                    is_rule_block = True
-                    continue
-                if is_rule_block and line.startswith('['):
-                    break
-                if is_rule_block:
-                    yield DefaultUfwRule.fromBitmanConfig(line)
-
-    def _parsed_services(self, category: str) -> Generator[ServiceConfig, None, None]:
-        try:
-            with open(self._services_path, 'rt', encoding='utf-8') as config_file:
-                found_services_start = False
-                for line in config_file:
-                    line = line.strip()
-                    if line.startswith('#'):
-                        continue
-                    if not found_services_start and f'[{category}]' in line.lower():
-                        found_services_start = True
-                        continue
-                    if found_services_start and line.startswith('['):
-                        break
-                    if found_services_start and len(line) > 0:
-                        yield self._parsed_service_config(line)
-        except IOError:
-            yield from []
-
-    def _parsed_service_config(self, line: str) -> ServiceConfig:
-        state, name = line.split(' ', 2)
-        if state != 'enable' and state != 'disable':
-            raise ServiceConfigParseException
-        return ServiceConfig(name, state)
-
-    def _packages(self, file_path: str) -> Generator[str, None, None]:
-        try:
-            with open(file_path, 'rt', encoding='utf-8') as config_file:
-                for line in config_file:
-                    line = line.strip()
-                    if not line.startswith('#') and len(line) > 0:
-                        yield line
-        except IOError:
-            yield from []
-
-
-class ServiceConfigParseException(BaseException):
-    pass
+        return join(self._directory(), 'hooks')
+
+    def config_files(self) -> ConfigFiles:
+        """Returns the paths of all files the config is parsed from"""
+        directory = self._directory()
+        return ConfigFiles(
+            join(directory, 'arch.packages'),
+            join(directory, 'aur.packages'),
+            join(directory, 'services.conf'),
+            join(directory, 'user', 'symlinks'),
+            join(directory, 'ufw.conf')
+        )
+
+    def _directory(self) -> str:
+        """Returns the config directory, or the resolved directory if the config is layered"""
+        if self._resolved_directory is None:
+            if self._layered_config.is_layered():
+                with span('config layers', 'config'):
+                    self._resolved_directory = self._layered_config.resolve()
+            else:
+                self._resolved_directory = self._config_directory
+        return self._resolved_directory
+
+    def _snapshot(self) -> ConfigSnapshot:
+        return self._snapshot_store.load(self._config_directory, self.config_files())
+
+    def _ufw_config(self) -> UfwConfig:
+        ufw = self._snapshot().ufw
+        if ufw is None:
+            raise FileNotFoundError(f'UFW config {self.config_files().ufw} does not exist')
+        return ufw
@@ -2,6 +2,9 @@ from __future__ import annotations
 from typing import Literal
 import re
 
+UFW_STATUS_PATTERN = re.compile(
+    r"(\[\s*(?P<index>\d+)\])\s*(?P<port_proto>[\w\/]+)( \(v6\))?\s+(?P<rule>ALLOW|DENY) (?P<type>IN|OUT)\s+(?P<from_ip>.+)")
+
 
 class DefaultUfwRule:
     rule: Literal['deny', 'allow']
@@ -14,17 +17,19 @@ class DefaultUfwRule:
         self.rule = rule
 
     def __eq__(self, rule: any) -> bool:
-        return rule is not None and rule is DefaultUfwRule and self.rule == rule.rule and self.type == rule.type
+        return isinstance(rule, DefaultUfwRule) and self.rule == rule.rule and self.type == rule.type
 
     def __hash__(self):
         return hash((self.rule, self.type))
 
     @staticmethod
     def fromBitmanConfig(line: str) -> DefaultUfwRule:
-        if ('in' in line):
-            return DefaultUfwRule('in', 'deny' if 'deny' in line else 'allow')
-        if ('out' in line):
-            return DefaultUfwRule('out', 'deny' if 'deny' in line else 'allow')
+        # Compared word by word, 'outgoing' contains 'in'
+        words = line.split()
+        if ('in' in words or 'incoming' in words):
+            return DefaultUfwRule('in', 'deny' if 'deny' in words else 'allow')
+        if ('out' in words or 'outgoing' in words):
+            return DefaultUfwRule('out', 'deny' if 'deny' in words else 'allow')
         raise UfwConfigParseException(f"Invalid default ufw config: {line}")
 
     @staticmethod
@@ -63,8 +68,7 @@ class UfwRule:
         self.port = port
 
     def __eq__(self, rule: any) -> bool:
-        return rule is not None \
-            and rule is UfwRule \
+        return isinstance(rule, UfwRule) \
             and self.rule == rule.rule \
             and self.type == rule.type \
             and self.proto == rule.proto \
@@ -92,8 +96,7 @@ class UfwRule:
 
     @staticmethod
     def fromUfwStatus(line: str) -> UfwRule:
-        pattern = r"(\[\s*(?P<index>\d+)\])\s*(?P<port_proto>[\w\/]+)( \(v6\))?\s+(?P<rule>ALLOW|DENY) (?P<type>IN|OUT)\s+(?P<from_ip>.+)"
-        match = re.match(pattern, line.strip())
+        match = UFW_STATUS_PATTERN.match(line.strip())
         if not match:
             raise UfwStatusParseException(f"Invalid UFW status line: {line}")
 
@@ -111,7 +114,7 @@ class UfwRule:
         if 'Anywhere' in from_ip:
             from_ip = 'any'
 
-        if proto != 'any' and proto != 'tpc' and proto != 'udp':
+        if proto != 'any' and proto != 'tcp' and proto != 'udp':
             raise UfwStatusParseException(f"Invalid UFW status proto: '{proto}'")
         if from_ip == '':
             raise UfwStatusParseException(f"Invalid UFW status from_ip: {from_ip}")
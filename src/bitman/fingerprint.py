@@ -0,0 +1,86 @@
+import glob
+import hashlib
+import os
+from os.path import expanduser, join
+
+from bitman.config.snapshot import ConfigFiles, config_hash
+from bitman.root import in_root, is_alternate_root
+
+PACMAN_LOCAL_DB_PATH = '/var/lib/pacman/local'
+PACMAN_SYNC_DB_PATH = '/var/lib/pacman/sync'
+SYSTEMD_SYSTEM_UNIT_PATH = '/etc/systemd/system'
+SYSTEMD_USER_UNIT_PATH = '~/.config/systemd/user'
+# User units are enabled globally in alternate roots
+SYSTEMD_GLOBAL_USER_UNIT_PATH = '/etc/systemd/user'
+UFW_RULES_FILES = [
+    '/etc/ufw/user.rules',
+    '/etc/ufw/user6.rules',
+    '/etc/default/ufw',
+]
+
+
+def observed_state_fingerprint() -> str:
+    """
+    Returns a cheap fingerprint of the system state bitman syncs, built only from file metadata:
+    the pacman local and sync databases, the unit wants directories and the UFW rules files. It
+    changes whenever packages are (un)installed or their install reason changes, the sync
+    databases are refreshed, units are enabled/disabled or UFW rules are modified.
+    """
+    digest = hashlib.sha256(b'bitman-state-1')
+
+    digest.update(f'pacman\0{local_db_stamp(in_root(PACMAN_LOCAL_DB_PATH))}\0'.encode())
+    # Refreshed sync databases may make installed packages outdated
+    sync_db_path = in_root(PACMAN_SYNC_DB_PATH)
+    digest.update(f'{sync_db_path}\0{_mtime(sync_db_path)}\0'.encode())
+
+    user_unit_path = in_root(SYSTEMD_GLOBAL_USER_UNIT_PATH) if is_alternate_root() \
+        else expanduser(SYSTEMD_USER_UNIT_PATH)
+    for unit_path in (in_root(SYSTEMD_SYSTEM_UNIT_PATH), user_unit_path):
+        for wants_path in [unit_path, *sorted(glob.glob(os.path.join(unit_path, '*.wants')))]:
+            digest.update(f'{wants_path}\0{_mtime(wants_path)}\0'.encode())
+
+    for rules_file in map(in_root, UFW_RULES_FILES):
+        digest.update(f'{rules_file}\0{_mtime(rules_file)}\0'.encode())
+
+    return digest.hexdigest()
+
+
+def sync_fingerprint(config_files: ConfigFiles) -> str:
+    """
+    Returns a fingerprint of everything a sync depends on: the observed system state and the
+    contents of the config files. As long as it doesn't change, a system that was fully synced is
+    still in sync.
+    """
+    digest = hashlib.sha256(b'bitman-sync-1')
+    digest.update(observed_state_fingerprint().encode())
+    digest.update(config_hash(config_files).encode())
+    return digest.hexdigest()
+
+
+def local_db_stamp(local_db_path: str) -> tuple[int, int] | None:
+    """
+    Returns the newest mtime of pacman's local db and of the `desc` files of its packages, with
+    the number of installed packages. (Un)installing packages changes the db directory, while
+    `pacman -D` only rewrites the `desc` files of the changed packages.
+    """
+    try:
+        newest = os.stat(local_db_path).st_mtime_ns
+        packages = 0
+        for entry in os.scandir(local_db_path):
+            if not entry.is_dir():
+                continue
+            packages += 1
+            try:
+                newest = max(newest, os.stat(join(entry.path, 'desc')).st_mtime_ns)
+            except OSError:
+                pass
+    except OSError:
+        return None
+    return newest, packages
+
+
+def _mtime(file_path: str) -> int | None:
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except OSError:
+        return None
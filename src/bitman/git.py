@@ -1,5 +1,9 @@
 
-import subprocess
+import os
+from subprocess import CompletedProcess
+
+from bitman.config import CONFIG_FILE_PATTERNS
+from bitman.runner import command_runner
 
 
 class GitRepository:
@@ -8,73 +12,149 @@ class GitRepository:
 
     def branches(self) -> list[str]:
         """Returns a list of all available branch names"""
-        result = subprocess.run(
-            ['git', 'branch', '--all', '--format="%(refname:short)"'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False,
-            cwd=self._directory
-        )
+        result = self._run('branch', '--all', '--format="%(refname:short)"')
         result.check_returncode()
         return [line.removeprefix('"').removesuffix('"') for line in result.stdout.splitlines()]
 
     def active_branch(self) -> str:
         """Returns the currently active branch"""
-        result = subprocess.run(
-            ['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False,
-            cwd=self._directory
-        )
+        result = self._run('rev-parse', '--abbrev-ref', 'HEAD')
+        result.check_returncode()
+        return result.stdout.strip()
+
+    def head_commit(self) -> str:
+        """Returns the commit hash of HEAD"""
+        result = self._run('rev-parse', 'HEAD')
         result.check_returncode()
-        return result.stdout
+        return result.stdout.strip()
+
+    def remote_commit(self) -> str | None:
+        """Returns the commit the active branch points to on the remote, without fetching it"""
+        result = self._run('ls-remote', '--heads', 'origin', f'refs/heads/{self.active_branch()}')
+        result.check_returncode()
+        for line in result.stdout.splitlines():
+            return line.split('\t', 1)[0]
+        return None
+
+    def has_updates(self) -> bool:
+        """Returns whether the remote has commits which haven't been pulled yet"""
+        return self.remote_commit() != self.head_commit()
+
+    def is_shallow(self) -> bool:
+        """Returns whether the repository was cloned with a limited history"""
+        result = self._run('rev-parse', '--is-shallow-repository')
+        result.check_returncode()
+        return result.stdout.strip() == 'true'
+
+    def changed_files(self, since: str) -> set[str]:
+        """Returns all files changed since the given commit, including uncommitted changes"""
+        result = self._run('diff', '--name-only', '--no-renames', since)
+        result.check_returncode()
+        changed = set(result.stdout.splitlines())
+
+        result = self._run('ls-files', '--others', '--exclude-standard')
+        result.check_returncode()
+        changed.update(result.stdout.splitlines())
+        return changed
 
     def change_branch(self, branch: str) -> None:
         """Changes to the specified branch"""
-        result = subprocess.run(
-            ['git', 'switch', branch],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False,
-            cwd=self._directory
-        )
+        if self._is_single_branch():
+            # Single branch clones only know the branch they were cloned with
+            self._run('remote', 'set-branches', '--add', 'origin', branch).check_returncode()
+            depth = ['--depth', '1'] if self.is_shallow() else []
+            self._run('fetch', *depth, 'origin', branch).check_returncode()
+            self._run('checkout', '-B', branch, '--track', f'origin/{branch}').check_returncode()
+            return
+
+        result = self._run('switch', branch)
         result.check_returncode()
 
-    def pull(self) -> None:
-        """Pulls changes for the active branch"""
-        result = subprocess.run(
-            ['git', 'pull'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False,
-            cwd=self._directory
-        )
+    def pull(self) -> bool:
+        """
+        Pulls changes for the active branch. Returns False without fetching anything if the remote
+        has no new commits.
+        """
+        if not self.has_updates():
+            return False
+
+        if self.is_shallow():
+            branch = self.active_branch()
+            self._run('fetch', '--depth', '1', 'origin', branch).check_returncode()
+            self._run('reset', '--keep', 'FETCH_HEAD').check_returncode()
+            return True
+
+        result = self._run('pull')
         result.check_returncode()
+        return True
+
+    def commit(self, file_paths: list[str], message: str) -> str:
+        """Commits the given files (and nothing else staged) and returns the new commit"""
+        self._run('add', '--', *file_paths).check_returncode()
+        result = self._run('commit', '--quiet', '--message', message, '--', *file_paths)
+        if result.returncode != 0:
+            raise GitException(f'Could not commit {", ".join(file_paths)}: '
+                               f'{(result.stderr or result.stdout).strip()}')
+        return self.head_commit()
+
+    def sparse_checkout(self, patterns: list[str]) -> None:
+        """Limits the working tree to files matching the given patterns"""
+        self._run('sparse-checkout', 'set', '--no-cone', *patterns).check_returncode()
+
+    def _is_single_branch(self) -> bool:
+        result = self._run('config', '--get-all', 'remote.origin.fetch')
+        return all('*' not in refspec for refspec in result.stdout.splitlines())
+
+    def _run(self, *args: str) -> CompletedProcess[str]:
+        return command_runner().run(['git', *args], cwd=self._directory)
 
 
 class Git:
-    def clone(self, repository: str, directory: str) -> GitRepository:
-        """Clones a git repository into the specified directory"""
+    def remote_branches(self, repository: str) -> list[str]:
+        """Returns the branches of a remote repository without cloning it"""
+        result = command_runner().run(['git', 'ls-remote', '--heads', repository])
+        result.check_returncode()
+        return [line.split('\t', 1)[1].removeprefix('refs/heads/')
+                for line in result.stdout.splitlines() if '\t' in line]
+
+    def clone(self,
+              repository: str,
+              directory: str,
+              branch: str | None = None,
+              shallow: bool = True,
+              sparse: bool = True) -> GitRepository:
+        """
+        Clones a git repository into the specified directory. By default only the latest commit
+        of a single branch is fetched and only the files bitman reads are checked out.
+        """
         temp_path = '/tmp/bitman/config'
+        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+
+        arguments = ['git', 'clone', '--no-checkout']
+        if shallow:
+            arguments += ['--depth', '1', '--single-branch']
+        if sparse:
+            arguments += ['--filter=blob:none']
+        if branch is not None:
+            arguments += ['--branch', branch]
+
+        # We clone to a temporary path first, as git won't ask for SSH when running as root
+        result = command_runner().run([*arguments, repository, temp_path], interactive=True)
+        result.check_returncode()
 
-        # We copy to a temporary path first, as git won't ask for SSH when using sudo
-        result = subprocess.run(
-            ['git', 'clone', repository, temp_path],
-            encoding='utf-8',
-            check=False
-        )
+        temp_repository = GitRepository(temp_path)
+        if sparse:
+            temp_repository.sparse_checkout(CONFIG_FILE_PATTERNS)
+        result = command_runner().run(['git', 'checkout'], cwd=temp_path, interactive=True)
         result.check_returncode()
 
-        result = subprocess.run(
-            ['sudo', 'mv', temp_path, directory],
-            encoding='utf-8',
-            check=False
-        )
+        # Only the system config directory needs root, e.g. a config for an image doesn't
+        privileged = not os.access(os.path.dirname(os.path.abspath(directory)), os.W_OK)
+        result = command_runner().run(['mv', temp_path, directory], privileged=privileged)
         result.check_returncode()
 
         return GitRepository(directory)
+
+
+class GitException(BaseException):
+    pass
@@ -0,0 +1,112 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os.path import exists, join
+from subprocess import CompletedProcess
+
+from bitman.git import Git
+from bitman.runner import LiveCommandRunner, command_runner, set_command_runner
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'bitman', 'GIT_AUTHOR_EMAIL': 'bitman@localhost',
+    'GIT_COMMITTER_NAME': 'bitman', 'GIT_COMMITTER_EMAIL': 'bitman@localhost',
+}
+
+
+class UnprivilegedCommandRunner(LiveCommandRunner):
+    """Runs privileged commands (moving the clone into place) as the current user"""
+
+    def __init__(self):
+        self.commands: list[list[str]] = []
+
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        self.commands.append(argv)
+        return super().run(argv, input, cwd, False, False)
+
+
+@unittest.skipIf(shutil.which('git') is None, 'git is not installed')
+class GitTest(unittest.TestCase):
+    def setUp(self):
+        if exists('/tmp/bitman/config'):
+            self.skipTest('/tmp/bitman/config is in use')
+        self._directory = tempfile.mkdtemp()
+        self._remote = join(self._directory, 'remote.git')
+        self._work = join(self._directory, 'work')
+        self._git('init', '--quiet', '--bare', '--initial-branch', 'main', self._remote)
+        # Allows partial clones of the fixture
+        self._git('config', 'uploadpack.allowFilter', 'true', cwd=self._remote)
+        self._git('clone', '--quiet', self._remote, self._work)
+        self._write('arch.packages', 'vim\n')
+        self._write(join('hooks', 'vim'), '#!/bin/sh\n')
+        self._write('README.md', '# Config\n')
+        self._write(join('docs', 'setup.md'), 'Setup\n')
+        self._push('Initial config')
+
+        self._previous_runner = command_runner()
+        self._runner = UnprivilegedCommandRunner()
+        set_command_runner(self._runner)
+
+    def tearDown(self):
+        set_command_runner(self._previous_runner)
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_clone_checks_out_config_files_only(self):
+        clone = join(self._directory, 'clone')
+
+        repository = Git().clone(f'file://{self._remote}', clone)
+
+        self.assertTrue(exists(join(clone, 'arch.packages')))
+        self.assertTrue(exists(join(clone, 'hooks', 'vim')))
+        self.assertFalse(exists(join(clone, 'README.md')))
+        self.assertFalse(exists(join(clone, 'docs')))
+        self.assertTrue(repository.is_shallow())
+        self.assertEqual(repository.active_branch(), 'main')
+
+    def test_pull_without_changes_fetches_nothing(self):
+        repository = Git().clone(f'file://{self._remote}', join(self._directory, 'clone'))
+        self._runner.commands.clear()
+
+        self.assertFalse(repository.pull())
+        self.assertNotIn('fetch', [argv[1] for argv in self._runner.commands])
+        self.assertNotIn('pull', [argv[1] for argv in self._runner.commands])
+
+    def test_pull_fetches_new_commits(self):
+        clone = join(self._directory, 'clone')
+        repository = Git().clone(f'file://{self._remote}', clone)
+        self._write('arch.packages', 'vim\nhtop\n')
+        self._write('README.md', '# Updated config\n')
+        commit = self._push('Add htop')
+
+        self.assertTrue(repository.pull())
+        self.assertEqual(repository.head_commit(), commit)
+        self.assertFalse(repository.has_updates())
+        with open(join(clone, 'arch.packages'), 'rt', encoding='utf-8') as packages_file:
+            self.assertEqual(packages_file.read(), 'vim\nhtop\n')
+        self.assertFalse(exists(join(clone, 'README.md')))
+
+    def _write(self, file_path: str, content: str) -> None:
+        file_path = join(self._work, file_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wt', encoding='utf-8') as file:
+            file.write(content)
+
+    def _push(self, message: str) -> str:
+        self._git('add', '--all', cwd=self._work)
+        self._git('commit', '--quiet', '--message', message, cwd=self._work)
+        self._git('push', '--quiet', 'origin', 'HEAD:main', cwd=self._work)
+        return self._git('rev-parse', 'HEAD', cwd=self._work).strip()
+
+    def _git(self, *args: str, cwd: str | None = None) -> str:
+        return subprocess.run(['git', *args], cwd=cwd, env={**os.environ, **GIT_ENV},
+                              check=True, capture_output=True, encoding='utf-8').stdout
+
+
+if __name__ == '__main__':
+    unittest.main()
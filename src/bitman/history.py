@@ -0,0 +1,117 @@
+import json
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from os.path import dirname, join
+from typing import Generator, NamedTuple
+
+HISTORY_VERSION = 1
+HISTORY_FILE_NAME = 'history.json'
+# Durations of this many recent runs are kept per step
+HISTORY_RUNS = 20
+# A step taking this much longer than its median is reported as slower than usual
+SLOWER_FACTOR = 1.5
+SLOWER_MIN_SECONDS = 10.0
+
+
+class HistoryEntry(NamedTuple):
+    key: str
+    runs: int
+    median: float
+    last: float
+    # Across all recorded runs, not only the kept ones
+    total: float
+
+
+class DurationHistory:
+    """
+    Durations of sync phases, packages, hooks and units across runs, used to estimate how long a
+    step will take. A step installing several packages in one transaction is recorded as an even
+    share per package, so later steps with other package sets can still be estimated.
+    """
+
+    def __init__(self, directory: str):
+        self._path = join(directory, HISTORY_FILE_NAME)
+        self._steps: dict[str, dict] | None = None
+        self._changed = False
+
+    def estimate(self, keys: tuple[str, ...]) -> float | None:
+        """
+        Returns how long a step covering the given keys usually takes. Unknown keys are assumed to
+        take as long as the known ones on average, None is returned if no key is known.
+        """
+        medians = [self._median(key) for key in keys]
+        known = [median for median in medians if median is not None]
+        if len(known) == 0:
+            return None
+        return sum(known) + (len(keys) - len(known)) * statistics.fmean(known)
+
+    def record(self, keys: tuple[str, ...], seconds: float) -> None:
+        """Records the duration of a step, split evenly across its keys"""
+        if len(keys) == 0:
+            return
+        share = seconds / len(keys)
+        steps = self._data()
+        for key in keys:
+            step = steps.setdefault(key, {'durations': [], 'runs': 0, 'total': 0.0})
+            step['durations'] = [*step['durations'], share][-HISTORY_RUNS:]
+            step['runs'] += 1
+            step['total'] += share
+        self._changed = True
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        """Records how long the enclosed block took as the phase `name`, unless it raised"""
+        start = time.perf_counter()
+        yield
+        self.record((f'phase:{name}',), time.perf_counter() - start)
+
+    def entries(self) -> list[HistoryEntry]:
+        """Returns all recorded steps, the ones which cost the most time in total first"""
+        entries = [HistoryEntry(key, step['runs'], statistics.median(step['durations']),
+                                step['durations'][-1], step['total'])
+                   for key, step in self._data().items() if len(step['durations']) > 0]
+        return sorted(entries, key=lambda entry: entry.total, reverse=True)
+
+    def save(self) -> None:
+        """Writes recorded durations, nothing is written if none were recorded"""
+        if not self._changed:
+            return
+        os.makedirs(dirname(self._path), exist_ok=True)
+        temp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wt', encoding='utf-8') as history_file:
+            json.dump({'version': HISTORY_VERSION, 'steps': self._steps}, history_file)
+        os.replace(temp_path, self._path)
+        self._changed = False
+
+    def _median(self, key: str) -> float | None:
+        step = self._data().get(key)
+        if step is None or len(step['durations']) == 0:
+            return None
+        return statistics.median(step['durations'])
+
+    def _data(self) -> dict[str, dict]:
+        if self._steps is None:
+            try:
+                with open(self._path, 'rt', encoding='utf-8') as history_file:
+                    data = json.load(history_file)
+                self._steps = data['steps'] if data.get('version') == HISTORY_VERSION else {}
+            except (OSError, ValueError, KeyError):
+                self._steps = {}
+        return self._steps
+
+
+def is_slower_than_usual(elapsed: float, estimate: float) -> bool:
+    """Returns whether a step took noticeably longer than it usually does"""
+    return elapsed > estimate * SLOWER_FACTOR and elapsed - estimate >= SLOWER_MIN_SECONDS
+
+
+def format_duration(seconds: float) -> str:
+    """Formats a duration for humans, e.g. `45s` or `3m 20s`"""
+    seconds = round(seconds)
+    if seconds < 60:
+        return f'{seconds}s'
+    if seconds < 3600:
+        return f'{seconds // 60}m {seconds % 60:02d}s'
+    return f'{seconds // 3600}h {seconds % 3600 // 60:02d}m'
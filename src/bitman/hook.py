@@ -1,8 +1,10 @@
 from os import path
-import subprocess
 from subprocess import CompletedProcess
 from typing import Literal
 
+from bitman.runner import command_runner
+from bitman.trace import span
+
 
 class Hook:
     def __init__(self, hook_file_path: str):
@@ -17,17 +19,12 @@ class Hook:
         result = self._run('installed')
         return result.stdout.startswith('yes')
 
-    def install(self) -> None:
-        """Installs the hook"""
-        result = self._run('install')
-
-        for line in result.stdout.splitlines():
-            print(f'\t{line}')
-
-        for line in result.stderr.splitlines():
-            print(f'\t{line}')
-
-        result.check_returncode()
+    def install(self) -> CompletedProcess[str]:
+        """
+        Installs the hook. Returns its result without checking it, so the caller can print its
+        output once it finished (hooks run concurrently to other tasks).
+        """
+        return self._run('install')
 
     def remove(self) -> None:
         """Reverts install hook"""
@@ -35,11 +32,6 @@ class Hook:
         result.check_returncode()
 
     def _run(self, action: Literal['install', 'remove', 'installed']) -> CompletedProcess[str]:
-        result = subprocess.run(
-            [self._file_path, action],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        return result
+        with span(f'hook {path.basename(self._file_path)} {action}', 'hook',
+                  file=self._file_path):
+            return command_runner().run([self._file_path, action])
@@ -0,0 +1,67 @@
+from __future__ import annotations
+import sys
+from functools import partial
+from os.path import abspath, dirname
+from typing import TYPE_CHECKING
+
+from bitman.config.system_config import SystemConfig
+from bitman.package.pacman import Pacman
+from bitman.runner import command_runner
+from bitman.scheduler import Scheduler, Task
+
+if TYPE_CHECKING:
+    from rich.console import Console
+
+# Lines of output shown for a failed image
+FAILURE_OUTPUT_LINES = 20
+
+
+class ImageBuilder:
+    """
+    Provisions several alternate roots (e.g. VM or container images) from one config at the same
+    time. All packages are downloaded once into the package cache of the host, which every root
+    then installs from. Every root is provisioned by its own `bitman --root` process.
+    """
+
+    def __init__(self, config_directory: str, console: Console, jobs: int = 4):
+        self._config_directory = abspath(config_directory)
+        self._console = console
+        self._jobs = jobs
+
+    def build(self, roots: list[str]) -> None:
+        roots = [abspath(root) for root in roots]
+        tasks = [Task('download', 'images', 'Downloading packages',
+                      partial(self._download, roots[0]))]
+        for root in roots:
+            tasks.append(Task(f'image:{root}', 'images', f'Provisioning {root}',
+                              partial(self._provision, root), ('download',)))
+
+        # Authenticate once before the progress display starts, sudo remembers it for the roots
+        command_runner().authenticate()
+        Scheduler(self._console, max_workers=self._jobs).run(tasks)
+        self._console.print(f'Provisioned {len(roots)} roots', style='green')
+
+    def _download(self, root: str) -> None:
+        """Fills the shared package cache, so the roots don't download the same packages"""
+        packages = list(SystemConfig(self._config_directory).arch_packages())
+        if len(packages) == 0:
+            return
+        # The sync databases of the first root are used, the host's databases stay untouched. The
+        # root is passed explicitly, as the process wide root is still the host's.
+        Pacman(root=root).download_packages(packages)
+
+    def _provision(self, root: str) -> None:
+        # `python -m bitman` is started from the directory containing the bitman package
+        result = command_runner().run(
+            [sys.executable, '-m', 'bitman', '--non-interactive', '--root', root,
+             '--config', self._config_directory, 'sync', '--force'],
+            cwd=dirname(dirname(abspath(__file__)))
+        )
+        if result.returncode != 0:
+            output = (result.stdout + result.stderr).strip().splitlines()
+            raise ImageBuildException(f'Provisioning {root} failed:\n'
+                                      + '\n'.join(output[-FAILURE_OUTPUT_LINES:]))
+
+
+class ImageBuildException(BaseException):
+    pass
@@ -0,0 +1,113 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+from os.path import isdir, join
+from typing import NamedTuple
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# Every change of a file's content, a directory's entries or a symlink in a watched directory
+CHANGE_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyEvent(NamedTuple):
+    # The watched directory, empty for a queue overflow
+    directory: str
+    # The file inside the watched directory, empty for events of the directory itself
+    name: str
+    mask: int
+
+    @property
+    def path(self) -> str:
+        return join(self.directory, self.name) if self.name else self.directory
+
+
+class Inotify:
+    """Watches directories for changes using the inotify API of the Linux kernel"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise _os_error()
+        self._directories: dict[int, str] = {}
+        self._recursive: set[int] = set()
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def add_watch(self, directory: str, recursive: bool = False) -> bool:
+        """
+        Watches a directory (and with `recursive` all directories below it, including ones created
+        later on). Returns False if the directory doesn't exist.
+        """
+        descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), CHANGE_MASK)
+        if descriptor < 0:
+            error = _os_error()
+            if isinstance(error, (FileNotFoundError, NotADirectoryError)):
+                return False
+            raise error
+
+        self._directories[descriptor] = directory
+        if recursive:
+            self._recursive.add(descriptor)
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    self.add_watch(entry.path, recursive=True)
+        return True
+
+    def read_events(self) -> list[InotifyEvent]:
+        """Returns all pending events without blocking"""
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    events.append(InotifyEvent('', '', mask))
+                    continue
+                if mask & IN_IGNORED:
+                    self._directories.pop(descriptor, None)
+                    self._recursive.discard(descriptor)
+                    continue
+
+                directory = self._directories.get(descriptor)
+                if directory is None:
+                    continue
+                event = InotifyEvent(directory, name, mask)
+                events.append(event)
+                if descriptor in self._recursive and mask & IN_ISDIR \
+                        and mask & (IN_CREATE | IN_MOVED_TO) and isdir(event.path):
+                    self.add_watch(event.path, recursive=True)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def _os_error() -> OSError:
+    error_number = ctypes.get_errno()
+    return OSError(error_number, os.strerror(error_number))
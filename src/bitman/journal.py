@@ -0,0 +1,103 @@
+from __future__ import annotations
+import json
+import os
+import time
+from os.path import dirname, join
+from typing import NamedTuple
+
+from bitman.plan import SyncPlan
+from bitman.state import Subsystem
+
+JOURNAL_VERSION = 1
+JOURNAL_FILE_NAME = 'journal.json'
+
+
+class JournalEntry(NamedTuple):
+    """A sync that was started but didn't finish"""
+    started: float
+    # The changes of the sync, its fingerprint is not used
+    plan: SyncPlan
+    firewall: bool
+    # Subsystems whose sync fingerprint is recorded once the sync finished
+    fingerprint_subsystems: list[Subsystem]
+    tasks: list[str]
+    completed: list[str]
+
+    def pending(self) -> list[str]:
+        """Returns the tasks that didn't complete"""
+        completed = set(self.completed)
+        return [task for task in self.tasks if task not in completed]
+
+
+class SyncJournal:
+    """
+    Records the planned changes of a running sync and which of its tasks completed, so a sync
+    that died halfway through can be resumed without repeating the completed tasks. The journal is
+    removed once a sync finished successfully.
+    """
+
+    def __init__(self, directory: str):
+        self._path = join(directory, JOURNAL_FILE_NAME)
+        self._entry: JournalEntry | None = None
+
+    def load(self) -> JournalEntry | None:
+        """Returns the unfinished sync, if there is one"""
+        try:
+            with open(self._path, 'rt', encoding='utf-8') as journal_file:
+                data = json.load(journal_file)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != JOURNAL_VERSION:
+            return None
+        return JournalEntry(data['started'], SyncPlan.from_json(data['plan']), data['firewall'],
+                            data['fingerprint_subsystems'], data['tasks'], data['completed'])
+
+    def begin(self,
+              plan: SyncPlan,
+              firewall: bool,
+              fingerprint_subsystems: list[Subsystem],
+              tasks: list[str],
+              completed: list[str] | None = None) -> None:
+        """Records the tasks of a sync before the first one runs"""
+        self._entry = JournalEntry(time.time(), plan, firewall, fingerprint_subsystems, tasks,
+                                   [] if completed is None else completed)
+        self._save()
+
+    def complete(self, task: str) -> None:
+        """Records that a task completed"""
+        if self._entry is None:
+            return
+        self._entry.completed.append(task)
+        self._save()
+
+    def finish(self) -> None:
+        """Removes the journal after the sync finished successfully"""
+        self._entry = None
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+    def _save(self) -> None:
+        entry = self._entry
+        data = {
+            'version': JOURNAL_VERSION,
+            'started': entry.started,
+            'plan': entry.plan.to_json(),
+            'firewall': entry.firewall,
+            'fingerprint_subsystems': entry.fingerprint_subsystems,
+            'tasks': entry.tasks,
+            'completed': entry.completed,
+        }
+        os.makedirs(dirname(self._path), exist_ok=True)
+        temp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wt', encoding='utf-8') as journal_file:
+            json.dump(data, journal_file, indent=2)
+            # The journal has to survive a crash right after a task completed
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self._path)
+
+
+class SyncJournalException(BaseException):
+    pass
@@ -0,0 +1,157 @@
+from __future__ import annotations
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from os.path import dirname, join
+from typing import IO, Callable, Generator, NamedTuple
+
+from bitman.config import SYSTEM_CONFIG_PATH
+from bitman.state import Subsystem
+
+LOCK_FILE_NAME = 'sync.lock'
+REQUESTS_FILE_NAME = 'sync.requests'
+
+
+class SyncRequest(NamedTuple):
+    """
+    A requested sync, requests arriving during a run are merged into one if they sync the same
+    config with the same interactivity
+    """
+    subsystems: list[Subsystem]
+    pull: bool
+    full: bool
+    force: bool
+    upgrade: bool = False
+    config_directory: str = SYSTEM_CONFIG_PATH
+    interactive: bool = True
+
+    def mergeable(self, other: SyncRequest) -> bool:
+        return self.config_directory == other.config_directory \
+            and self.interactive == other.interactive
+
+    def merge(self, other: SyncRequest) -> SyncRequest:
+        subsystems = [subsystem for subsystem in ('packages', 'services', 'ufw')
+                      if subsystem in self.subsystems or subsystem in other.subsystems]
+        return SyncRequest(subsystems, self.pull or other.pull, self.full or other.full,
+                           self.force or other.force, self.upgrade or other.upgrade,
+                           self.config_directory, self.interactive)
+
+
+class RunLock:
+    """
+    Makes sure only one sync runs at a time. A sync requested while another one runs doesn't wait
+    for it: the request is recorded and all requests arriving during a run are merged into a single
+    follow-up run (per config and interactivity) of the process holding the lock.
+    """
+
+    def __init__(self, directory: str):
+        self._lock_path = join(directory, LOCK_FILE_NAME)
+        self._requests_path = join(directory, REQUESTS_FILE_NAME)
+        self._lock_file: IO | None = None
+
+    def run_coalesced(self, request: SyncRequest, run: Callable[[SyncRequest], None]) -> bool:
+        """
+        Runs the request and every request arriving in the meantime. Returns False if another
+        process is running, the request is then left to its follow-up run.
+        """
+        self._add_request(request)
+        if not self._try_lock():
+            return False
+
+        while True:
+            try:
+                request = self._take_request()
+                while request is not None:
+                    run(request)
+                    request = self._take_request()
+            finally:
+                self._unlock()
+            # A request recorded after the last check but before the lock was released is run by
+            # whoever gets the lock next, this process if nobody else does
+            if not self._has_requests() or not self._try_lock():
+                return True
+
+    @contextmanager
+    def hold(self, on_wait: Callable[[], None] | None = None) -> Generator[None, None, None]:
+        """Waits until no other sync runs and holds the lock while the block runs"""
+        if not self._try_lock():
+            if on_wait is not None:
+                on_wait()
+            self._lock(blocking=True)
+        try:
+            yield
+        finally:
+            self._unlock()
+
+    def _try_lock(self) -> bool:
+        return self._lock(blocking=False)
+
+    def _lock(self, blocking: bool) -> bool:
+        os.makedirs(dirname(self._lock_path), exist_ok=True)
+        # The file stays open (and locked) until the lock is released
+        lock_file = open(  # pylint: disable=consider-using-with
+            self._lock_path, 'a', encoding='utf-8')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _unlock(self) -> None:
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _add_request(self, request: SyncRequest) -> None:
+        with self._requests() as requests_file:
+            pending = _read_requests(requests_file)
+            for index, pending_request in enumerate(pending):
+                if pending_request.mergeable(request):
+                    pending[index] = pending_request.merge(request)
+                    break
+            else:
+                pending.append(request)
+            _write_requests(requests_file, pending)
+
+    def _take_request(self) -> SyncRequest | None:
+        """Returns the oldest pending (merged) request and removes it"""
+        if not self._has_requests():
+            return None
+        with self._requests() as requests_file:
+            pending = _read_requests(requests_file)
+            _write_requests(requests_file, pending[1:])
+        return pending[0] if len(pending) > 0 else None
+
+    def _has_requests(self) -> bool:
+        try:
+            return os.path.getsize(self._requests_path) > 0
+        except OSError:
+            return False
+
+    @contextmanager
+    def _requests(self) -> Generator[IO, None, None]:
+        """Opens the requests file, locked against concurrent updates"""
+        os.makedirs(dirname(self._requests_path), exist_ok=True)
+        with open(self._requests_path, 'a+', encoding='utf-8') as requests_file:
+            fcntl.flock(requests_file, fcntl.LOCK_EX)
+            requests_file.seek(0)
+            yield requests_file
+
+
+def _read_requests(requests_file: IO) -> list[SyncRequest]:
+    try:
+        return [SyncRequest(**request) for request in json.load(requests_file)]
+    except (ValueError, TypeError):
+        return []
+
+
+def _write_requests(requests_file: IO, requests: list[SyncRequest]) -> None:
+    # The file is emptied instead of removed, a process waiting for it would write into the
+    # removed file otherwise
+    requests_file.truncate(0)
+    if len(requests) > 0:
+        json.dump([request._asdict() for request in requests], requests_file)
@@ -0,0 +1,40 @@
+import shutil
+import tempfile
+import unittest
+
+from bitman.lock import RunLock, SyncRequest
+
+
+class RunLockTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_requests_arriving_during_a_run_are_merged_per_config(self):
+        other_config = SyncRequest(['ufw'], False, False, False, config_directory='/srv/config')
+        non_interactive = SyncRequest(['services'], False, False, False, interactive=False)
+        runs = []
+
+        def run(request: SyncRequest) -> None:
+            if len(runs) == 0:
+                # Other processes record their requests while this one runs
+                for pending in (SyncRequest(['packages'], True, False, False), other_config,
+                                SyncRequest(['services'], False, True, False), non_interactive):
+                    self.assertFalse(RunLock(self._directory).run_coalesced(pending, runs.append))
+            runs.append(request)
+
+        self.assertTrue(RunLock(self._directory).run_coalesced(
+            SyncRequest(['ufw'], False, False, False), run))
+
+        self.assertEqual(runs, [
+            SyncRequest(['ufw'], False, False, False),
+            SyncRequest(['packages', 'services'], True, True, False),
+            other_config,
+            non_interactive,
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+
+SOURCE_PATH = dirname(dirname(abspath(__file__)))
+
+
+class StartupImportsTest(unittest.TestCase):
+    """Commands which don't print anything rich must not pay for importing it"""
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_help_does_not_import_rich(self):
+        for arguments in (['--help'], ['sync', '--help']):
+            with self.subTest(arguments=arguments):
+                self.assertNotIn('rich', self._imported_packages(arguments))
+
+    def test_json_status_does_not_import_rich(self):
+        root = join(self._directory, 'root')
+        config = join(self._directory, 'config')
+        os.makedirs(root)
+        os.makedirs(config)
+        # The package queries of an empty root, everything else is read from files
+        fixture = join(self._directory, 'status.fixture')
+        with open(fixture, 'wt', encoding='utf-8') as fixture_file:
+            for query in ('-Q', '-Qe', '-Qm'):
+                fixture_file.write(json.dumps({
+                    'argv': ['pacman', query, '--root', root], 'input': None, 'cwd': None,
+                    'privileged': False, 'returncode': 0, 'stdout': '', 'stderr': '',
+                    'duration': 0}) + '\n')
+
+        imported = self._imported_packages(['--replay', fixture, '--root', root, '--config', config,
+                                            'sync', '--status', '--format', 'json'])
+
+        self.assertIn('bitman', imported)
+        self.assertNotIn('rich', imported)
+
+    def _imported_packages(self, arguments: list[str]) -> set[str]:
+        """Runs bitman with `python -X importtime` and returns the top level packages it imported"""
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-m', 'bitman', *arguments],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            check=False,
+            env={**os.environ, 'PYTHONPATH': SOURCE_PATH, 'HOME': self._directory,
+                 'XDG_CACHE_HOME': join(self._directory, 'cache'),
+                 'XDG_STATE_HOME': join(self._directory, 'state')}
+        )
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        return {line.rsplit('|', 1)[1].strip().split('.', 1)[0]
+                for line in result.stderr.splitlines() if line.startswith('import time:')}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import time
+
+from bitman.status import StatusReport
+
+
+def render_textfile(report: StatusReport, timestamp: float | None = None) -> str:
+    """Renders a status report in the Prometheus text format read by node_exporter"""
+    lines = [
+        '# HELP bitman_drift Differences between the system and the bitman config',
+        '# TYPE bitman_drift gauge',
+    ]
+    for (subsystem, kind), count in report.drift().items():
+        lines.append(f'bitman_drift{{subsystem="{subsystem}",kind="{kind}"}} {count}')
+
+    if report.firewall_backend is not None:
+        lines += [
+            '# HELP bitman_firewall_status_available Whether the firewall state could be queried',
+            '# TYPE bitman_firewall_status_available gauge',
+            f'bitman_firewall_status_available{{backend="{report.firewall_backend}"}} '
+            f'{int(report.firewall_available())}',
+        ]
+
+    lines += [
+        '# HELP bitman_phase_duration_seconds Time it took to compute the status of a subsystem',
+        '# TYPE bitman_phase_duration_seconds gauge',
+    ]
+    for phase, duration in report.durations.items():
+        lines.append(f'bitman_phase_duration_seconds{{phase="{phase}"}} {duration:.6f}')
+
+    lines += [
+        '# HELP bitman_status_timestamp_seconds Time the status was computed',
+        '# TYPE bitman_status_timestamp_seconds gauge',
+        f'bitman_status_timestamp_seconds {time.time() if timestamp is None else timestamp:.3f}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(file_path: str, report: StatusReport) -> None:
+    """
+    Writes the metrics of a status report atomically, so node_exporter never reads a partially
+    written file
+    """
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wt', encoding='utf-8') as textfile:
+        textfile.write(render_textfile(report))
+    os.replace(temp_path, file_path)
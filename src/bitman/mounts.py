@@ -0,0 +1,68 @@
+import re
+from os.path import normpath
+from typing import NamedTuple
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+FSTAB_PATH = '/etc/fstab'
+
+_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+class Mount(NamedTuple):
+    source: str
+    mount_point: str
+    fs_type: str
+
+
+class FstabEntry(NamedTuple):
+    source: str
+    mount_point: str
+    fs_type: str
+    options: str
+
+
+def mounts(mountinfo_path: str = MOUNTINFO_PATH) -> dict[str, Mount]:
+    """Returns the mounts of bitman's mount namespace by mount point, the last one wins"""
+    mounted: dict[str, Mount] = {}
+    with open(mountinfo_path, 'rt', encoding='utf-8') as mountinfo_file:
+        for line in mountinfo_file:
+            # ID PARENT MAJOR:MINOR ROOT MOUNT_POINT OPTIONS [OPTIONAL...] - TYPE SOURCE OPTIONS
+            fields, separator, filesystem = line.rstrip('\n').partition(' - ')
+            fields = fields.split(' ')
+            filesystem = filesystem.split(' ')
+            if separator == '' or len(fields) < 5 or len(filesystem) < 2:
+                continue
+            mount_point = _unescape(fields[4])
+            mounted[mount_point] = Mount(_unescape(filesystem[1]), mount_point, filesystem[0])
+    return mounted
+
+
+def fstab_entries(fstab_path: str = FSTAB_PATH) -> list[FstabEntry]:
+    """Returns the entries of an fstab file"""
+    entries = []
+    try:
+        with open(fstab_path, 'rt', encoding='utf-8') as fstab_file:
+            for line in fstab_file:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) < 3:
+                    continue
+                entries.append(FstabEntry(_unescape(fields[0]), normpath(_unescape(fields[1])),
+                                          fields[2], fields[3] if len(fields) > 3 else 'defaults'))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def fstab_line(entry: FstabEntry) -> str:
+    """Formats an entry as fstab line"""
+    return '\t'.join([_escape(entry.source), _escape(entry.mount_point), entry.fs_type,
+                      entry.options, '0', '2']) + '\n'
+
+
+def _unescape(field: str) -> str:
+    """Mount points with spaces (and other whitespace) are octal escaped, e.g. `\\040`"""
+    return _ESCAPE.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+def _escape(field: str) -> str:
+    return ''.join(f'\\{ord(char):03o}' if char in ' \t\n\\' else char for char in field)
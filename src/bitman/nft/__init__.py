@@ -0,0 +1,27 @@
+import json
+
+from bitman.runner import command_runner
+
+
+class Nft:
+    def ruleset(self) -> dict:
+        """Returns the currently loaded nftables ruleset as parsed JSON"""
+        result = command_runner().run(['nft', '-j', 'list', 'ruleset'], privileged=True)
+        result.check_returncode()
+        return json.loads(result.stdout)
+
+    def check(self, ruleset: str) -> None:
+        """Validates a ruleset without loading it (nft -c), which needs netlink access as well"""
+        result = command_runner().run(['nft', '-c', '-f', '-'], input=ruleset, privileged=True)
+        if result.returncode != 0:
+            raise NftRulesetException(result.stderr.strip())
+
+    def load(self, ruleset: str) -> None:
+        """Loads a ruleset in a single atomic transaction (nft -f)"""
+        result = command_runner().run(['nft', '-f', '-'], input=ruleset, privileged=True)
+        if result.returncode != 0:
+            raise NftRulesetException(result.stderr.strip())
+
+
+class NftRulesetException(BaseException):
+    pass
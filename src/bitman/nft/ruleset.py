@@ -0,0 +1,332 @@
+from __future__ import annotations
+import ipaddress
+import socket
+from typing import Iterable, NamedTuple
+
+from bitman.config.ufw_rule import DefaultUfwRule, UfwRule
+
+TABLE_FAMILY = 'inet'
+TABLE_NAME = 'bitman'
+
+RULES = ('deny', 'allow')
+PROTOCOLS = ('tcp', 'udp')
+VERDICTS = {'allow': 'accept', 'deny': 'drop'}
+POLICIES = {'allow': 'accept', 'deny': 'drop'}
+
+# Elements of every set are kept as normalized strings, so the compiled ruleset and the
+# ruleset reported by `nft -j list ruleset` can be compared directly
+SET_TYPES = {
+    'ports': 'inet_service',
+    'v4': 'ipv4_addr . inet_service',
+    'v6': 'ipv6_addr . inet_service',
+}
+
+IPNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+BASE_INPUT_RULES = (
+    'ct state established,related accept',
+    'ct state invalid drop',
+    'iif "lo" accept',
+    'meta l4proto { icmp, ipv6-icmp } accept',
+)
+# Replies to allowed incoming connections must pass a denying output policy
+BASE_OUTPUT_RULES = (
+    'ct state established,related accept',
+    'oif "lo" accept',
+)
+
+
+class NftSetDiff(NamedTuple):
+    name: str
+    added: list[str]
+    removed: list[str]
+
+
+class NftRulesetDiff(NamedTuple):
+    table_missing: bool
+    policies: dict[str, str]
+    sets: list[NftSetDiff]
+    rules_changed: bool
+
+    def is_empty(self) -> bool:
+        """Returns whether the loaded ruleset already matches the compiled one"""
+        return not self.table_missing \
+            and len(self.policies) == 0 \
+            and len(self.sets) == 0 \
+            and not self.rules_changed
+
+
+class NftRuleset:
+    """
+    The firewall configuration compiled into a single nftables table. Every rule of `ufw.conf`
+    becomes an element of one of twelve named sets (deny/allow × tcp/udp × any/IPv4/IPv6), so the
+    chain itself has a constant number of rules and lookups are set matches.
+
+    Unlike UFW, where the first matching rule wins, all deny rules are matched before all allow
+    rules: an allow rule doesn't punch a hole into a deny rule listed after it. Overlapping and
+    adjacent elements of a set are merged, like the kernel merges them.
+    """
+
+    def __init__(self,
+                 policies: dict[str, str],
+                 sets: dict[str, frozenset[str]],
+                 rule_counts: dict[str, int] | None = None):
+        self.policies = policies
+        self.sets = sets
+        # The number of rules per chain of a loaded ruleset
+        self.rule_counts = rule_counts
+
+    @staticmethod
+    def set_name(rule: str, proto: str, kind: str) -> str:
+        return f'{rule}_{proto}_{kind}'
+
+    @staticmethod
+    def compile(default_rules: Iterable[DefaultUfwRule], rules: Iterable[UfwRule]) -> NftRuleset:
+        """Compiles the `[default]` and `[rules]` sections of ufw.conf"""
+        policies = {'input': 'drop', 'output': 'accept'}
+        for default_rule in default_rules:
+            chain = 'input' if default_rule.type == 'in' else 'output'
+            policies[chain] = POLICIES[default_rule.rule]
+
+        sets: dict[str, set[str]] = {
+            NftRuleset.set_name(rule, proto, kind): set()
+            for rule in RULES for proto in PROTOCOLS for kind in SET_TYPES
+        }
+        for rule in rules:
+            protocols = PROTOCOLS if rule.proto == 'any' else (rule.proto,)
+            ports = _normalized_ports(str(rule.port))
+            for proto in protocols:
+                if rule.from_ip == 'any':
+                    sets[NftRuleset.set_name(rule.rule, proto, 'ports')].update(ports)
+                    continue
+                address, kind = _normalized_address(rule.from_ip)
+                sets[NftRuleset.set_name(rule.rule, proto, kind)].update(
+                    f'{address} . {port}' for port in ports)
+
+        return NftRuleset(policies,
+                          {name: _merged(name, elements) for name, elements in sets.items()})
+
+    @staticmethod
+    def from_json(ruleset: dict) -> NftRuleset | None:
+        """Reads the bitman table from the output of `nft -j list ruleset`"""
+        policies: dict[str, str] = {}
+        sets: dict[str, frozenset[str]] = {}
+        rule_counts: dict[str, int] = {}
+        found = False
+        for entry in ruleset.get('nftables', []):
+            for kind, value in entry.items():
+                if not isinstance(value, dict) \
+                        or value.get('family') != TABLE_FAMILY \
+                        or value.get('table', value.get('name')) != TABLE_NAME:
+                    continue
+                if kind == 'table':
+                    found = True
+                elif kind == 'chain' and 'policy' in value:
+                    policies[value['name']] = value['policy']
+                elif kind == 'set':
+                    sets[value['name']] = _merged(value['name'], [
+                        _normalized_json_element(element) for element in value.get('elem', [])])
+                elif kind == 'rule':
+                    rule_counts[value.get('chain')] = rule_counts.get(value.get('chain'), 0) + 1
+        if not found:
+            return None
+        return NftRuleset(policies, sets, rule_counts)
+
+    def diff(self, loaded: NftRuleset | None) -> NftRulesetDiff:
+        """Compares this ruleset with the currently loaded one"""
+        if loaded is None:
+            return NftRulesetDiff(True, dict(self.policies), [
+                NftSetDiff(name, sorted(elements), [])
+                for name, elements in self.sets.items() if len(elements) > 0
+            ], True)
+
+        policies = {chain: policy for chain, policy in self.policies.items()
+                    if loaded.policies.get(chain) != policy}
+        sets = []
+        for name, elements in self.sets.items():
+            current = loaded.sets.get(name, frozenset())
+            if elements != current:
+                sets.append(
+                    NftSetDiff(name, sorted(elements - current), sorted(current - elements)))
+        rule_counts = loaded.rule_counts or {}
+        rules_changed = rule_counts.get('input', 0) != len(self._input_rules()) \
+            or rule_counts.get('output', 0) != len(BASE_OUTPUT_RULES) \
+            or set(loaded.sets) != set(self.sets)
+        return NftRulesetDiff(False, policies, sets, rules_changed)
+
+    def render(self) -> str:
+        """
+        Renders the ruleset as an nft script. The table is created, flushed by deleting it and
+        recreated in the same file, so `nft -f` applies it as one atomic transaction.
+        """
+        lines = [
+            f'table {TABLE_FAMILY} {TABLE_NAME} {{}}',
+            f'delete table {TABLE_FAMILY} {TABLE_NAME}',
+            '',
+            f'table {TABLE_FAMILY} {TABLE_NAME} {{',
+        ]
+        for name, elements in self.sets.items():
+            kind = name.rsplit('_', 1)[1]
+            lines.append(f'\tset {name} {{')
+            lines.append(f'\t\ttype {SET_TYPES[kind]}')
+            lines.append('\t\tflags interval')
+            lines.append('\t\tauto-merge')
+            if len(elements) > 0:
+                lines.append(f'\t\telements = {{ {", ".join(sorted(elements))} }}')
+            lines.append('\t}')
+        lines.append('')
+        lines.append('\tchain input {')
+        lines.append(f'\t\t{_chain_header("input", self.policies["input"])}')
+        lines.extend(f'\t\t{rule}' for rule in self._input_rules())
+        lines.append('\t}')
+        lines.append('')
+        lines.append('\tchain output {')
+        lines.append(f'\t\t{_chain_header("output", self.policies["output"])}')
+        lines.extend(f'\t\t{rule}' for rule in BASE_OUTPUT_RULES)
+        lines.append('\t}')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def _input_rules(self) -> list[str]:
+        rules = list(BASE_INPUT_RULES)
+        for rule in RULES:
+            verdict = VERDICTS[rule]
+            for proto in PROTOCOLS:
+                rules.append(
+                    f'ip saddr . {proto} dport @{self.set_name(rule, proto, "v4")} {verdict}')
+                rules.append(
+                    f'ip6 saddr . {proto} dport @{self.set_name(rule, proto, "v6")} {verdict}')
+                rules.append(f'{proto} dport @{self.set_name(rule, proto, "ports")} {verdict}')
+        return rules
+
+
+def _chain_header(hook: str, policy: str) -> str:
+    return f'type filter hook {hook} priority filter; policy {policy};'
+
+
+def _normalized_ports(port: str) -> list[str]:
+    ports = []
+    for part in port.split(','):
+        part = part.strip()
+        if ':' in part:
+            start, end = part.split(':', 1)
+            ports.append(f'{_port_number(start)}-{_port_number(end)}')
+        else:
+            ports.append(str(_port_number(part)))
+    return ports
+
+
+def _port_number(port: str) -> int:
+    if port.isdigit():
+        return int(port)
+    try:
+        return socket.getservbyname(port)
+    except OSError as e:
+        raise NftCompileException(f'Unknown port or service: {port}') from e
+
+
+def _normalized_address(address: str) -> tuple[str, str]:
+    try:
+        network = ipaddress.ip_network(address, strict=False)
+    except ValueError as e:
+        raise NftCompileException(f'Invalid source address: {address}') from e
+    kind = 'v4' if network.version == 4 else 'v6'
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address), kind
+    return str(network), kind
+
+
+def _merged(set_name: str, elements: Iterable[str]) -> frozenset[str]:
+    """
+    Merges overlapping and adjacent elements of a set into a canonical form, so compiled and loaded
+    sets compare equal no matter how the kernel merged them
+    """
+    if set_name.rsplit('_', 1)[1] == 'ports':
+        return frozenset(_port_element(interval)
+                         for interval in _merge_intervals(map(_port_interval, elements)))
+
+    intervals: dict[IPNetwork, list[tuple[int, int]]] = {}
+    for element in elements:
+        address, _, port = element.partition(' . ')
+        for network in _networks(address):
+            intervals.setdefault(network, []).append(_port_interval(port))
+
+    # Networks either contain each other or are disjoint, ports covered by a containing network
+    # are removed from the contained one
+    prefix_lengths = {(network.version, network.prefixlen) for network in intervals}
+    merged = set()
+    for network, network_intervals in intervals.items():
+        covered = []
+        for version, prefix_length in prefix_lengths:
+            if version == network.version and prefix_length < network.prefixlen:
+                covered.extend(intervals.get(network.supernet(new_prefix=prefix_length), []))
+        for interval in _merge_intervals(_subtract_intervals(network_intervals, covered)):
+            merged.add(f'{_network_element(network)} . {_port_element(interval)}')
+    return frozenset(merged)
+
+
+def _networks(address: str) -> list[IPNetwork]:
+    """Returns the networks of an address, prefix or address range (`start-end`)"""
+    if '-' in address:
+        start, end = address.split('-', 1)
+        return list(ipaddress.summarize_address_range(
+            ipaddress.ip_address(start), ipaddress.ip_address(end)))
+    return [ipaddress.ip_network(address, strict=False)]
+
+
+def _network_element(network: IPNetwork) -> str:
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def _port_interval(port: str) -> tuple[int, int]:
+    start, _, end = port.partition('-')
+    return int(start), int(end or start)
+
+
+def _port_element(interval: tuple[int, int]) -> str:
+    start, end = interval
+    return str(start) if start == end else f'{start}-{end}'
+
+
+def _merge_intervals(intervals: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _subtract_intervals(intervals: list[tuple[int, int]],
+                        removed: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    remaining = []
+    for interval in intervals:
+        pieces = [interval]
+        for removed_start, removed_end in removed:
+            pieces = [piece for start, end in pieces
+                      for piece in ((start, min(end, removed_start - 1)),
+                                    (max(start, removed_end + 1), end))
+                      if piece[0] <= piece[1]]
+        remaining.extend(pieces)
+    return remaining
+
+
+def _normalized_json_element(element) -> str:
+    if isinstance(element, dict):
+        if 'elem' in element:
+            return _normalized_json_element(element['elem']['val'])
+        if 'prefix' in element:
+            return f'{element["prefix"]["addr"]}/{element["prefix"]["len"]}'
+        if 'range' in element:
+            start, end = element['range']
+            return f'{_normalized_json_element(start)}-{_normalized_json_element(end)}'
+        if 'concat' in element:
+            return ' . '.join(_normalized_json_element(part) for part in element['concat'])
+    return str(element)
+
+
+class NftCompileException(BaseException):
+    pass
@@ -0,0 +1,154 @@
+import unittest
+
+from bitman.config.ufw_rule import DefaultUfwRule, UfwRule
+from bitman.nft.ruleset import NftRuleset, NftSetDiff
+
+DEFAULT_RULES = [DefaultUfwRule('in', 'deny'), DefaultUfwRule('out', 'allow')]
+RULES = [
+    UfwRule(None, 'in', 'allow', 'tcp', 22, 'any'),
+    UfwRule(None, 'in', 'allow', 'any', '8000:8080', 'any'),
+    # Adjacent to the range above
+    UfwRule(None, 'in', 'allow', 'tcp', 8081, 'any'),
+    UfwRule(None, 'in', 'allow', 'tcp', '80,443', '10.0.0.0/8'),
+    # Port 80 is covered by the network above, port 81 isn't
+    UfwRule(None, 'in', 'allow', 'tcp', '80:81', '10.1.2.3'),
+    UfwRule(None, 'in', 'deny', 'udp', 53, '2001:db8::/32'),
+    UfwRule(None, 'in', 'deny', 'tcp', 25, 'any'),
+]
+
+
+def _table_entry(kind: str, **value) -> dict:
+    return {kind: {'family': 'inet', 'table': 'bitman', **value}}
+
+
+def _set(name: str, set_type, elements: list) -> dict:
+    return _table_entry('set', name=name, type=set_type, handle=1, flags=['interval'],
+                        **({'elem': elements} if len(elements) > 0 else {}))
+
+
+def _loaded_ruleset(allow_tcp_ports: list) -> dict:
+    """The output of `nft -j list ruleset` after loading the rendered ruleset of RULES"""
+    entries: list[dict] = [
+        {'metainfo': {'version': '1.0.9', 'release_name': 'Old Doc Yak #3',
+                      'json_schema_version': 1}},
+        {'table': {'family': 'inet', 'name': 'bitman', 'handle': 1}},
+        # Another table with sets of the same name must be ignored
+        {'set': {'family': 'inet', 'name': 'allow_tcp_ports', 'table': 'filter',
+                 'type': 'inet_service', 'handle': 1, 'elem': [9999]}},
+    ]
+    elements = {
+        'allow_tcp_ports': allow_tcp_ports,
+        'allow_udp_ports': [{'range': [8000, 8080]}],
+        'allow_tcp_v4': [
+            {'concat': [{'prefix': {'addr': '10.0.0.0', 'len': 8}}, 80]},
+            {'concat': [{'prefix': {'addr': '10.0.0.0', 'len': 8}}, 443]},
+            {'elem': {'val': {'concat': ['10.1.2.3', 81]}, 'counter': {'packets': 0, 'bytes': 0}}},
+        ],
+        'deny_udp_v6': [{'concat': [{'prefix': {'addr': '2001:db8::', 'len': 32}}, 53]}],
+        'deny_tcp_ports': [25],
+    }
+    set_types = {'ports': 'inet_service', 'v4': ['ipv4_addr', 'inet_service'],
+                 'v6': ['ipv6_addr', 'inet_service']}
+    for rule in ('deny', 'allow'):
+        for proto in ('tcp', 'udp'):
+            for kind, set_type in set_types.items():
+                name = f'{rule}_{proto}_{kind}'
+                entries.append(_set(name, set_type, elements.get(name, [])))
+    entries.append(_table_entry('chain', name='input', handle=2, type='filter', hook='input',
+                                prio=0, policy='drop'))
+    entries.extend(_table_entry('rule', chain='input', handle=10 + index, expr=[])
+                   for index in range(16))
+    entries.append(_table_entry('chain', name='output', handle=3, type='filter', hook='output',
+                                prio=0, policy='accept'))
+    entries.extend(_table_entry('rule', chain='output', handle=30 + index, expr=[])
+                   for index in range(2))
+    return {'nftables': entries}
+
+
+class NftRulesetTest(unittest.TestCase):
+    def test_compile(self):
+        ruleset = NftRuleset.compile(DEFAULT_RULES, RULES)
+
+        self.assertEqual(ruleset.policies, {'input': 'drop', 'output': 'accept'})
+        self.assertEqual(len(ruleset.sets), 12)
+        self.assertEqual({name: elements for name, elements in ruleset.sets.items()
+                          if len(elements) > 0}, {
+            'allow_tcp_ports': {'22', '8000-8081'},
+            'allow_udp_ports': {'8000-8080'},
+            'allow_tcp_v4': {'10.0.0.0/8 . 80', '10.0.0.0/8 . 443', '10.1.2.3 . 81'},
+            'deny_udp_v6': {'2001:db8::/32 . 53'},
+            'deny_tcp_ports': {'25'},
+        })
+
+    def test_default_policies(self):
+        ruleset = NftRuleset.compile([DefaultUfwRule('in', 'allow'),
+                                      DefaultUfwRule('out', 'deny')], [])
+
+        self.assertEqual(ruleset.policies, {'input': 'accept', 'output': 'drop'})
+        self.assertTrue(all(len(elements) == 0 for elements in ruleset.sets.values()))
+        self.assertEqual(NftRuleset.compile([], []).policies,
+                         {'input': 'drop', 'output': 'accept'})
+
+    def test_overlapping_and_adjacent_elements_are_merged(self):
+        ruleset = NftRuleset.compile([], [
+            UfwRule(None, 'in', 'allow', 'udp', '20:30', 'any'),
+            UfwRule(None, 'in', 'allow', 'udp', '25:40', 'any'),
+            UfwRule(None, 'in', 'allow', 'udp', 41, 'any'),
+            UfwRule(None, 'in', 'allow', 'udp', 43, 'any'),
+            UfwRule(None, 'in', 'allow', 'udp', '1000:2000', '192.168.0.0/16'),
+            UfwRule(None, 'in', 'allow', 'udp', '1500:2500', '192.168.1.0/24'),
+            UfwRule(None, 'in', 'allow', 'udp', 3000, '192.168.1.7'),
+            UfwRule(None, 'in', 'allow', 'udp', 3001, '192.168.1.7'),
+        ])
+
+        self.assertEqual(ruleset.sets['allow_udp_ports'], {'20-41', '43'})
+        self.assertEqual(ruleset.sets['allow_udp_v4'], {
+            '192.168.0.0/16 . 1000-2000', '192.168.1.0/24 . 2001-2500', '192.168.1.7 . 3000-3001'
+        })
+
+    def test_deny_rules_are_matched_before_allow_rules(self):
+        rendered = NftRuleset.compile(DEFAULT_RULES, RULES).render()
+        input_chain = rendered.split('chain input {')[1].split('chain output {')[0]
+        set_rules = [rule.strip() for rule in input_chain.splitlines() if '@' in rule]
+
+        self.assertEqual(len(set_rules), 12)
+        self.assertTrue(all(rule.endswith('drop') for rule in set_rules[:6]))
+        self.assertTrue(all(rule.endswith('accept') for rule in set_rules[6:]))
+
+    def test_render(self):
+        rendered = NftRuleset.compile(DEFAULT_RULES, RULES).render()
+
+        # The table is recreated atomically, even if it doesn't exist yet
+        self.assertTrue(rendered.startswith('table inet bitman {}\ndelete table inet bitman\n'))
+        self.assertIn('\t\telements = { 22, 8000-8081 }\n', rendered)
+        self.assertIn('\t\telements = { 10.0.0.0/8 . 443, 10.0.0.0/8 . 80, 10.1.2.3 . 81 }\n',
+                      rendered)
+        self.assertIn('\t\ttype filter hook input priority filter; policy drop;\n', rendered)
+
+    def test_loaded_ruleset_matches_the_rendered_one(self):
+        ruleset = NftRuleset.compile(DEFAULT_RULES, RULES)
+        # The kernel may split or merge interval elements differently
+        loaded = NftRuleset.from_json(_loaded_ruleset(
+            [22, {'range': [8000, 8040]}, {'range': [8041, 8081]}]))
+
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.rule_counts, {'input': 16, 'output': 2})
+        self.assertTrue(ruleset.diff(loaded).is_empty())
+
+    def test_diff(self):
+        ruleset = NftRuleset.compile(DEFAULT_RULES, RULES)
+
+        missing = ruleset.diff(NftRuleset.from_json({'nftables': []}))
+        self.assertTrue(missing.table_missing)
+        self.assertIn(NftSetDiff('deny_tcp_ports', ['25'], []), missing.sets)
+
+        changed = ruleset.diff(NftRuleset.from_json(_loaded_ruleset([22, 25])))
+        self.assertFalse(changed.table_missing)
+        self.assertEqual(changed.policies, {})
+        self.assertEqual(changed.sets, [NftSetDiff('allow_tcp_ports', ['8000-8081'], ['25'])])
+        self.assertFalse(changed.rules_changed)
+        self.assertFalse(changed.is_empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
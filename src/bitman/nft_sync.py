@@ -0,0 +1,90 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from bitman.config.system_config import SystemConfig
+from bitman.nft import Nft
+from bitman.nft.ruleset import NftRuleset, NftRulesetDiff
+from bitman.prompt import confirm
+
+if TYPE_CHECKING:
+    from rich.console import Console
+
+
+class NftSync:
+    def __init__(self, nft: Nft, console: Console | None, system_config: SystemConfig):
+        """The console may be None if nothing is printed, e.g. when only computing the status"""
+        self._nft = nft
+        self._console = console
+        self._system_config = system_config
+
+    def compiled_ruleset(self) -> NftRuleset:
+        """Compiles the configured firewall rules into an nftables ruleset"""
+        return NftRuleset.compile(
+            self._system_config.default_ufw_rules(),
+            self._system_config.ufw_rules()
+        )
+
+    def status(self, ruleset: NftRuleset | None = None) -> NftRulesetDiff:
+        """Returns the differences between the loaded and the configured ruleset"""
+        if ruleset is None:
+            ruleset = self.compiled_ruleset()
+        return ruleset.diff(NftRuleset.from_json(self._nft.ruleset()))
+
+    def print_summary(self, diff: NftRulesetDiff | None = None) -> bool:
+        """Prints the differences between the loaded and the configured ruleset"""
+        if diff is None:
+            diff = self.status()
+
+        if diff.is_empty():
+            self._console.print('All nftables rules in sync', style='green')
+            return False
+
+        self._print_diff(diff)
+        return True
+
+    def run(self) -> bool:
+        """
+        Loads the compiled ruleset atomically if it differs from the loaded one, returns whether
+        the rules are in sync afterwards
+        """
+        ruleset = self.compiled_ruleset()
+        is_not_synced = self.print_summary(self.status(ruleset))
+
+        if not is_not_synced:
+            return True
+
+        if not confirm('Do you want to continue?', non_interactive_answer=True):
+            return False
+
+        self.apply(ruleset.render())
+        return True
+
+    def apply(self, rendered_ruleset: str) -> None:
+        """Validates and atomically loads a rendered ruleset"""
+        self._console.print('Checking ruleset', style='bold yellow')
+        self._nft.check(rendered_ruleset)
+        self._console.print('Loading ruleset', style='bold yellow')
+        self._nft.load(rendered_ruleset)
+
+    def _print_diff(self, diff: NftRulesetDiff) -> None:
+        if diff.table_missing:
+            self._console.print('The bitman nftables table is not loaded', style='bold yellow')
+        elif diff.rules_changed:
+            self._console.print('The bitman nftables chains were modified', style='bold yellow')
+
+        if len(diff.policies) != 0:
+            self._console.print('Unsynced default policies', style='bold yellow')
+            self._console.print(
+                *[f'[bold]·[/bold] {chain}: {policy}' for chain, policy in diff.policies.items()],
+                sep='\n')
+
+        for set_diff in diff.sets:
+            self._console.print(f'Set {set_diff.name}', style='bold yellow')
+            if len(set_diff.added) != 0:
+                self._console.print(
+                    *[f'[bold]+[/bold] {element}' for element in set_diff.added], sep='\n',
+                    highlight=False)
+            if len(set_diff.removed) != 0:
+                self._console.print(
+                    *[f'[bold]-[/bold] {element}' for element in set_diff.removed], sep='\n',
+                    highlight=False)
@@ -0,0 +1,94 @@
+"""
+The index of pacman's package cache: every cached package file with its name, version and
+architecture, read from the file names without opening any archive.
+"""
+import os
+import re
+from functools import cmp_to_key
+from typing import NamedTuple
+
+from bitman.package.vercmp import vercmp
+
+# Alternate roots share the package cache of the host
+PACKAGE_CACHE_PATH = '/var/cache/pacman/pkg'
+# NAME-PKGVER-PKGREL-ARCH.pkg.tar[.COMPRESSION], neither pkgver nor pkgrel contain dashes
+PACKAGE_FILE_PATTERN = re.compile(
+    r'^(?P<name>.+)-(?P<version>[^-/]+-[^-/]+)-(?P<arch>[^-/]+)\.pkg\.tar(\.[a-z0-9]+)?$')
+
+
+class CachedPackage(NamedTuple):
+    name: str
+    version: str
+    arch: str
+    path: str
+    size: int
+
+
+class PackageCache:
+    """
+    The package files in pacman's cache by package name, newest version first. Files of other
+    architectures, downloads in progress and signatures are left out.
+    """
+
+    def __init__(self, directory: str = PACKAGE_CACHE_PATH):
+        self._directory = directory
+        self._packages: dict[str, list[CachedPackage]] | None = None
+
+    def packages(self) -> dict[str, list[CachedPackage]]:
+        """Returns all cached packages, the cache directory is read only once"""
+        if self._packages is None:
+            architectures = ('any', os.uname().machine)
+            packages: dict[str, list[CachedPackage]] = {}
+            try:
+                entries = list(os.scandir(self._directory))
+            except FileNotFoundError:
+                entries = []
+            for entry in entries:
+                match = PACKAGE_FILE_PATTERN.match(entry.name)
+                if match is None or match['arch'] not in architectures or not entry.is_file():
+                    continue
+                packages.setdefault(match['name'], []).append(CachedPackage(
+                    match['name'], match['version'], match['arch'], entry.path,
+                    entry.stat().st_size))
+            for versions in packages.values():
+                versions.sort(key=cmp_to_key(lambda a, b: vercmp(a.version, b.version)),
+                              reverse=True)
+            self._packages = packages
+        return self._packages
+
+    def find(self, name: str, version: str) -> CachedPackage | None:
+        """Returns the cached file of a package version"""
+        for package in self.packages().get(name, []):
+            if package.version == version:
+                return package
+        return None
+
+    def prunable(self, referenced: dict[str, str | None], keep: int) -> list[CachedPackage]:
+        """
+        Returns the cached files which aren't needed: of referenced packages all versions older
+        than the referenced version (the newest cached one if None) and its `keep` predecessors,
+        of other packages every version
+        """
+        prunable = []
+        for name, versions in self.packages().items():
+            if name not in referenced:
+                prunable.extend(versions)
+                continue
+            version = referenced[name]
+            # Newer versions (e.g. downloaded for an image) are kept as well
+            older = versions[1:] if version is None \
+                else [package for package in versions if vercmp(package.version, version) < 0]
+            prunable.extend(older[keep:])
+        return prunable
+
+
+def format_size(size: int) -> str:
+    """Formats a number of bytes, e.g. `1.4 GiB`"""
+    if size < 1024:
+        return f'{size} B'
+    value = size / 1024
+    for unit in ('KiB', 'MiB'):
+        if value < 1024:
+            return f'{value:.1f} {unit}'
+        value /= 1024
+    return f'{value:.1f} GiB'
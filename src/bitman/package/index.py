@@ -0,0 +1,243 @@
+"""
+The package index of bitman: every installed package with its version, install reason and whether
+it is foreign. It is kept up to date by an ALPM hook after every pacman transaction and read
+instead of querying pacman. Run as the hook, this module reads the transaction's targets from
+stdin and updates them in the index.
+"""
+import json
+import os
+import stat
+import sys
+import time
+from os.path import dirname, join, realpath
+from typing import NamedTuple
+
+from bitman.fingerprint import PACMAN_LOCAL_DB_PATH, local_db_stamp
+from bitman.paths import SYSTEM_STATE_PATH, state_directory
+from bitman.root import in_root, is_alternate_root, target_root
+from bitman.runner import command_runner
+
+INDEX_VERSION = 2
+INDEX_FILE_NAME = 'package-index.json'
+ALPM_HOOK_PATH = '/usr/share/libalpm/hooks/bitman-index.hook'
+
+
+class IndexedPackage(NamedTuple):
+    version: str
+    explicit: bool
+    foreign: bool
+
+
+class PackageIndex:
+    """
+    Installed packages read from an index file instead of pacman. The index is only used if it was
+    written for the current state of the pacman database (the mtimes of the db and of its packages'
+    `desc` files), otherwise it is rebuilt from pacman. This includes install reasons changed with
+    `pacman -D`, which don't run hooks.
+    """
+
+    def __init__(self, file_paths: list[str] | None = None, local_db_path: str | None = None):
+        # The first writable path is written to, the most recently written valid one is read
+        self._file_paths = file_paths if file_paths is not None else index_file_paths()
+        self._local_db_path = local_db_path if local_db_path is not None \
+            else in_root(PACMAN_LOCAL_DB_PATH)
+        self._packages: dict[str, IndexedPackage] | None = None
+        self._stamp: tuple[int, int] | None = None
+
+    def packages(self) -> dict[str, IndexedPackage]:
+        """Returns all installed packages, rebuilding the index if it doesn't match pacman's db"""
+        stamp = self._db_stamp()
+        if self._packages is None or stamp is None or stamp != self._stamp:
+            packages = self._load(stamp)
+            if packages is None:
+                packages = self._query()
+                self._save(packages, stamp)
+            self._packages, self._stamp = packages, stamp
+        return self._packages
+
+    def rebuild(self) -> None:
+        """Rebuilds the whole index from pacman"""
+        self._packages, self._stamp = self._query(), self._db_stamp()
+        self._save(self._packages, self._stamp)
+
+    def update(self, targets: list[str]) -> None:
+        """
+        Updates the given packages after a transaction, packages which are no longer installed are
+        removed. Falls back to a rebuild if there is no index or it diverged from pacman's db before
+        the transaction, e.g. after `pacman -D` or transactions before the hook was installed.
+        """
+        data = self._newest(None)
+        if data is None or _changed_packages(self._local_db_path, data['db'][0]) - set(targets):
+            self.rebuild()
+            return
+        packages = _packages(data)
+
+        for target in targets:
+            packages.pop(target, None)
+        packages.update(self._query(targets))
+
+        stamp = self._db_stamp()
+        if stamp is None or len(packages) != stamp[1]:
+            self.rebuild()
+            return
+        self._packages, self._stamp = packages, stamp
+        self._save(packages, stamp)
+
+    def _query(self, targets: list[str] | None = None) -> dict[str, IndexedPackage]:
+        """Queries pacman for all (or the given installed) packages"""
+        if targets is not None and len(targets) == 0:
+            return {}
+        # Queried targets which aren't installed (anymore) are reported as errors
+        check = targets is None
+        targets = [] if targets is None else targets
+        root = ['--root', target_root()] if is_alternate_root() else []
+        versions = _query_pacman(['pacman', '-Q', *root, *targets], check)
+        explicit = {name for name, _ in _query_pacman(['pacman', '-Qe', *root, *targets], check)}
+        foreign = {name for name, _ in _query_pacman(['pacman', '-Qm', *root, *targets], check)}
+        return {name: IndexedPackage(version, name in explicit, name in foreign)
+                for name, version in versions}
+
+    def _db_stamp(self) -> tuple[int, int] | None:
+        """Returns the state of pacman's local db, which changes with every package transaction"""
+        return local_db_stamp(self._local_db_path)
+
+    def _load(self, stamp: tuple[int, int] | None) -> dict[str, IndexedPackage] | None:
+        """Returns the most recently written index, only if it matches `stamp` (if given)"""
+        data = self._newest(stamp)
+        return None if data is None else _packages(data)
+
+    def _newest(self, stamp: tuple[int, int] | None) -> dict | None:
+        """Returns the data of the most recently written index matching `stamp` (if given)"""
+        newest: dict | None = None
+        for file_path in self._file_paths:
+            try:
+                with open(file_path, 'rt', encoding='utf-8') as index_file:
+                    data = json.load(index_file)
+            except (OSError, ValueError):
+                continue
+            if data.get('version') != INDEX_VERSION \
+                    or (stamp is not None and tuple(data['db']) != stamp):
+                continue
+            if newest is None or data['updated'] > newest['updated']:
+                newest = data
+        return newest
+
+    def _save(self, packages: dict[str, IndexedPackage], stamp: tuple[int, int] | None) -> None:
+        if stamp is None:
+            return
+        data = {
+            'version': INDEX_VERSION,
+            'db': stamp,
+            'updated': time.time(),
+            'packages': {name: list(package) for name, package in sorted(packages.items())},
+        }
+        for file_path in self._file_paths:
+            temporary_path = f'{file_path}.{os.getpid()}.tmp'
+            try:
+                os.makedirs(dirname(file_path), exist_ok=True)
+                with open(temporary_path, 'wt', encoding='utf-8') as index_file:
+                    json.dump(data, index_file, separators=(',', ':'))
+                os.replace(temporary_path, file_path)
+                return
+            except OSError:
+                continue
+
+
+def index_file_paths() -> list[str]:
+    """Returns the system wide index (written by the hook) and the one of the current user"""
+    return list(dict.fromkeys([join(in_root(SYSTEM_STATE_PATH), INDEX_FILE_NAME),
+                               join(state_directory(), INDEX_FILE_NAME)]))
+
+
+def _packages(data: dict) -> dict[str, IndexedPackage]:
+    return {name: IndexedPackage(*package) for name, package in data['packages'].items()}
+
+
+def _changed_packages(local_db_path: str, since: int) -> set[str]:
+    """
+    Returns the packages of pacman's local db whose `desc` file changed after `since` (an mtime in
+    nanoseconds). The entries of the db are named `NAME-PKGVER-PKGREL`.
+    """
+    changed = set()
+    try:
+        entries = list(os.scandir(local_db_path))
+    except OSError:
+        return changed
+    for entry in entries:
+        try:
+            if entry.is_dir() and os.stat(join(entry.path, 'desc')).st_mtime_ns > since:
+                changed.add(entry.name.rsplit('-', 2)[0])
+        except OSError:
+            continue
+    return changed
+
+
+def _query_pacman(argv: list[str], check: bool) -> list[tuple[str, str]]:
+    """Returns name and version of the packages listed by a pacman query"""
+    result = command_runner().run(argv)
+    if check and result.returncode != 0 and result.stderr:
+        result.check_returncode()
+    packages = []
+    for line in result.stdout.splitlines():
+        name, _, version = line.partition(' ')
+        packages.append((name, version))
+    return packages
+
+
+def alpm_hook(source_path: str, python: str = sys.executable) -> str:
+    """Returns the ALPM hook which updates the index after every transaction"""
+    return '\n'.join([
+        '[Trigger]',
+        'Operation = Install',
+        'Operation = Upgrade',
+        'Operation = Remove',
+        'Type = Package',
+        'Target = *',
+        '',
+        '[Action]',
+        'Description = Updating the bitman package index...',
+        'When = PostTransaction',
+        f'Exec = /usr/bin/env PYTHONPATH={source_path} {python} -m bitman.package.index',
+        'NeedsTargets',
+    ]) + '\n'
+
+
+def insecure_hook_paths(source_path: str, python: str = sys.executable) -> list[str]:
+    """
+    Returns the paths the hook would run code from as root which aren't owned by root or which
+    other users can write to: the interpreter, bitman's source tree and their parent directories
+    """
+    paths = [*_with_parents(python), *_with_parents(realpath(python)), *_with_parents(source_path)]
+    for directory, directories, files in os.walk(join(source_path, 'bitman')):
+        paths.extend(join(directory, name) for name in [*directories, *files])
+
+    insecure = []
+    for path in dict.fromkeys(paths):
+        try:
+            path_stat = os.lstat(path)
+        except OSError:
+            continue
+        if path_stat.st_uid != 0 or (path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+                                     and not stat.S_ISLNK(path_stat.st_mode)):
+            insecure.append(path)
+    return insecure
+
+
+def _with_parents(path: str) -> list[str]:
+    paths = [path]
+    while dirname(paths[-1]) != paths[-1]:
+        paths.append(dirname(paths[-1]))
+    return paths
+
+
+def main() -> None:
+    targets = [line.strip() for line in sys.stdin if line.strip() != '']
+    try:
+        PackageIndex([join(SYSTEM_STATE_PATH, INDEX_FILE_NAME)]).update(targets)
+    except BaseException as e:  # pylint: disable=broad-exception-caught
+        # The index is rebuilt when it's read next, a failing hook must not bother pacman users
+        print(f'bitman: could not update the package index: {e}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from subprocess import CompletedProcess
+
+from bitman.package.index import IndexedPackage, PackageIndex
+from bitman.runner import CommandRunner, command_runner, set_command_runner
+
+SECOND = 1_000_000_000
+
+
+class PacmanQueryRunner(CommandRunner):
+    """Answers pacman's queries from a dict of installed packages (version and install reason)"""
+
+    def __init__(self, packages: dict[str, tuple[str, bool]]):
+        self.packages = packages
+        self.commands: list[list[str]] = []
+
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        self.commands.append(argv)
+        targets = argv[2:] or list(self.packages)
+        lines = [f'{name} {self.packages[name][0]}' for name in targets
+                 if name in self.packages and (argv[1] != '-Qe' or self.packages[name][1])
+                 and argv[1] != '-Qm']
+        return CompletedProcess(argv, 0, ''.join(f'{line}\n' for line in lines), '')
+
+
+class PackageIndexTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._local_db = join(self._directory, 'local')
+        os.makedirs(self._local_db)
+        self._time = 1_700_000_000 * SECOND
+        self._previous_runner = command_runner()
+        self._runner = PacmanQueryRunner({})
+        set_command_runner(self._runner)
+
+        self._install('vim', '9.1.0-1', explicit=True)
+        self._install('git', '2.45.0-1', explicit=True)
+        self._index().rebuild()
+        self._runner.commands.clear()
+
+    def tearDown(self):
+        set_command_runner(self._previous_runner)
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_update_queries_only_the_targets(self):
+        self._install('htop', '3.3.0-1', explicit=True)
+
+        self._index().update(['htop'])
+
+        self.assertEqual(self._runner.commands, [['pacman', '-Q', 'htop'], ['pacman', '-Qe', 'htop'],
+                                                 ['pacman', '-Qm', 'htop']])
+        self.assertEqual(self._index().packages()['htop'], IndexedPackage('3.3.0-1', True, False))
+
+    def test_update_rebuilds_after_changes_without_hook(self):
+        # `pacman -D --asdeps vim` runs no hook
+        self._install('vim', '9.1.0-1', explicit=False)
+        self._install('htop', '3.3.0-1', explicit=True)
+
+        self._index().update(['htop'])
+
+        self.assertIn(['pacman', '-Q'], self._runner.commands)
+        self.assertFalse(self._index().packages()['vim'].explicit)
+
+    def _install(self, name: str, version: str, explicit: bool) -> None:
+        """Writes the package's `desc` file into the local db, newer than everything before"""
+        self._runner.packages[name] = (version, explicit)
+        package_path = join(self._local_db, f'{name}-{version}')
+        os.makedirs(package_path, exist_ok=True)
+        with open(join(package_path, 'desc'), 'wt', encoding='utf-8') as desc_file:
+            desc_file.write(f'%NAME%\n{name}\n')
+        self._time += SECOND
+        os.utime(join(package_path, 'desc'), ns=(self._time, self._time))
+        os.utime(self._local_db, ns=(self._time, self._time))
+
+    def _index(self) -> PackageIndex:
+        return PackageIndex([join(self._directory, 'package-index.json')], self._local_db)
+
+
+if __name__ == '__main__':
+    unittest.main()
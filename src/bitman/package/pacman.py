@@ -1,65 +1,266 @@
-import subprocess
-from typing import Generator
+import glob
+import os
+import sys
+import time
+from os.path import dirname, join
+from subprocess import CalledProcessError
+from typing import Generator, Iterable, NamedTuple
 
+from bitman.fingerprint import PACMAN_LOCAL_DB_PATH, PACMAN_SYNC_DB_PATH
+from bitman.package.cache import PACKAGE_CACHE_PATH, CachedPackage, PackageCache
+from bitman.package.index import PackageIndex
 from bitman.package.package_manager import PackageManager
+from bitman.package.vercmp import vercmp
+from bitman.root import AlternateRootException, in_root, target_root
+from bitman.runner import command_runner
+from bitman.scheduler import show_task_status
+from bitman.trace import span
+
+PACMAN_LOCK_PATH = join(dirname(PACMAN_LOCAL_DB_PATH), 'db.lck')
+# How long transactions wait for another pacman to release its database lock
+LOCK_TIMEOUT_SECONDS = 10 * 60
+LOCK_BACKOFF_SECONDS = 0.5
+LOCK_MAX_BACKOFF_SECONDS = 10.0
+LOCK_ERROR = 'unable to lock database'
+# How many cached files are removed by a single command
+CACHE_REMOVE_CHUNK = 200
+
+# Directories pacman needs in a new root, with their modes (like pacstrap creates them)
+ROOT_DIRECTORIES = {
+    '/var/cache/pacman/pkg': 0o755,
+    '/var/lib/pacman': 0o755,
+    '/var/lib/pacman/sync': 0o755,
+    '/var/log': 0o755,
+    '/etc/pacman.d': 0o755,
+    '/dev': 0o755,
+    '/run': 0o755,
+    '/tmp': 0o1777,
+    '/sys': 0o555,
+    '/proc': 0o555,
+}
+
+
+class OutdatedPackage(NamedTuple):
+    name: str
+    installed_version: str
+    available_version: str
 
 
 class Pacman(PackageManager):
+    def __init__(self,
+                 index: PackageIndex | None = None,
+                 cache: PackageCache | None = None,
+                 root: str | None = None):
+        self.index = index if index is not None else PackageIndex()
+        self.cache = cache if cache is not None else PackageCache()
+        # Transactions run in the root bitman provisions, unless another one is given (e.g. by
+        # image builds, which provision several roots from worker threads)
+        self._root = root if root is not None else target_root()
+        self._sync_versions: dict[str, str] | None = None
+
     def install_packages(self, packages):
-        result = subprocess.run(
-            ['sudo', 'pacman', '-S', '--asexplicit', '--needed', '--noconfirm', *packages],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        result.check_returncode()
+        self._prepare_root()
+        cached_files = self._cached_files(packages)
+        if cached_files is not None:
+            # Every package is cached in the version of the sync databases, no mirror is needed
+            run_transaction(['pacman', '-U', '--asexplicit', '--needed', '--noconfirm',
+                             *self._root_options(), *cached_files], self._root)
+            return
+
+        # A new root has no sync databases yet, so they are refreshed like pacstrap does
+        operation = '-Sy' if self._is_alternate_root() else '-S'
+        run_transaction(['pacman', operation, '--asexplicit', '--needed', '--noconfirm',
+                         *self._root_options(), *packages], self._root)
+
+    def download_packages(self, packages: list[str]) -> None:
+        """Downloads packages with their dependencies into the package cache without installing"""
+        operation = '-Syw' if self._is_alternate_root() else '-Sw'
+        self._prepare_root()
+        run_transaction(['pacman', operation, '--needed', '--noconfirm', *self._root_options(),
+                         *packages], self._root)
 
     def remove_packages(self, packages):
-        result = subprocess.run(
-            ['sudo', 'pacman', '-R', '--noconfirm', *packages],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        result.check_returncode()
+        run_transaction(['pacman', '-R', '--noconfirm', *self._root_options(), *packages],
+                        self._root)
+
+    def upgrade_packages(self) -> None:
+        """
+        Upgrades all installed packages to the versions of the sync databases. Arch doesn't support
+        partial upgrades, so outdated packages can't be upgraded on their own.
+        """
+        self._prepare_root()
+        run_transaction(['pacman', '-Su', '--noconfirm', *self._root_options()], self._root)
+
+    def prunable_cache(self, configured: Iterable[str], keep: int) -> list[CachedPackage]:
+        """
+        Returns the cached package files which neither an installed package (e.g. a dependency)
+        nor a configured one references, keeping `keep` versions older than the referenced one
+        """
+        if self._is_alternate_root():
+            raise AlternateRootException(
+                'The package cache is shared with the host, it can\'t be pruned for a root')
+        referenced: dict[str, str | None] = {
+            name: package.version for name, package in self.index.packages().items()}
+        available = self._available_versions()
+        for package in configured:
+            # Configured packages which aren't installed keep the version they would be installed in
+            referenced.setdefault(package, available.get(package))
+        return self.cache.prunable(referenced, keep)
+
+    def remove_cached(self, packages: list[CachedPackage]) -> None:
+        """Removes package files (and their signatures) from the cache in a single helper request"""
+        paths = []
+        for package in packages:
+            paths.append(package.path)
+            if os.path.exists(f'{package.path}.sig'):
+                paths.append(f'{package.path}.sig')
+        commands: list[tuple[list[str], str | None]] = [
+            (['rm', '-f', '--', *paths[start:start + CACHE_REMOVE_CHUNK]], None)
+            for start in range(0, len(paths), CACHE_REMOVE_CHUNK)]
+        if len(commands) > 0:
+            command_runner().run_batch(commands, privileged=True).check_returncode()
+
+    def sync_versions(self) -> dict[str, str]:
+        """Returns the version of every package in the sync databases, read with a single query"""
+        if self._sync_versions is None:
+            root = ['--root', self._root] if self._is_alternate_root() else []
+            result = command_runner().run(['pacman', '-Sl', *root])
+            result.check_returncode()
+            versions: dict[str, str] = {}
+            for line in result.stdout.splitlines():
+                # REPOSITORY NAME VERSION [installed]
+                fields = line.split(' ', 3)
+                if len(fields) >= 3:
+                    # Like pacman, the first repository providing a package wins
+                    versions.setdefault(fields[1], fields[2])
+            self._sync_versions = versions
+        return self._sync_versions
+
+    def outdated_packages(self, packages: Iterable[str]) -> list[OutdatedPackage]:
+        """
+        Returns the given installed packages which have a newer version in the sync databases.
+        Packages which aren't installed or in no repository (e.g. from the AUR) are left out.
+        """
+        installed = self.index.packages()
+        candidates = [package for package in packages if package in installed]
+        if len(candidates) == 0:
+            # A new root has no sync databases to query yet
+            return []
+        available = self.sync_versions()
+        return [OutdatedPackage(package, installed[package].version, available[package])
+                for package in sorted(candidates) if package in available
+                and vercmp(installed[package].version, available[package]) < 0]
+
+    def _cached_files(self, packages: list[str]) -> list[str] | None:
+        """Returns the cached files of the packages in their sync database versions, if all exist"""
+        available = self._available_versions()
+        files = []
+        for package in packages:
+            version = available.get(package)
+            cached = None if version is None else self.cache.find(package, version)
+            if cached is None:
+                return None
+            files.append(cached.path)
+        return files
+
+    def _available_versions(self) -> dict[str, str]:
+        """Returns the versions of the sync databases, none if they can't be read (e.g. missing)"""
+        try:
+            return self.sync_versions()
+        except (CalledProcessError, OSError):
+            return {}
+
+    def _is_alternate_root(self) -> bool:
+        return self._root != '/'
+
+    def _root_options(self) -> list[str]:
+        if not self._is_alternate_root():
+            return []
+        return ['--root', self._root, '--cachedir', PACKAGE_CACHE_PATH]
+
+    def _prepare_root(self) -> None:
+        """
+        Creates the directories pacman needs in a new root. It starts with the host's sync
+        databases, so cached packages can be installed without a mirror; they are refreshed when
+        packages have to be downloaded anyway. The root belongs to root, so everything is created
+        by the privileged helper in a single batch.
+        """
+        if not self._is_alternate_root():
+            return
+        commands: list[tuple[list[str], str | None]] = [
+            (['mkdir', '-p', '-m', f'{mode:o}', '--', in_root(directory, self._root)], None)
+            for directory, mode in ROOT_DIRECTORIES.items()
+            if not os.path.isdir(in_root(directory, self._root))]
+
+        sync_db_path = in_root(PACMAN_SYNC_DB_PATH, self._root)
+        databases = sorted(glob.glob(join(PACMAN_SYNC_DB_PATH, '*.db')))
+        if len(databases) > 0 and len(glob.glob(join(sync_db_path, '*.db'))) == 0:
+            commands.append((['cp', '-p', '--', *databases, sync_db_path], None))
+            self._sync_versions = None
+
+        if len(commands) > 0:
+            command_runner().run_batch(commands, privileged=True).check_returncode()
 
     def explicitly_installed_packages(self) -> Generator[str, None, None]:
         """Yields all explicitly installed packages (packages which weren't installed as a dependency)"""
-        result = subprocess.run(
-            ['pacman', '-Qe'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        if result.returncode != 0 and result.stderr:
-            result.check_returncode()
-        for line in result.stdout.splitlines():
-            yield line.split(' ', 1)[0]
+        for name, package in self.index.packages().items():
+            if package.explicit:
+                yield name
 
     def foreign_installed_packages(self) -> Generator[str, None, None]:
         """Yields all foreign installed packages (e. g. those from the AUR)"""
-        result = subprocess.run(
-            ['pacman', '-Qm'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        if result.returncode != 0 and result.stderr:
-            result.check_returncode()
-        for line in result.stdout.splitlines():
-            yield line.split(' ', 1)[0]
+        for name, package in self.index.packages().items():
+            if package.foreign:
+                yield name
 
     def package_installed(self, package: str) -> bool:
         """Returns whether or not a certain package is installed"""
-        result = subprocess.run(
-            ['pacman', '-Q', package],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        return result.returncode == 0
+        return package in self.index.packages()
+
+
+def run_transaction(argv: list[str], root: str | None = None) -> None:
+    """
+    Runs a privileged pacman command which locks the database (of `root`, defaults to the root
+    bitman provisions). If another transaction holds the lock, it waits until the lock is released
+    instead of failing.
+    """
+    deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS
+    delay = LOCK_BACKOFF_SECONDS
+    while True:
+        wait_for_pacman_lock(deadline, root)
+        result = command_runner().run(argv, privileged=True)
+        # The lock may have been taken again between the check and the start of the transaction
+        if result.returncode == 0 or LOCK_ERROR not in (result.stderr or '') \
+                or time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, LOCK_MAX_BACKOFF_SECONDS)
+    result.check_returncode()
+
+
+def wait_for_pacman_lock(deadline: float | None = None, root: str | None = None) -> None:
+    """Waits with an increasing delay until no pacman transaction holds the database lock"""
+    lock_path = in_root(PACMAN_LOCK_PATH, root)
+    if not os.path.exists(lock_path):
+        return
+
+    deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS if deadline is None else deadline
+    delay = LOCK_BACKOFF_SECONDS
+    # Tasks show it in their progress row, printing would break the progress display
+    if not show_task_status('waiting for another pacman transaction'):
+        print('Waiting for another pacman transaction to finish...', file=sys.stderr)
+    try:
+        with span('wait for pacman lock', 'wait'):
+            while os.path.exists(lock_path):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PacmanLockedException(
+                        f'{lock_path} is still held, remove it if no pacman transaction is running')
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, LOCK_MAX_BACKOFF_SECONDS)
+    finally:
+        show_task_status(None)
+
+
+class PacmanLockedException(BaseException):
+    pass
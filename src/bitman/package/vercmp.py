@@ -0,0 +1,89 @@
+"""
+pacman's version comparison (`vercmp`, alpm_pkg_vercmp) in Python, so versions can be compared
+without running a process per package. Versions have the form `[epoch:]pkgver[-pkgrel]`.
+"""
+import string
+
+_DIGITS = frozenset(string.digits)
+_LETTERS = frozenset(string.ascii_letters)
+_ALPHANUMERIC = _DIGITS | _LETTERS
+
+
+def vercmp(version: str, other: str) -> int:
+    """Returns -1 if `version` is older than `other`, 1 if it is newer and 0 if they are equal"""
+    if version == other:
+        return 0
+
+    epoch, pkgver, pkgrel = _parse(version)
+    other_epoch, other_pkgver, other_pkgrel = _parse(other)
+    result = _rpmvercmp(epoch, other_epoch)
+    if result == 0:
+        result = _rpmvercmp(pkgver, other_pkgver)
+    # The release is only compared if both versions have one
+    if result == 0 and pkgrel is not None and other_pkgrel is not None:
+        result = _rpmvercmp(pkgrel, other_pkgrel)
+    return result
+
+
+def _parse(version: str) -> tuple[str, str, str | None]:
+    """Splits a version into epoch, pkgver and pkgrel"""
+    epoch = '0'
+    digits = 0
+    while digits < len(version) and version[digits] in _DIGITS:
+        digits += 1
+    if digits < len(version) and version[digits] == ':':
+        epoch = version[:digits] or '0'
+        version = version[digits + 1:]
+
+    pkgver, separator, pkgrel = version.rpartition('-')
+    if separator == '':
+        return epoch, version, None
+    return epoch, pkgver, pkgrel
+
+
+def _rpmvercmp(a: str, b: str) -> int:
+    """Compares alternating numeric and alphabetic segments, like rpm (and pacman) do"""
+    if a == b:
+        return 0
+
+    one = two = 0
+    while one < len(a) and two < len(b):
+        separator_start, other_separator_start = one, two
+        while one < len(a) and a[one] not in _ALPHANUMERIC:
+            one += 1
+        while two < len(b) and b[two] not in _ALPHANUMERIC:
+            two += 1
+        if one >= len(a) or two >= len(b):
+            break
+        # Different separators (e.g. `1.0` and `1..0`) decide on their own
+        separator, other_separator = one - separator_start, two - other_separator_start
+        if separator != other_separator:
+            return -1 if separator < other_separator else 1
+
+        numeric = a[one] in _DIGITS
+        characters = _DIGITS if numeric else _LETTERS
+        end, other_end = one, two
+        while end < len(a) and a[end] in characters:
+            end += 1
+        while other_end < len(b) and b[other_end] in characters:
+            other_end += 1
+        segment, other_segment = a[one:end], b[two:other_end]
+
+        # Segments of different types: numeric ones are newer
+        if other_segment == '':
+            return 1 if numeric else -1
+
+        if numeric:
+            segment, other_segment = segment.lstrip('0'), other_segment.lstrip('0')
+            if len(segment) != len(other_segment):
+                return 1 if len(segment) > len(other_segment) else -1
+        if segment != other_segment:
+            return 1 if segment > other_segment else -1
+        one, two = end, other_end
+
+    if one >= len(a) and two >= len(b):
+        return 0
+    # A remaining alphabetic segment (e.g. `1.0alpha`) is older than nothing, anything else newer
+    if (one >= len(a) and b[two] not in _LETTERS) or (one < len(a) and a[one] in _LETTERS):
+        return -1
+    return 1
@@ -0,0 +1,80 @@
+import unittest
+
+from bitman.package.vercmp import vercmp
+
+# The cases of pacman's test/util/vercmptest.sh: both versions and the expected result, every case
+# is also checked with the versions swapped
+CASES = [
+    # All similar length, no pkgrel
+    ('1.5.0', '1.5.0', 0),
+    ('1.5.1', '1.5.0', 1),
+    # Mixed length
+    ('1.5.1', '1.5', 1),
+    # With pkgrel, simple
+    ('1.5.0-1', '1.5.0-1', 0),
+    ('1.5.0-1', '1.5.0-2', -1),
+    ('1.5.0-1', '1.5.1-1', -1),
+    ('1.5.0-2', '1.5.1-1', -1),
+    # With pkgrel, mixed lengths
+    ('1.5-1', '1.5.1-1', -1),
+    ('1.5-2', '1.5.1-1', -1),
+    ('1.5-2', '1.5.1-2', -1),
+    # Mixed pkgrel inclusion
+    ('1.5', '1.5-1', 0),
+    ('1.5-1', '1.5', 0),
+    ('1.1-1', '1.1', 0),
+    ('1.0-1', '1.1', -1),
+    ('1.1-1', '1.0', 1),
+    # Alphanumeric versions
+    ('1.5b-1', '1.5-1', -1),
+    ('1.5b', '1.5', -1),
+    ('1.5b-1', '1.5', -1),
+    ('1.5b', '1.5.1', -1),
+    # From the manpage
+    ('1.0a', '1.0alpha', -1),
+    ('1.0alpha', '1.0b', -1),
+    ('1.0b', '1.0beta', -1),
+    ('1.0beta', '1.0rc', -1),
+    ('1.0rc', '1.0', -1),
+    # Alpha-dotted versions
+    ('1.5.a', '1.5', 1),
+    ('1.5.b', '1.5.a', 1),
+    ('1.5.1', '1.5.b', 1),
+    # Alpha dots and dashes
+    ('1.5.b-1', '1.5.b', 0),
+    ('1.5-1', '1.5.b', -1),
+    # Same or similar content, differing separators
+    ('2.0', '2_0', 0),
+    ('2.0_a', '2_0.a', 0),
+    ('2.0a', '2.0.a', -1),
+    ('2___a', '2_a', 1),
+    # Epoch included version comparisons
+    ('0:1.0', '0:1.0', 0),
+    ('0:1.0', '0:1.1', -1),
+    ('1:1.0', '0:1.0', 1),
+    ('1:1.0', '0:1.1', 1),
+    ('1:1.0', '2:1.1', -1),
+    # Epoch and sometimes present pkgrel
+    ('1:1.0', '0:1.0-1', 1),
+    ('1:1.0-1', '0:1.1-1', 1),
+    # Epoch included on one version
+    ('0:1.0', '1.0', 0),
+    ('0:1.1', '1.0', 1),
+    ('0:1.1', '1.1', 0),
+    ('1.0', '0:1.1', -1),
+    ('1:1.0', '1.0', 1),
+    ('1:1.1', '1.1', 1),
+    ('1:1.1', '1.11', 1),
+]
+
+
+class VercmpTest(unittest.TestCase):
+    def test_pacman_cases(self):
+        for version, other, expected in CASES:
+            with self.subTest(version=version, other=other):
+                self.assertEqual(vercmp(version, other), expected)
+                self.assertEqual(vercmp(other, version), -expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
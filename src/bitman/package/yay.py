@@ -1,37 +1,40 @@
-import subprocess
-from rich.console import Console
+from __future__ import annotations
+from functools import cached_property
+from typing import TYPE_CHECKING
 from bitman.package.package_manager import PackageManager
-from bitman.package.pacman import Pacman
+from bitman.package.pacman import Pacman, run_transaction, wait_for_pacman_lock
+from bitman.root import AlternateRootException, is_alternate_root
+from bitman.runner import command_runner
+
+if TYPE_CHECKING:
+    from rich.console import Console
 
 
 class Yay(PackageManager):
-    def __init__(self):
-        self._console = Console()
+    @cached_property
+    def _console(self) -> Console:
+        from rich.console import Console
+        return Console()
 
     def install_packages(self, packages):
+        if is_alternate_root():
+            # yay builds and checks dependencies against the host
+            raise AlternateRootException('AUR packages can\'t be installed into an alternate root')
+
         if not self._is_installed():
             self._console.print(
                 '[red]Package manager [bold]yay[/bold] is currently not installed[/red]')
             # TODO: install yay via git clone & makepkg
             raise YayNotInstalledException()
 
-        result = subprocess.run(
-            ['yay', '-S', '--noconfirm', '--needed', *packages],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        # yay only locks the database once the packages are built, it is not retried when locked
+        wait_for_pacman_lock()
+        result = command_runner().run(['yay', '-S', '--noconfirm', '--needed', *packages])
         result.check_returncode()
 
-        result = subprocess.run(
-            ['pacman', '-D', '--asexplicit', *packages],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        result.check_returncode()
+        run_transaction(['pacman', '-D', '--asexplicit', *packages])
+        # Changing the install reason doesn't run the ALPM hook which keeps the index up to date
+        Pacman().index.update(packages)
 
     def _is_installed(self) -> bool:
         pacman = Pacman()
@@ -1,20 +1,20 @@
+from __future__ import annotations
 from os.path import join
-from typing import Callable, NamedTuple
-
-from rich.console import Console
-from rich.progress import Progress, SpinnerColumn, TaskID
-from rich.table import Table
-from rich.live import Live
-from rich.panel import Panel
+from typing import TYPE_CHECKING, Callable, NamedTuple
 
 from bitman.hook import Hook
-from bitman.package.pacman import Pacman
+from bitman.package.pacman import OutdatedPackage, Pacman
 from bitman.package.yay import Yay, YayNotInstalledException
+from bitman.scheduler import Task, Scheduler
 
+if TYPE_CHECKING:
+    from rich.console import Console
 
-class TaskInfo(NamedTuple):
-    task: TaskID
-    command: Callable[[None], None]
+PACMAN_RESOURCE = 'pacman'
+REMOVE_TASK = 'remove'
+UPGRADE_TASK = 'upgrade'
+INSTALL_ARCH_TASK = 'install-arch'
+INSTALL_AUR_TASK = 'install-aur'
 
 
 class PackageSyncStatus(NamedTuple):
@@ -22,6 +22,10 @@ class PackageSyncStatus(NamedTuple):
     missing_arch: list[str]
     missing_aur: list[str]
     installed: list[str]
+    # Configured packages with a newer version in the sync databases
+    outdated: tuple[OutdatedPackage, ...] = ()
+    # Whether the sync upgrades the system to get rid of outdated packages
+    upgrade: bool = False
 
 
 class PackageSync:
@@ -35,6 +39,7 @@ class PackageSync:
 
         if len(status.additional) == 0 and len(status.missing_aur) == 0 and len(status.missing_arch) == 0:
             self._console.print('All packages are in sync', style='green')
+            self._print_outdated()
             return
 
         self._console.print('Additional', style='bold yellow')
@@ -49,15 +54,27 @@ class PackageSync:
         if len(status.missing_aur) > 0:
             self._console.print(*['[bold]·[/bold] ' + line +
                                   ' (AUR)' for line in status.missing_aur], sep='\n', highlight=False)
+        self._print_outdated()
 
     def print_summary(self) -> None:
         """Prints which changes will be made to the installed packages if sync is run"""
         status = self._status
         console = self._console
 
-        if len(status.additional) == 0 and len(status.missing_aur) == 0 and len(status.missing_arch) == 0:
+        upgrade = status.upgrade and len(status.outdated) > 0
+        if len(status.additional) == 0 and len(status.missing_aur) == 0 and len(status.missing_arch) == 0 \
+                and not upgrade:
             console.print('All packages are in sync, nothing to do', style='green')
 
+        if upgrade:
+            console.print('The system will be upgraded, updating these packages:', style='yellow')
+            console.print(*['[bold]·[/bold] ' + _outdated_line(package)
+                            for package in status.outdated], sep='\n', highlight=False)
+            console.line()
+        elif len(status.outdated) > 0:
+            console.print(f'Outdated packages: {len(status.outdated)} '
+                          '(use [bold]--upgrade[/bold] to upgrade the system)', style='yellow')
+
         if len(status.missing_arch) > 0 or len(status.missing_aur) > 0:
             console.print('The following packages will be installed:', style='yellow')
 
@@ -78,71 +95,123 @@ class PackageSync:
 
     def run(self, pacman: Pacman, yay: Yay, hooks_path: str) -> None:
         """Executes package sync"""
-        self._run_installs(pacman, yay)
-        self._run_hooks(hooks_path)
-
-    def _run_installs(self, pacman: Pacman, yay: Yay) -> None:
-        progress = Progress(
-            "{task.description}",
-            SpinnerColumn(finished_text='[green]✔')
-        )
-
-        status = self._status
-        tasks: list[TaskInfo] = []
-
-        if len(status.additional) > 0:
-            remove_task = progress.add_task('[red]Removing additional packages', total=1)
-            tasks.append(
-                TaskInfo(remove_task, lambda: pacman.remove_packages(status.additional)))
-
-        if len(status.missing_arch) > 0:
-            arch_task = progress.add_task('[yellow]Installing packages', total=1)
-            tasks.append(
-                TaskInfo(arch_task, lambda: pacman.install_packages(status.missing_arch)))
-
-        if len(status.missing_aur) > 0:
-            aur_task = progress.add_task('[yellow]Installing packages (AUR)', total=1)
-            tasks.append(TaskInfo(aur_task, lambda: yay.install_packages(status.missing_aur)))
-
-        progress_table = Table.grid()
-        progress_table.add_row(
-            Panel.fit(progress, title='[b]Tasks', border_style='red', padding=(1, 2))
-        )
-
         try:
-            with Live(progress_table, refresh_per_second=10):
-                for task in tasks:
-                    task.command()
-                    progress.advance(task.task)
+            Scheduler(self._console).run(self.tasks(pacman, yay, hooks_path))
         except YayNotInstalledException as e:
             self._console.print(
                 "Could not install AUR packages, [bold]yay[/bold] is not installed", style='red')
             raise e
 
-    def _run_hooks(self, hooks_path: str) -> None:
+    def tasks(self, pacman: Pacman, yay: Yay, hooks_path: str) -> list[Task]:
+        """
+        Returns the package sync as scheduler tasks. All tasks use the pacman database, so they
+        run one after another, but concurrently to tasks of other subsystems.
+        """
         status = self._status
-        console = self._console
+        tasks: list[Task] = []
 
-        for package in status.additional:
-            hook = Hook(join(hooks_path, package))
-            if not hook.exists():
-                continue
+        if len(status.additional) > 0:
+            tasks.append(Task(REMOVE_TASK, 'packages', '[red]Removing additional packages',
+                              lambda: pacman.remove_packages(status.additional),
+                              resource=PACMAN_RESOURCE,
+                              history_keys=_history_keys('remove', status.additional)))
+
+        if status.upgrade and len(status.outdated) > 0:
+            tasks.append(Task(UPGRADE_TASK, 'packages', '[yellow]Upgrading packages',
+                              pacman.upgrade_packages,
+                              depends_on=self._keys(tasks, REMOVE_TASK),
+                              resource=PACMAN_RESOURCE,
+                              history_keys=_history_keys(
+                                  'upgrade', [package.name for package in status.outdated])))
 
-            if not hook.is_installed():
-                console.print(f'Skipping remove hook for {package} (was not installed)')
-                continue
+        if len(status.missing_arch) > 0:
+            tasks.append(Task(INSTALL_ARCH_TASK, 'packages', '[yellow]Installing packages',
+                              lambda: pacman.install_packages(status.missing_arch),
+                              depends_on=self._keys(tasks, REMOVE_TASK, UPGRADE_TASK),
+                              resource=PACMAN_RESOURCE,
+                              history_keys=_history_keys('package', status.missing_arch)))
 
-            console.print(f'Running remove hook for {package}...')
-            hook.remove()
+        if len(status.missing_aur) > 0:
+            tasks.append(Task(INSTALL_AUR_TASK, 'packages', '[yellow]Installing packages (AUR)',
+                              lambda: yay.install_packages(status.missing_aur),
+                              depends_on=self._keys(tasks, REMOVE_TASK, UPGRADE_TASK,
+                                                    INSTALL_ARCH_TASK),
+                              resource=PACMAN_RESOURCE,
+                              history_keys=_history_keys('package', status.missing_aur)))
+
+        # Hooks run once the package transactions are done, e.g. an install hook of an installed
+        # package may use a package the sync is about to install
+        package_tasks = self._keys(tasks, REMOVE_TASK, UPGRADE_TASK, INSTALL_ARCH_TASK,
+                                   INSTALL_AUR_TASK)
+        for package in status.additional:
+            hook = Hook(join(hooks_path, package))
+            if hook.exists():
+                tasks.append(Task(f'hook-remove:{package}', 'packages',
+                                  f'Running remove hook for {package}',
+                                  self._hook_command(hook, package, remove=True),
+                                  depends_on=package_tasks,
+                                  resource=PACMAN_RESOURCE))
 
         for package in status.installed:
             hook = Hook(join(hooks_path, package))
-            if not hook.exists():
-                continue
+            if hook.exists():
+                tasks.append(Task(f'hook-install:{package}', 'packages',
+                                  f'Running install hook for {package}',
+                                  self._hook_command(hook, package, remove=False),
+                                  depends_on=package_tasks,
+                                  resource=PACMAN_RESOURCE))
+
+        return tasks
+
+    def install_task_keys(self) -> tuple[str, ...]:
+        """Returns the keys of the tasks which install packages"""
+        keys = []
+        if len(self._status.missing_arch) > 0:
+            keys.append(INSTALL_ARCH_TASK)
+        if len(self._status.missing_aur) > 0:
+            keys.append(INSTALL_AUR_TASK)
+        return tuple(keys)
+
+    def _print_outdated(self) -> None:
+        if len(self._status.outdated) > 0:
+            self._console.print('\nOutdated', style='bold yellow')
+            self._console.print(*['[bold]·[/bold] ' + _outdated_line(package)
+                                  for package in self._status.outdated], sep='\n', highlight=False)
+
+    def _keys(self, tasks: list[Task], *keys: str) -> tuple[str, ...]:
+        existing = {task.key for task in tasks}
+        return tuple(key for key in keys if key in existing)
+
+    def _hook_command(self, hook: Hook, package: str, remove: bool) -> Callable[[], None]:
+        console = self._console
+
+        def command() -> None:
+            if remove:
+                if not hook.is_installed():
+                    console.print(f'Skipping remove hook for {package} (was not installed)')
+                    return
+                console.print(f'Running remove hook for {package}...')
+                hook.remove()
+                return
 
             if hook.is_installed():
                 console.print(f'Skipping install hook for {package} (was already installed)')
-                continue
+                return
+            result = hook.install()
+            # Printed at once, so the output of concurrent tasks isn't interleaved
+            console.print(f'Ran install hook for {package}:',
+                          *[f'\t{line}' for line in [*result.stdout.splitlines(),
+                                                     *result.stderr.splitlines()]],
+                          sep='\n', markup=False, highlight=False)
+            result.check_returncode()
+
+        return command
+
+
+def _outdated_line(package: OutdatedPackage) -> str:
+    return f'{package.name} {package.installed_version} → {package.available_version}'
+
 
-            console.print(f'Running install hook for {package}...')
-            hook.install()
+def _history_keys(kind: str, packages: list[str]) -> tuple[str, ...]:
+    """A transaction's duration is recorded per package, as the next one may contain others"""
+    return tuple(f'{kind}:{package}' for package in packages)
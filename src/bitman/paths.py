@@ -0,0 +1,52 @@
+import os
+from os.path import expanduser, join
+
+from bitman.root import in_root, is_alternate_root
+
+SYSTEM_CACHE_PATH = '/var/cache/bitman'
+SYSTEM_STATE_PATH = '/var/lib/bitman'
+SYSTEM_RUNTIME_PATH = '/run/bitman'
+
+
+def cache_directory() -> str:
+    """
+    Returns the directory bitman keeps caches in. Uses the system wide cache directory if it is
+    writable and falls back to the user's cache directory otherwise.
+    """
+    return _writable_directory(
+        SYSTEM_CACHE_PATH,
+        join(os.environ.get('XDG_CACHE_HOME', expanduser('~/.cache')), 'bitman')
+    )
+
+
+def state_directory() -> str:
+    """
+    Returns the directory bitman keeps its state in. Uses the system wide state directory if it is
+    writable and falls back to the user's state directory otherwise. The state of an alternate
+    root is kept inside of it.
+    """
+    if is_alternate_root():
+        return in_root(SYSTEM_STATE_PATH)
+    return _writable_directory(
+        SYSTEM_STATE_PATH,
+        join(os.environ.get('XDG_STATE_HOME', expanduser('~/.local/state')), 'bitman')
+    )
+
+
+def _writable_directory(system_path: str, user_path: str) -> str:
+    if os.access(system_path, os.W_OK):
+        return system_path
+    if not os.path.exists(system_path) and os.access(os.path.dirname(system_path), os.W_OK):
+        return system_path
+    return user_path
+
+
+def runtime_directory() -> str:
+    """
+    Returns the directory for sockets of bitman. Uses the system wide runtime directory if it is
+    writable and falls back to the user's runtime directory otherwise.
+    """
+    return _writable_directory(
+        SYSTEM_RUNTIME_PATH,
+        join(os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}'), 'bitman')
+    )
@@ -0,0 +1,83 @@
+from __future__ import annotations
+import json
+from typing import NamedTuple
+
+from bitman.config.ufw_rule import DefaultUfwRule, UfwRule
+from bitman.package.pacman import OutdatedPackage
+from bitman.package_sync import PackageSyncStatus
+from bitman.services_sync import ServiceSyncStatus
+from bitman.ufw_sync import UfwSyncStatus
+
+PLAN_VERSION = 1
+
+
+class SyncPlan(NamedTuple):
+    """
+    The complete set of changes a sync would make, together with a fingerprint of the system state
+    it was computed from. A plan can be stored, reviewed and applied later as long as the system
+    didn't change in between.
+    """
+    fingerprint: str
+    config_commit: str | None
+    packages: PackageSyncStatus | None
+    services: ServiceSyncStatus | None
+    ufw: UfwSyncStatus | None
+    nftables: str | None
+
+    def save(self, file_path: str) -> None:
+        """Writes the plan as JSON"""
+        with open(file_path, 'wt', encoding='utf-8') as plan_file:
+            json.dump(self.to_json(), plan_file, indent=2)
+
+    @staticmethod
+    def load(file_path: str) -> SyncPlan:
+        """Reads a plan written by `save`"""
+        with open(file_path, 'rt', encoding='utf-8') as plan_file:
+            return SyncPlan.from_json(json.load(plan_file))
+
+    def to_json(self) -> dict:
+        return {
+            'version': PLAN_VERSION,
+            'fingerprint': self.fingerprint,
+            'config_commit': self.config_commit,
+            'packages': None if self.packages is None else self.packages._asdict(),
+            'services': None if self.services is None else self.services._asdict(),
+            'ufw': None if self.ufw is None else {
+                'default_rules': [[rule.type, rule.rule] for rule in self.ufw.default_rules],
+                'missing': [_ufw_rule_to_json(rule) for rule in self.ufw.missing],
+                'to_delete': [_ufw_rule_to_json(rule) for rule in self.ufw.to_delete],
+            },
+            'nftables': self.nftables,
+        }
+
+    @staticmethod
+    def from_json(data: dict) -> SyncPlan:
+        if data.get('version') != PLAN_VERSION:
+            raise SyncPlanException(f'Unsupported plan version: {data.get("version")}')
+
+        packages = data['packages']
+        ufw = data['ufw']
+        return SyncPlan(
+            data['fingerprint'],
+            data['config_commit'],
+            None if packages is None else PackageSyncStatus(**{
+                **packages,
+                'outdated': tuple(OutdatedPackage(*package)
+                                  for package in packages.get('outdated', ()))
+            }),
+            None if data['services'] is None else ServiceSyncStatus(**data['services']),
+            None if ufw is None else UfwSyncStatus(
+                [DefaultUfwRule(*rule) for rule in ufw['default_rules']],
+                [UfwRule(*rule) for rule in ufw['missing']],
+                [UfwRule(*rule) for rule in ufw['to_delete']]
+            ),
+            data['nftables']
+        )
+
+
+def _ufw_rule_to_json(rule: UfwRule) -> list:
+    return [rule.index, rule.type, rule.rule, rule.proto, rule.port, rule.from_ip]
+
+
+class SyncPlanException(BaseException):
+    pass
@@ -0,0 +1,152 @@
+import atexit
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+from subprocess import CompletedProcess
+
+from bitman.privileged import server
+
+
+class PrivilegedHelper:
+    """
+    Client of the privileged helper. The helper is started through sudo once, on first use, and
+    then executes all privileged commands of the run, so sudo (and its password prompt) is only
+    paid once. Requests may be sent from multiple threads concurrently.
+    """
+
+    def __init__(self, command: list[str] | None = None):
+        if command is None:
+            command = default_helper_command()
+        self._command = command
+        self._process: subprocess.Popen | None = None
+        self._reader: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._pending: dict[int, tuple[threading.Event, list[dict]]] = {}
+
+    def start(self) -> None:
+        """Starts the helper unless it is already running (this may prompt for the password)"""
+        with self._lock:
+            if self._process is not None:
+                return
+            self._process = subprocess.Popen(
+                self._command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                encoding='utf-8',
+                bufsize=1
+            )
+            self._reader = threading.Thread(target=self._read_responses, daemon=True)
+            self._reader.start()
+
+    def run(self, argv: list[str], input: str | None = None) -> CompletedProcess[str]:
+        """Executes an allowlisted command as root"""
+        if not server.is_allowed(argv):
+            raise PrivilegedCommandException(f'Command is not allowed: {argv}')
+        return self._request({'argv': argv, 'input': input})
+
+    def run_batch(self, commands: list[tuple[list[str], str | None]]) -> CompletedProcess[str]:
+        """
+        Executes allowlisted commands (argv and input) as root one after another in a single
+        request, until one fails. Returns the result of the failed or the last command.
+        """
+        for argv, _ in commands:
+            if not server.is_allowed(argv):
+                raise PrivilegedCommandException(f'Command is not allowed: {argv}')
+        return self._request({'batch': [{'argv': argv, 'input': input}
+                                        for argv, input in commands]})
+
+    def _request(self, request: dict) -> CompletedProcess[str]:
+        self.start()
+
+        event = threading.Event()
+        response: list[dict] = []
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = (event, response)
+            try:
+                self._process.stdin.write(json.dumps({'id': request_id, **request}) + '\n')
+                self._process.stdin.flush()
+            except OSError:
+                # The helper exited, it is started again by the next request
+                self._pending.pop(request_id)
+                raise PrivilegedHelperException('The privileged helper exited unexpectedly')
+
+        event.wait()
+        if len(response) == 0:
+            raise PrivilegedHelperException('The privileged helper exited unexpectedly')
+        return CompletedProcess(response[0].get('argv', request.get('argv')),
+                                response[0]['returncode'],
+                                response[0]['stdout'], response[0]['stderr'])
+
+    def close(self) -> None:
+        """Shuts the helper down after all running commands finished"""
+        with self._lock:
+            process = self._process
+            self._process = None
+        if process is None:
+            return
+        process.stdin.close()
+        process.wait()
+        if self._reader is not None:
+            self._reader.join()
+
+    def _read_responses(self) -> None:
+        process = self._process
+        for line in process.stdout:
+            response = json.loads(line)
+            with self._lock:
+                event, result = self._pending.pop(response['id'])
+            result.append(response)
+            event.set()
+
+        # The helper exited, wake up everyone still waiting. The next request starts it again.
+        with self._lock:
+            if self._process is process:
+                self._process = None
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for event, _ in pending:
+            event.set()
+        process.stdout.close()
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+
+
+def default_helper_command() -> list[str]:
+    """
+    Returns the command starting the helper. It can be overridden with the BITMAN_HELPER
+    environment variable, e.g. to use a fake helper which doesn't need root:
+    BITMAN_HELPER="python3 src/bitman/privileged/server.py --fake --record requests.jsonl"
+    """
+    override = os.environ.get('BITMAN_HELPER')
+    if override:
+        return shlex.split(override)
+    return ['sudo', sys.executable, os.path.abspath(server.__file__)]
+
+
+_helper: PrivilegedHelper | None = None
+
+
+def privileged_helper() -> PrivilegedHelper:
+    """Returns the helper shared by the whole process"""
+    global _helper
+    if _helper is None:
+        _helper = PrivilegedHelper()
+        atexit.register(_helper.close)
+    return _helper
+
+
+class PrivilegedCommandException(BaseException):
+    pass
+
+
+class PrivilegedHelperException(BaseException):
+    pass
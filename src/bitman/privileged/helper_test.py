@@ -0,0 +1,39 @@
+import sys
+import unittest
+
+from bitman.privileged import PrivilegedHelper, server
+
+
+class PrivilegedHelperTest(unittest.TestCase):
+    def setUp(self):
+        self._helper = PrivilegedHelper([sys.executable, server.__file__, '--fake'])
+
+    def tearDown(self):
+        self._helper.close()
+
+    def test_run(self):
+        result = self._helper.run(['systemctl', 'daemon-reload'])
+
+        self.assertEqual(result.returncode, 0)
+
+    def test_run_empty_batch(self):
+        result = self._helper.run_batch([])
+
+        self.assertEqual(result.args, [])
+        self.assertEqual(result.returncode, 0)
+
+    def test_restarts_exited_helper(self):
+        self._helper.run(['systemctl', 'daemon-reload'])
+        process = self._helper._process
+        process.kill()
+        process.wait()
+        self._helper._reader.join()
+
+        result = self._helper.run(['systemctl', 'daemon-reload'])
+
+        self.assertEqual(result.returncode, 0)
+        self.assertIsNot(self._helper._process, process)
+
+
+if __name__ == '__main__':
+    unittest.main()
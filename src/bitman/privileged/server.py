@@ -0,0 +1,269 @@
+"""
+The privileged helper of bitman. It is started once per run through sudo and executes an
+allowlisted set of commands on bitman's behalf. Requests and responses are JSON lines on
+stdin/stdout, the helper exits once stdin is closed. A request runs a single command (`argv` and
+`input`) or a `batch` of them, which stops at the first failing command.
+
+This file is executed directly as a script (sudo strips PYTHONPATH), so it must only import the
+standard library.
+"""
+import json
+import os
+import pwd
+import re
+import shutil
+import subprocess
+import sys
+import threading
+from typing import Callable
+
+SAFE_PATH = '/usr/local/sbin:/usr/local/bin:/usr/bin'
+
+# The options bitman passes to each pacman operation
+PACMAN_OPTIONS = {
+    '-S': ('--asexplicit', '--needed', '--noconfirm'),
+    '-Sy': ('--asexplicit', '--needed', '--noconfirm'),
+    '-Sw': ('--needed', '--noconfirm'),
+    '-Syw': ('--needed', '--noconfirm'),
+    '-Su': ('--noconfirm',),
+    '-R': ('--noconfirm',),
+    '-D': ('--asexplicit',),
+    '-U': ('--asexplicit', '--needed', '--noconfirm'),
+}
+PACKAGE_NAME = re.compile(r'^([a-z0-9_-]+/)?[a-zA-Z0-9@_+][a-zA-Z0-9@._+-]*$')
+SYSTEMCTL_COMMANDS = ('enable', 'disable', 'daemon-reload')
+UFW_COMMANDS = ('reload', 'enable', 'disable', 'reset', 'status', 'default', 'allow', 'deny',
+                'delete')
+CONFIG_CLONE_PATH = '/tmp/bitman/config'
+SYSTEM_CONFIG_PATH = '/etc/bitman'
+TEE_APPEND_FILES = ('/etc/fstab',)
+TEE_WRITE_FILES = ('/usr/share/libalpm/hooks/bitman-index.hook',)
+# The firewall config written into alternate roots
+ROOT_CONFIG_FILES = ('/etc/nftables.conf', '/etc/ufw/user.rules', '/etc/ufw/user6.rules',
+                     '/etc/ufw/ufw.conf', '/etc/default/ufw')
+# Directories created in a new alternate root, with their modes
+ROOT_DIRECTORIES = {
+    '/var/cache/pacman/pkg': '755',
+    '/var/lib/pacman': '755',
+    '/var/lib/pacman/sync': '755',
+    '/var/log': '755',
+    '/etc/pacman.d': '755',
+    '/dev': '755',
+    '/run': '755',
+    '/tmp': '1777',
+    '/sys': '555',
+    '/proc': '555',
+}
+PACKAGE_CACHE_PATH = '/var/cache/pacman/pkg'
+PACKAGE_FILE = re.compile(r'^[^/]+\.pkg\.tar(\.[a-z0-9]+)?(\.sig)?$')
+PACMAN_SYNC_DB_PATH = '/var/lib/pacman/sync'
+SYNC_DB_FILE = re.compile(r'^[^/]+\.db$')
+
+
+def _pacman(args: list[str]) -> bool:
+    """
+    Only the transactions bitman runs: its options, an alternate root with the host's package
+    cache and package names as targets (files of the package cache for `-U`)
+    """
+    if len(args) == 0 or args[0] not in PACMAN_OPTIONS:
+        return False
+    operation, options = args[0], PACMAN_OPTIONS[args[0]]
+    index = 1
+    while index < len(args) and args[index] in options:
+        index += 1
+    if args[index:index + 1] == ['--root']:
+        if not _alternate_root(args[index + 1:index + 2]) \
+                or args[index + 2:index + 4] != ['--cachedir', PACKAGE_CACHE_PATH]:
+            return False
+        index += 4
+
+    targets = args[index:]
+    if operation == '-Su':
+        return len(targets) == 0
+    if operation == '-U':
+        return len(targets) > 0 and all(_cached_package(target) for target in targets)
+    return len(targets) > 0 and all(PACKAGE_NAME.match(target) is not None for target in targets)
+
+
+def _alternate_root(args: list[str]) -> bool:
+    return len(args) == 1 and os.path.isabs(args[0]) and os.path.normpath(args[0]) == args[0] \
+        and args[0] != '/'
+
+
+def _in_alternate_root(path: str, file_path: str) -> bool:
+    """
+    Returns whether a path is `file_path` of an alternate root. Symlinks in the root could point
+    anywhere on the host, so they aren't followed.
+    """
+    root = path.removesuffix(file_path)
+    return root != path and _alternate_root([root]) and os.path.realpath(path) == path
+
+
+def _cached_package(file_path: str) -> bool:
+    """Returns whether a path is a package file (or its signature) directly in the package cache"""
+    return os.path.dirname(os.path.normpath(file_path)) == PACKAGE_CACHE_PATH \
+        and PACKAGE_FILE.match(os.path.basename(file_path)) is not None
+
+
+def _systemctl(args: list[str]) -> bool:
+    commands = [arg for arg in args if not arg.startswith('--')]
+    return len(commands) > 0 and commands[0] in SYSTEMCTL_COMMANDS \
+        and all(arg in ('--now', '--global')
+                or (arg.startswith('--root=') and _alternate_root([arg.removeprefix('--root=')]))
+                for arg in args if arg.startswith('--'))
+
+
+def _ufw(args: list[str]) -> bool:
+    commands = [arg for arg in args if arg != '--force']
+    return len(commands) > 0 and commands[0] in UFW_COMMANDS
+
+
+def _nft(args: list[str]) -> bool:
+    return args in (['-f', '-'], ['-c', '-f', '-'], ['-j', 'list', 'ruleset'])
+
+
+def _mv(args: list[str]) -> bool:
+    """Only a cloned config repository can be moved into place"""
+    return args == [CONFIG_CLONE_PATH, SYSTEM_CONFIG_PATH]
+
+
+def _bindfs(args: list[str]) -> bool:
+    """Only a directory can be mounted into `~/.bitman` of the user who started bitman"""
+    if len(args) != 6 or args[0] != '-u' or args[2] != '-g' or args[1] != args[3]:
+        return False
+    username = os.environ.get('SUDO_USER') or pwd.getpwuid(os.getuid()).pw_name
+    if args[1] != username:
+        return False
+    return os.path.isabs(args[4]) and os.path.normpath(args[4]) == args[4] \
+        and args[5] == os.path.join(pwd.getpwnam(username).pw_dir, '.bitman')
+
+
+def _tee(args: list[str]) -> bool:
+    return (len(args) == 2 and args[0] == '-a' and args[1] in TEE_APPEND_FILES) \
+        or (len(args) == 1 and args[0] in TEE_WRITE_FILES) \
+        or (len(args) == 1 and any(_in_alternate_root(args[0], file_path)
+                                   for file_path in ROOT_CONFIG_FILES))
+
+
+def _mkdir(args: list[str]) -> bool:
+    """Only the directories pacman needs can be created in an alternate root"""
+    return len(args) == 5 and args[:2] == ['-p', '-m'] and args[3] == '--' \
+        and any(args[2] == mode and _in_alternate_root(args[4], directory)
+                for directory, mode in ROOT_DIRECTORIES.items())
+
+
+def _cp(args: list[str]) -> bool:
+    """Only the host's sync databases can be copied into an alternate root"""
+    return len(args) > 3 and args[:2] == ['-p', '--'] \
+        and all(os.path.dirname(os.path.normpath(path)) == PACMAN_SYNC_DB_PATH
+                and SYNC_DB_FILE.match(os.path.basename(path)) is not None
+                for path in args[2:-1]) \
+        and _in_alternate_root(args[-1], PACMAN_SYNC_DB_PATH)
+
+
+def _rm(args: list[str]) -> bool:
+    """Only package files (and their signatures) directly in the package cache can be removed"""
+    return len(args) > 2 and args[:2] == ['-f', '--'] \
+        and all(_cached_package(path) for path in args[2:])
+
+
+ALLOWLIST: dict[str, Callable[[list[str]], bool]] = {
+    'pacman': _pacman,
+    'systemctl': _systemctl,
+    'ufw': _ufw,
+    'nft': _nft,
+    'mv': _mv,
+    'bindfs': _bindfs,
+    'tee': _tee,
+    'rm': _rm,
+    'mkdir': _mkdir,
+    'cp': _cp,
+}
+
+
+def is_allowed(argv: list[str]) -> bool:
+    """Returns whether the helper may execute the given command"""
+    return len(argv) > 0 and argv[0] in ALLOWLIST and ALLOWLIST[argv[0]](argv[1:])
+
+
+class HelperServer:
+    def __init__(self, fake: bool, record_path: str | None):
+        self._fake = fake
+        self._record_path = record_path
+        self._output_lock = threading.Lock()
+
+    def serve(self) -> None:
+        """Handles requests from stdin until it is closed"""
+        threads = []
+        for line in sys.stdin:
+            if line.strip() == '':
+                continue
+            thread = threading.Thread(target=self._handle, args=(json.loads(line),))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _handle(self, request: dict) -> None:
+        commands = request['batch'] if 'batch' in request else [request]
+        for command in commands:
+            if not is_allowed(command['argv']):
+                self._respond(request['id'], command['argv'], 126, '',
+                              f'bitman helper: command not allowed: {command["argv"]}')
+                return
+
+        # An empty batch succeeds without executing anything
+        argv, returncode, stdout, stderr = [], 0, '', ''
+        for command in commands:
+            argv = command['argv']
+            returncode, stdout, stderr = self._execute(request['id'], command)
+            if returncode != 0:
+                break
+        self._respond(request['id'], argv, returncode, stdout, stderr)
+
+    def _execute(self, request_id: int, command: dict) -> tuple[int, str, str]:
+        argv = command['argv']
+        if self._record_path is not None:
+            with self._output_lock, open(self._record_path, 'at', encoding='utf-8') as record:
+                record.write(json.dumps({'id': request_id, 'argv': argv,
+                                         'input': command.get('input')}) + '\n')
+
+        if self._fake:
+            return 0, '', ''
+
+        executable = shutil.which(argv[0], path=SAFE_PATH)
+        if executable is None:
+            return 127, '', f'bitman helper: {argv[0]} not found'
+
+        result = subprocess.run(
+            [executable, *argv[1:]],
+            input=command.get('input') or '',
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8',
+            check=False,
+            env={'PATH': SAFE_PATH, 'LANG': 'C.UTF-8'}
+        )
+        return result.returncode, result.stdout, result.stderr
+
+    def _respond(self, request_id: int, argv: list[str], returncode: int, stdout: str,
+                 stderr: str) -> None:
+        response = json.dumps({'id': request_id, 'argv': argv, 'returncode': returncode,
+                               'stdout': stdout, 'stderr': stderr})
+        with self._output_lock:
+            sys.stdout.write(response + '\n')
+            sys.stdout.flush()
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description='bitman privileged helper')
+    parser.add_argument('--fake', action='store_true',
+                        help='Do not execute anything, answer every allowed request with success')
+    parser.add_argument('--record', help='Append every allowed request to this file')
+    args = parser.parse_args()
+    HelperServer(args.fake, args.record).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import os
+import pwd
+import unittest
+from unittest import mock
+
+from bitman.privileged.server import is_allowed
+
+# Any user who isn't root
+USER = pwd.getpwnam('nobody')
+PACKAGE = '/var/cache/pacman/pkg/vim-9.1.0-1-x86_64.pkg.tar.zst'
+ROOT = ['--root', '/srv/images/web', '--cachedir', '/var/cache/pacman/pkg']
+
+
+class AllowlistTest(unittest.TestCase):
+    def test_pacman(self):
+        self._assert_allowed([
+            ['pacman', '-S', '--asexplicit', '--needed', '--noconfirm', 'vim', 'git'],
+            ['pacman', '-Sy', '--asexplicit', '--needed', '--noconfirm', *ROOT, 'vim'],
+            ['pacman', '-Sw', '--needed', '--noconfirm', 'vim'],
+            ['pacman', '-Syw', '--needed', '--noconfirm', *ROOT, 'vim'],
+            ['pacman', '-Su', '--noconfirm'],
+            ['pacman', '-Su', '--noconfirm', *ROOT],
+            ['pacman', '-R', '--noconfirm', 'nano'],
+            ['pacman', '-D', '--asexplicit', 'visual-studio-code-bin'],
+            ['pacman', '-U', '--asexplicit', '--needed', '--noconfirm', PACKAGE],
+            ['pacman', '-U', '--asexplicit', '--needed', '--noconfirm', *ROOT, PACKAGE],
+        ], [
+            ['pacman'],
+            ['pacman', '-Q'],
+            ['pacman', '-Rns', '--noconfirm', 'nano'],
+            ['pacman', '-S', '--noconfirm', '--config', '/tmp/pacman.conf', 'vim'],
+            ['pacman', '-S', '--noconfirm', '--dbpath', '/tmp/db', 'vim'],
+            ['pacman', '-S', '--noconfirm', '--hookdir', '/tmp/hooks', 'vim'],
+            ['pacman', '-S', '--noconfirm'],
+            ['pacman', '-S', '--noconfirm', '--overwrite=*', 'vim'],
+            ['pacman', '-Su', '--noconfirm', 'vim'],
+            ['pacman', '-U', '--noconfirm', '/tmp/evil-1-1-x86_64.pkg.tar.zst'],
+            ['pacman', '-U', '--noconfirm', '/var/cache/pacman/pkg/../../evil.pkg.tar.zst'],
+            ['pacman', '-U', '--noconfirm', 'https://example.com/evil-1-1-any.pkg.tar.zst'],
+            ['pacman', '-S', '--noconfirm', '--root', '/', '--cachedir',
+             '/var/cache/pacman/pkg', 'vim'],
+            ['pacman', '-S', '--noconfirm', '--root', 'relative', '--cachedir',
+             '/var/cache/pacman/pkg', 'vim'],
+            ['pacman', '-S', '--noconfirm', '--root', '/srv/../etc', '--cachedir',
+             '/var/cache/pacman/pkg', 'vim'],
+            ['pacman', '-S', '--noconfirm', '--root', '/srv/images/web', '--cachedir', '/tmp',
+             'vim'],
+            ['pacman', '-S', '--noconfirm', '--root', '/srv/images/web', 'vim'],
+        ])
+
+    def test_mv(self):
+        self._assert_allowed([
+            ['mv', '/tmp/bitman/config', '/etc/bitman'],
+        ], [
+            ['mv', '/tmp/bitman/config', '/etc/sudoers.d/bitman'],
+            ['mv', '/etc/shadow', '/etc/bitman'],
+            ['mv', '-f', '/tmp/bitman/config', '/etc/bitman'],
+        ])
+
+    def test_bindfs(self):
+        with mock.patch.dict(os.environ, {'SUDO_USER': USER.pw_name}):
+            self._assert_allowed([
+                ['bindfs', '-u', USER.pw_name, '-g', USER.pw_name, '/etc/bitman/user',
+                 os.path.join(USER.pw_dir, '.bitman')],
+            ], [
+                ['bindfs', '/', '/tmp/root'],
+                ['bindfs', '-u', 'root', '-g', 'root', '/etc/bitman/user',
+                 os.path.join(USER.pw_dir, '.bitman')],
+                ['bindfs', '-u', USER.pw_name, '-g', USER.pw_name, '/etc/bitman/user', '/etc'],
+                ['bindfs', '-u', USER.pw_name, '-g', USER.pw_name, 'user',
+                 os.path.join(USER.pw_dir, '.bitman')],
+                ['bindfs', '-o', 'dev', '-u', USER.pw_name, '-g', USER.pw_name,
+                 '/etc/bitman/user', os.path.join(USER.pw_dir, '.bitman')],
+            ])
+
+    def test_rm(self):
+        self._assert_allowed([
+            ['rm', '-f', '--', PACKAGE, f'{PACKAGE}.sig'],
+        ], [
+            ['rm', '-f', '--'],
+            ['rm', '-rf', '--', PACKAGE],
+            ['rm', '-f', '--', '/var/cache/pacman/pkg'],
+            ['rm', '-f', '--', '/etc/passwd'],
+            ['rm', '-f', '--', '/var/cache/pacman/pkg/../../../etc/x.pkg.tar.zst'],
+        ])
+
+    def test_alternate_root_files(self):
+        self._assert_allowed([
+            ['tee', '/srv/images/web/etc/nftables.conf'],
+            ['tee', '/srv/images/web/etc/default/ufw'],
+            ['mkdir', '-p', '-m', '1777', '--', '/srv/images/web/tmp'],
+            ['mkdir', '-p', '-m', '755', '--', '/srv/images/web/var/lib/pacman/sync'],
+            ['cp', '-p', '--', '/var/lib/pacman/sync/core.db', '/var/lib/pacman/sync/extra.db',
+             '/srv/images/web/var/lib/pacman/sync'],
+        ], [
+            ['tee', '/etc/nftables.conf'],
+            ['tee', '/srv/images/web/etc/shadow'],
+            ['tee', '/srv/../etc/nftables.conf'],
+            ['tee', '-a', '/srv/images/web/etc/nftables.conf'],
+            ['mkdir', '-p', '-m', '1777', '--', '/srv/images/web/etc'],
+            ['mkdir', '-p', '-m', '4755', '--', '/srv/images/web/tmp'],
+            ['mkdir', '-p', '-m', '755', '--', '/var/lib/pacman/sync'],
+            ['cp', '-p', '--', '/etc/shadow', '/srv/images/web/var/lib/pacman/sync'],
+            ['cp', '-p', '--', '/var/lib/pacman/sync/../../../../etc/x.db',
+             '/srv/images/web/var/lib/pacman/sync'],
+            ['cp', '-p', '--', '/var/lib/pacman/sync/core.db', '/srv/images/web/etc'],
+            ['cp', '-p', '--', '/srv/images/web/var/lib/pacman/sync'],
+        ])
+
+    def test_nft(self):
+        self._assert_allowed([
+            ['nft', '-f', '-'],
+            ['nft', '-c', '-f', '-'],
+            ['nft', '-j', 'list', 'ruleset'],
+        ], [
+            ['nft', 'flush', 'ruleset'],
+            ['nft', '-f', '/tmp/ruleset.nft'],
+            ['nft', '-c', '-f', '/tmp/ruleset.nft'],
+        ])
+
+    def test_systemctl(self):
+        self._assert_allowed([
+            ['systemctl', 'enable', '--now', 'sshd.service'],
+            ['systemctl', '--root=/srv/images/web', '--global', 'enable', 'pipewire.service'],
+            ['systemctl', 'daemon-reload'],
+        ], [
+            ['systemctl', 'start', 'sshd.service'],
+            ['systemctl', '--root=/', 'enable', 'sshd.service'],
+            ['systemctl', '--root=relative', 'enable', 'sshd.service'],
+        ])
+
+    def test_unknown_commands(self):
+        self._assert_allowed([], [[], ['sh', '-c', 'id'], ['/usr/bin/pacman', '-Su']])
+
+    def _assert_allowed(self, allowed: list[list[str]], denied: list[list[str]]) -> None:
+        for argv in allowed:
+            with self.subTest(argv=argv):
+                self.assertTrue(is_allowed(argv))
+        for argv in denied:
+            with self.subTest(argv=argv):
+                self.assertFalse(is_allowed(argv))
+
+
+if __name__ == '__main__':
+    unittest.main()
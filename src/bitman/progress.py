@@ -0,0 +1,30 @@
+from rich.progress import ProgressColumn, Task
+from rich.text import Text
+
+from bitman.history import format_duration, is_slower_than_usual
+
+
+class EstimateColumn(ProgressColumn):
+    """
+    Shows how long a task will probably take (from its `estimate` field) and warns if it takes
+    longer than usual. Finished tasks show how long they took.
+    """
+
+    def render(self, task: Task) -> Text:
+        estimate: float | None = task.fields.get('estimate')
+        if task.finished:
+            if task.finished_time is None:
+                return Text('')
+            return Text(format_duration(task.finished_time), style='dim')
+
+        elapsed = task.elapsed
+        if elapsed is None:
+            return Text('' if estimate is None else f'~{format_duration(estimate)}', style='dim')
+        if estimate is None:
+            return Text(format_duration(elapsed), style='dim')
+        if elapsed <= estimate:
+            return Text(f'{format_duration(estimate - elapsed)} left', style='cyan')
+        if is_slower_than_usual(elapsed, estimate):
+            return Text(f'{format_duration(elapsed)}, slower than usual '
+                        f'(~{format_duration(estimate)})', style='yellow')
+        return Text(f'{format_duration(elapsed)}, usually ~{format_duration(estimate)}', style='cyan')
@@ -0,0 +1,26 @@
+_interactive = True
+
+
+def set_interactive(interactive: bool) -> None:
+    """Enables or disables prompting for the rest of the process"""
+    global _interactive
+    _interactive = interactive
+
+
+def is_interactive() -> bool:
+    """Returns whether bitman may ask the user questions"""
+    return _interactive
+
+
+def confirm(question: str, non_interactive_answer: bool, default: bool = True) -> bool:
+    """
+    Asks a yes/no question. In non-interactive mode nothing is asked and `non_interactive_answer`
+    is returned instead.
+    """
+    if not _interactive:
+        return non_interactive_answer
+
+    from rich.prompt import Prompt
+    answer = Prompt.ask(question, choices=['yes', 'no'], default='yes' if default else 'no',
+                        case_sensitive=False)
+    return answer == 'yes'
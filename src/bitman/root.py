@@ -0,0 +1,34 @@
+import os
+from os.path import abspath, join
+
+# Environment variable telling hooks which root they provision
+ROOT_ENVIRONMENT_VARIABLE = 'BITMAN_ROOT'
+
+_root = '/'
+
+
+def target_root() -> str:
+    """Returns the root directory of the system bitman provisions, `/` for the live host"""
+    return _root
+
+
+def set_target_root(root: str) -> None:
+    """Provisions the system below another root directory instead of the live host"""
+    global _root
+    _root = abspath(root)
+    os.environ[ROOT_ENVIRONMENT_VARIABLE] = _root
+
+
+def is_alternate_root() -> bool:
+    """Returns whether bitman provisions an alternate root instead of the live host"""
+    return _root != '/'
+
+
+def in_root(file_path: str, root: str | None = None) -> str:
+    """Returns where an absolute path of the target system (or of `root`) is found from the host"""
+    root = _root if root is None else root
+    return file_path if root == '/' else join(root, file_path.lstrip('/'))
+
+
+class AlternateRootException(BaseException):
+    pass
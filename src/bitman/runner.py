@@ -0,0 +1,199 @@
+import json
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from subprocess import CompletedProcess
+
+from bitman.privileged import privileged_helper
+from bitman.trace import span
+
+
+class CommandRunner(ABC):
+    """Executes the external commands of bitman, every module runs its commands through it"""
+
+    @abstractmethod
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        """
+        Runs a command and returns its result without checking the return code. Privileged
+        commands are executed by the privileged helper, interactive commands write directly to the
+        terminal instead of capturing their output.
+        """
+
+    def run_batch(self,
+                  commands: list[tuple[list[str], str | None]],
+                  privileged: bool = False) -> CompletedProcess[str]:
+        """
+        Runs commands (argv and input) one after another until one fails. Returns the result of
+        the failed or the last command. Privileged batches are sent to the helper at once.
+        """
+        result = CompletedProcess([], 0, '', '')
+        for argv, input in commands:
+            result = self.run(argv, input, privileged=privileged)
+            if result.returncode != 0:
+                break
+        return result
+
+    def authenticate(self) -> None:
+        """Makes sure privileged commands can run without prompting for a password later on"""
+
+
+class LiveCommandRunner(CommandRunner):
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        if privileged:
+            return privileged_helper().run(argv, input=input)
+
+        return subprocess.run(
+            argv,
+            input=input,
+            stdout=None if interactive else subprocess.PIPE,
+            stderr=None if interactive else subprocess.PIPE,
+            encoding='utf-8',
+            check=False,
+            cwd=cwd
+        )
+
+    def run_batch(self,
+                  commands: list[tuple[list[str], str | None]],
+                  privileged: bool = False) -> CompletedProcess[str]:
+        if privileged:
+            return privileged_helper().run_batch(commands)
+        return super().run_batch(commands, privileged)
+
+    def authenticate(self) -> None:
+        privileged_helper().start()
+
+
+class RecordingCommandRunner(CommandRunner):
+    """Runs commands live and appends every command with its output and duration to a fixture"""
+
+    def __init__(self, fixture_path: str, runner: CommandRunner | None = None):
+        self._fixture_path = fixture_path
+        self._runner = runner if runner is not None else LiveCommandRunner()
+        self._lock = threading.Lock()
+
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        start = time.perf_counter()
+        result = self._runner.run(argv, input, cwd, privileged, interactive)
+        duration = time.perf_counter() - start
+
+        entry = {
+            'argv': argv,
+            'input': input,
+            'cwd': cwd,
+            'privileged': privileged,
+            'returncode': result.returncode,
+            'stdout': result.stdout,
+            'stderr': result.stderr,
+            'duration': round(duration, 6),
+        }
+        with self._lock, open(self._fixture_path, 'at', encoding='utf-8') as fixture:
+            fixture.write(json.dumps(entry) + '\n')
+        return result
+
+    def authenticate(self) -> None:
+        self._runner.authenticate()
+
+
+class TracingCommandRunner(CommandRunner):
+    """Records every command of another runner as a span of the trace"""
+
+    def __init__(self, runner: CommandRunner):
+        self._runner = runner
+
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        with span(' '.join(argv[:2]), 'command', argv=argv, privileged=privileged) as args:
+            result = self._runner.run(argv, input, cwd, privileged, interactive)
+            args['returncode'] = result.returncode
+        return result
+
+    def run_batch(self,
+                  commands: list[tuple[list[str], str | None]],
+                  privileged: bool = False) -> CompletedProcess[str]:
+        with span(f'batch of {len(commands)} commands', 'command',
+                  argvs=[argv for argv, _ in commands], privileged=privileged) as args:
+            result = self._runner.run_batch(commands, privileged)
+            args['returncode'] = result.returncode
+        return result
+
+    def authenticate(self) -> None:
+        with span('authenticate', 'command'):
+            self._runner.authenticate()
+
+
+class ReplayCommandRunner(CommandRunner):
+    """
+    Serves commands from a fixture written by `RecordingCommandRunner` without executing anything.
+    Identical commands are answered in recording order, once exhausted the last answer is
+    repeated. With `realtime` every command takes as long as it did when it was recorded.
+    """
+
+    def __init__(self, fixture_path: str, realtime: bool = False):
+        self._realtime = realtime
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, list[dict]] = {}
+        with open(fixture_path, 'rt', encoding='utf-8') as fixture:
+            for line in fixture:
+                if line.strip() == '':
+                    continue
+                entry = json.loads(line)
+                key = _key(entry['argv'], entry['input'], entry['cwd'], entry['privileged'])
+                self._entries.setdefault(key, []).append(entry)
+
+    def run(self,
+            argv: list[str],
+            input: str | None = None,
+            cwd: str | None = None,
+            privileged: bool = False,
+            interactive: bool = False) -> CompletedProcess[str]:
+        with self._lock:
+            entries = self._entries.get(_key(argv, input, cwd, privileged))
+            if not entries:
+                raise CommandNotRecordedException(f'Command was not recorded: {argv}')
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+
+        if self._realtime:
+            time.sleep(entry['duration'])
+        return CompletedProcess(argv, entry['returncode'], entry['stdout'], entry['stderr'])
+
+
+def _key(argv: list[str], input: str | None, cwd: str | None, privileged: bool) -> tuple:
+    return (tuple(argv), input, cwd, privileged)
+
+
+_runner: CommandRunner = LiveCommandRunner()
+
+
+def command_runner() -> CommandRunner:
+    """Returns the runner used by the whole process"""
+    return _runner
+
+
+def set_command_runner(runner: CommandRunner) -> None:
+    """Replaces the runner used by the whole process, e.g. to record or replay a run"""
+    global _runner
+    _runner = runner
+
+
+class CommandNotRecordedException(BaseException):
+    pass
@@ -0,0 +1,198 @@
+from __future__ import annotations
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable, NamedTuple
+
+from bitman.trace import span
+
+if TYPE_CHECKING:
+    from rich.console import Console
+    from rich.progress import Progress, TaskID
+    from bitman.history import DurationHistory
+
+# The progress row of the task running on a worker thread
+_current = threading.local()
+
+LANE_TITLES = {
+    'packages': '[b]Packages',
+    'services': '[b]Services',
+    'firewall': '[b]Firewall',
+}
+
+
+class Task(NamedTuple):
+    key: str
+    lane: str
+    description: str
+    command: Callable[[], None]
+    depends_on: tuple[str, ...] = ()
+    # Tasks using the same resource (e.g. the pacman database) never run concurrently
+    resource: str | None = None
+    # Keys the duration is recorded under in the history, defaults to the task's key
+    history_keys: tuple[str, ...] | None = None
+
+    def duration_keys(self) -> tuple[str, ...]:
+        return (self.key,) if self.history_keys is None else self.history_keys
+
+
+class Scheduler:
+    """
+    Runs tasks concurrently while respecting their dependencies and resources. Every lane is shown
+    as its own panel of the progress table. With a history, tasks show how long they usually take
+    and their durations are recorded.
+    """
+
+    def __init__(self,
+                 console: Console,
+                 max_workers: int = 4,
+                 completed: set[str] | None = None,
+                 on_complete: Callable[[str], None] | None = None,
+                 history: DurationHistory | None = None):
+        self._console = console
+        self._max_workers = max_workers
+        # Tasks completed by an earlier run are skipped, tasks depending on them run right away
+        self.completed: set[str] = set() if completed is None else set(completed)
+        self._on_complete = on_complete
+        self._history = history
+
+    def run(self, tasks: list[Task]) -> None:
+        """Runs all tasks, raises the first error after all running tasks finished"""
+        if len(tasks) == 0:
+            return
+
+        known = {task.key for task in tasks}.union(self.completed)
+        for task in tasks:
+            for dependency in task.depends_on:
+                if dependency not in known:
+                    raise SchedulerException(f'{task.key} depends on unknown task {dependency}')
+
+        from rich.live import Live
+        from rich.panel import Panel
+        from rich.progress import Progress, SpinnerColumn
+        from rich.table import Table
+        from bitman.progress import EstimateColumn
+
+        lanes: dict[str, Progress] = {}
+        progress_tasks: dict[str, tuple[Progress, TaskID]] = {}
+        for task in tasks:
+            if task.lane not in lanes:
+                lanes[task.lane] = Progress(
+                    "{task.description}",
+                    SpinnerColumn(finished_text='[green]✔'),
+                    EstimateColumn()
+                )
+            progress = lanes[task.lane]
+            estimate = None
+            if self._history is not None:
+                estimate = self._history.estimate(task.duration_keys())
+            progress_tasks[task.key] = (progress, progress.add_task(
+                task.description, start=False, total=1, completed=int(task.key in self.completed),
+                estimate=estimate))
+
+        progress_table = Table.grid()
+        progress_table.add_row(*[
+            Panel.fit(progress, title=LANE_TITLES.get(lane, f'[b]{lane}'), border_style='red',
+                      padding=(1, 2))
+            for lane, progress in lanes.items()
+        ])
+
+        pending = [task for task in tasks if task.key not in self.completed]
+        try:
+            with Live(progress_table, console=self._console, refresh_per_second=10), \
+                    ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                error = self._run_pending(pending, progress_tasks, executor)
+        finally:
+            if self._history is not None:
+                self._history.save()
+
+        if error is not None:
+            raise error
+
+    def _run_pending(self,
+                     pending: list[Task],
+                     progress_tasks: dict[str, tuple[Progress, TaskID]],
+                     executor: ThreadPoolExecutor) -> BaseException | None:
+        """Runs the pending tasks and returns the first error once all running tasks finished"""
+        running: dict[Future, Task] = {}
+        busy_resources: set[str] = set()
+        error: BaseException | None = None
+
+        while len(pending) > 0 or len(running) > 0:
+            if error is None:
+                for task in [task for task in pending if self._is_ready(task, busy_resources)]:
+                    if task.resource is not None:
+                        if task.resource in busy_resources:
+                            continue
+                        busy_resources.add(task.resource)
+                    pending.remove(task)
+                    progress, progress_task = progress_tasks[task.key]
+                    progress.start_task(progress_task)
+                    running[executor.submit(self._traced, task, progress, progress_task)] = task
+            else:
+                pending.clear()
+
+            if len(running) == 0:
+                if len(pending) > 0:
+                    raise SchedulerException('Circular task dependencies')
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                progress, progress_task = progress_tasks[task.key]
+                if task.resource is not None:
+                    busy_resources.discard(task.resource)
+                try:
+                    duration = future.result()
+                except BaseException as e:  # pylint: disable=broad-exception-caught
+                    progress.stop_task(progress_task)
+                    progress.update(progress_task, description=f'[red]{task.description}')
+                    if error is None:
+                        error = e
+                    continue
+                self.completed.add(task.key)
+                if self._on_complete is not None:
+                    self._on_complete(task.key)
+                if self._history is not None:
+                    self._history.record(task.duration_keys(), duration)
+                progress.advance(progress_task)
+
+        return error
+
+    def _traced(self, task: Task, progress: Progress, progress_task: TaskID) -> float:
+        """Runs a task and returns how many seconds it took"""
+        def show_status(status: str | None) -> None:
+            description = task.description if status is None \
+                else f'{task.description} [dim]({status})'
+            progress.update(progress_task, description=description)
+
+        start = time.perf_counter()
+        _current.show_status = show_status
+        try:
+            with span(task.description, 'task', key=task.key, lane=task.lane):
+                task.command()
+        finally:
+            _current.show_status = None
+            show_status(None)
+        return time.perf_counter() - start
+
+    def _is_ready(self, task: Task, busy_resources: set[str]) -> bool:
+        return all(dependency in self.completed for dependency in task.depends_on) \
+            and (task.resource is None or task.resource not in busy_resources)
+
+
+def show_task_status(status: str | None) -> bool:
+    """
+    Shows a status (e.g. what the task waits for) next to the task running on the current thread,
+    None removes it. Returns False if the thread doesn't run a task.
+    """
+    show_status = getattr(_current, 'show_status', None)
+    if show_status is None:
+        return False
+    show_status(status)
+    return True
+
+
+class SchedulerException(BaseException):
+    pass
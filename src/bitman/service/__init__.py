@@ -1,38 +1,42 @@
-import subprocess
+from subprocess import CompletedProcess
+from os.path import expanduser, isfile, join
+
+from bitman.root import in_root, is_alternate_root, target_root
+from bitman.runner import command_runner
+
+SYSTEM_UNIT_PATHS = ['/etc/systemd/system', '/run/systemd/system', '/usr/lib/systemd/system']
+USER_UNIT_PATHS = ['~/.config/systemd/user', '/etc/systemd/user', '/usr/lib/systemd/user']
+# User units of an alternate root are enabled for all users (systemctl --global)
+GLOBAL_USER_UNIT_PATHS = ['/etc/systemd/user', '/usr/lib/systemd/user']
 
 
 class Systemd:
+    def unit_exists(self, service: str, user: bool = False) -> bool:
+        """Returns whether the unit file of a service is installed, without asking systemd"""
+        unit = service if '.' in service else f'{service}.service'
+        if '@' in unit:
+            # Instances of template units are defined by the template file
+            name, suffix = unit.split('@', 1)
+            unit = f'{name}@.{suffix.rsplit(".", 1)[-1]}'
+        if user:
+            unit_paths = GLOBAL_USER_UNIT_PATHS if is_alternate_root() else USER_UNIT_PATHS
+        else:
+            unit_paths = SYSTEM_UNIT_PATHS
+        return any(isfile(join(in_root(expanduser(unit_path)), unit)) for unit_path in unit_paths)
+
     def service_enabled(self, service: str, user: bool = False) -> bool:
-        result = subprocess.run(
-            filter(None, ['systemctl', '--user' if user else '', 'is-enabled', service]),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run([*self._systemctl_command(user), 'is-enabled', service])
         if result.returncode != 0 and result.stderr:
             result.check_returncode()
         return result.stdout.startswith('enabled')
 
     def service_running(self, service: str, user: bool = False) -> bool:
-        result = subprocess.run(
-            filter(None, ['systemctl', '--user' if user else '', 'is-active', '--quiet', service]),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(
+            [*self._systemctl_command(user), 'is-active', '--quiet', service])
         return result.returncode == 0
 
     def enable_service(self, service: str, now: bool = False, user: bool = False) -> None:
-        result = subprocess.run(
-            filter(None, ['sudo' if not user else '', 'systemctl', '--user' if user else '',
-                   'enable', '--now' if now else '', service]),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = self._systemctl(['enable', '--now' if now else '', service], user)
         try:
             result.check_returncode()
         except Exception as e:
@@ -41,23 +45,27 @@ class Systemd:
             print(result.stderr)
 
     def disable_service(self, service: str, now: bool = False, user: bool = False) -> None:
-        result = subprocess.run(
-            filter(None, ['sudo' if not user else '', 'systemctl', '--user' if user else '',
-                   'disable', '--now' if now else '', service]),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = self._systemctl(['disable', '--now' if now else '', service], user)
         result.check_returncode()
 
     def reload_daemon(self, user: bool = False) -> None:
-        result = subprocess.run(
-            filter(None, ['sudo' if not user else '', 'systemctl', '--user' if user else '',
-                   'daemon-reload']),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        if is_alternate_root():
+            # Units of an alternate root are only read from disk, there is no daemon to reload
+            return
+        result = self._systemctl(['daemon-reload'], user)
         result.check_returncode()
+
+    def _systemctl(self, args: list[str], user: bool) -> CompletedProcess[str]:
+        """Runs a modifying systemctl command, system units are changed through the helper"""
+        args = [arg for arg in args if arg != '']
+        if is_alternate_root():
+            # Units of an alternate root can't be started, only enabled
+            args = [arg for arg in args if arg != '--now']
+        if not user or is_alternate_root():
+            return command_runner().run([*self._systemctl_command(user), *args], privileged=True)
+        return command_runner().run([*self._systemctl_command(user), *args])
+
+    def _systemctl_command(self, user: bool) -> list[str]:
+        if is_alternate_root():
+            return ['systemctl', f'--root={target_root()}', *(['--global'] if user else [])]
+        return ['systemctl', '--user'] if user else ['systemctl']
@@ -1,9 +1,15 @@
-from typing import NamedTuple
-from rich.console import Console
+from __future__ import annotations
+from typing import TYPE_CHECKING, NamedTuple
 
 from bitman.config.system_config import SystemConfig
+from bitman.scheduler import Scheduler, Task
 from bitman.service import Systemd
 
+if TYPE_CHECKING:
+    from rich.console import Console
+
+SYSTEMD_RESOURCE = 'systemd'
+
 
 class ServiceSyncStatus(NamedTuple):
     system_to_disable: list[str]
@@ -75,24 +81,45 @@ class ServicesSync:
 
     def run(self, systemd: Systemd) -> None:
         """Enables and disables services to make them match the configuration"""
+        Scheduler(self._console).run(self.tasks(systemd))
+
+    def tasks(self, systemd: Systemd, install_task_keys: tuple[str, ...] = ()) -> list[Task]:
+        """
+        Returns the service changes as scheduler tasks. Services whose unit isn't installed yet
+        wait for the given package install tasks.
+        """
         status = self._status
+        tasks: list[Task] = []
 
         for service in status.system_to_enable:
-            self._console.print(f'Enabling {service}...', end='')
-            systemd.enable_service(service)
-            self._console.print(' Done!')
+            tasks.append(Task(f'enable:{service}', 'services', f'Enabling {service}',
+                              lambda service=service: systemd.enable_service(service),
+                              self._dependencies(systemd, service, False, install_task_keys),
+                              SYSTEMD_RESOURCE))
 
         for service in status.user_to_enable:
-            self._console.print(f'Enabling {service}...', end='')
-            systemd.enable_service(service, user=True)
-            self._console.print(' Done!')
+            tasks.append(Task(f'enable-user:{service}', 'services', f'Enabling {service} (user)',
+                              lambda service=service: systemd.enable_service(service, user=True),
+                              self._dependencies(systemd, service, True, install_task_keys),
+                              SYSTEMD_RESOURCE))
 
         for service in status.system_to_disable:
-            self._console.print(f'Disbling {service}...', end='')
-            systemd.disable_service(service)
-            self._console.print(' Done!')
+            tasks.append(Task(f'disable:{service}', 'services', f'Disabling {service}',
+                              lambda service=service: systemd.disable_service(service),
+                              resource=SYSTEMD_RESOURCE))
 
         for service in status.user_to_disable:
-            self._console.print(f'Disbling {service}...', end='')
-            systemd.disable_service(service, user=True)
-            self._console.print(' Done!')
+            tasks.append(Task(f'disable-user:{service}', 'services', f'Disabling {service} (user)',
+                              lambda service=service: systemd.disable_service(service, user=True),
+                              resource=SYSTEMD_RESOURCE))
+
+        return tasks
+
+    def _dependencies(self,
+                      systemd: Systemd,
+                      service: str,
+                      user: bool,
+                      install_task_keys: tuple[str, ...]) -> tuple[str, ...]:
+        if systemd.unit_exists(service, user=user):
+            return ()
+        return install_task_keys
@@ -1,88 +1,125 @@
-
+from __future__ import annotations
 import getpass
 import os
+from functools import cached_property
+from os.path import dirname, islink, join, lexists, normpath
 from pathlib import Path
-import subprocess
-from os.path import join
+from typing import TYPE_CHECKING, NamedTuple
 
 from bitman.config.system_config import SystemConfig
-from bitman.service import Systemd
+from bitman.mounts import FSTAB_PATH, FstabEntry, fstab_entries, fstab_line, mounts
+from bitman.runner import command_runner
+
+if TYPE_CHECKING:
+    from rich.console import Console
+
+BINDFS_TYPES = ('fuse', 'fuse.bindfs')
+
+
+class SetupPlan(NamedTuple):
+    """Everything missing or wrong in the setup of a user"""
+    fstab_entry: FstabEntry | None
+    # The bindfs mount, if it isn't mounted yet
+    mount: FstabEntry | None
+    # Symlinks to create (or replace) with their targets
+    symlinks: list[tuple[str, str]]
+    # Paths which should be symlinks, but are files or directories of the user
+    conflicts: list[str]
+    # Another fstab entry for the mount point, which isn't changed
+    fstab_conflict: FstabEntry | None
+
+    def is_empty(self) -> bool:
+        return self.fstab_entry is None and self.mount is None and len(self.symlinks) == 0
 
 
 class Setup:
-    def __init__(self, system_config: SystemConfig, systemd: Systemd):
+    """
+    Sets up a user: mounts the user files of the config into `~/.bitman` with bindfs (owned by
+    the user) and symlinks the configured files into the home directory. The mounts and existing
+    symlinks are read without running any command, all changes are computed up front and the
+    privileged ones are applied in a single batch.
+    """
+
+    def __init__(self, system_config: SystemConfig):
         self._system_config = system_config
-        self._systemd = systemd
+
+    @cached_property
+    def _console(self) -> Console:
+        from rich.console import Console
+        return Console()
 
     def run(self) -> None:
-        """
-        Creates symlinks and bindfs for the current user to use bitman
-        """
-
-        bitman_user_directory = self._system_config.user_config_directory
-        user_home = Path.home()
-        user_local_bitman_directory = join(user_home, '.bitman')
-        username = getpass.getuser()
-
-        print("Setup")
-        print(f"Bitman user directory: {bitman_user_directory}")
-        print(f"User home: {user_home}")
-        print(f"User local bitman directory: {user_local_bitman_directory}")
-        print(f"Username: {username}")
-
-        if not self._bind_mount_exists(user_local_bitman_directory):
-            print("bindfs already exists, skipping")
-            self._extend_fstab(bitman_user_directory, user_local_bitman_directory, username)
-            self._mount_bindfs(bitman_user_directory, user_local_bitman_directory, username)
-
-        self._create_symlinks(user_local_bitman_directory, user_home)
-
-    def _extend_fstab(self, system_bitman_directory: str, user_bitman_directory: str, username: str) -> None:
-        result = subprocess.run(
-            f'sudo sh -c "echo \'{system_bitman_directory}\t{user_bitman_directory}\tfuse.bindfs\tforce-user={username},force-group={username}\t0\t2\' >> /etc/fstab"',
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False,
-            shell=True,
-            executable='/bin/bash'
-        )
-        result.check_returncode()
-
-        self._systemd.reload_daemon()
-
-    def _bind_mount_exists(self, user_bitman_directory: str) -> bool:
-        result = subprocess.run(
-            ['mount'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        result.check_returncode()
-
-        return user_bitman_directory in result.stdout
-
-    def _mount_bindfs(self, system_bitman_directory: str, user_bitman_directory: str, username: str) -> None:
-        result = subprocess.run(
-            ['sudo', 'bindfs', '-u', username, '-g', username,
-                system_bitman_directory, user_bitman_directory],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
-        result.check_returncode()
-
-    def _create_symlinks(self, user_bitman_directory: str, user_home_directory: str) -> None:
-        symlinks = self._system_config.symlinks()
-        for symlink in symlinks:
+        """Creates the missing mount and symlinks for the current user"""
+        plan = self.plan(str(Path.home()), getpass.getuser())
+        if plan.fstab_conflict is not None:
+            self._console.print(
+                f'{FSTAB_PATH} already mounts [bold]{plan.fstab_conflict.source}[/bold] to '
+                f'{plan.fstab_conflict.mount_point}, it is left unchanged', style='yellow')
+        for conflict in plan.conflicts:
+            self._console.print(f'[bold]{conflict}[/bold] exists and is not a symlink, skipping',
+                                style='yellow')
+        if plan.is_empty():
+            self._console.print('Everything is set up, nothing to do', style='green')
+            return
+        self.apply(plan, getpass.getuser())
+
+    def plan(self, home_directory: str, username: str) -> SetupPlan:
+        """Computes which mount and symlinks are missing or wrong"""
+        system_directory = normpath(self._system_config.user_config_directory)
+        user_directory = join(home_directory, '.bitman')
+
+        fstab_entry = None
+        fstab_conflict = None
+        entry = FstabEntry(system_directory, user_directory, 'fuse.bindfs',
+                           f'force-user={username},force-group={username}')
+        existing = [fstab_entry for fstab_entry in fstab_entries()
+                    if fstab_entry.mount_point == user_directory]
+        if len(existing) == 0:
+            fstab_entry = entry
+        elif all(existing_entry.source != system_directory
+                 or existing_entry.fs_type not in BINDFS_TYPES for existing_entry in existing):
+            fstab_conflict = existing[0]
+
+        mount = mounts().get(user_directory)
+        mounted = mount is not None and mount.fs_type in BINDFS_TYPES
+
+        symlinks = []
+        conflicts = []
+        for symlink in self._system_config.symlinks():
             symlink = symlink.removesuffix('/')
-
-            target_path = join(user_home_directory, symlink)
-            if os.path.islink(target_path):
-                print(f'Skipping {symlink}...')
-                continue
-
-            print(f'Symlinking {symlink}...')
-            os.symlink(join(user_bitman_directory, symlink), target_path)
+            link_path = join(home_directory, symlink)
+            target = join(user_directory, symlink)
+            if islink(link_path):
+                if os.readlink(link_path) != target:
+                    symlinks.append((link_path, target))
+            elif lexists(link_path):
+                conflicts.append(link_path)
+            else:
+                symlinks.append((link_path, target))
+
+        return SetupPlan(fstab_entry, None if mounted else entry, symlinks, conflicts,
+                         fstab_conflict)
+
+    def apply(self, plan: SetupPlan, username: str) -> None:
+        """Applies a plan, all privileged changes are sent to the helper at once"""
+        commands: list[tuple[list[str], str | None]] = []
+        if plan.fstab_entry is not None:
+            self._console.print(f'Adding {plan.fstab_entry.mount_point} to {FSTAB_PATH}')
+            commands.append((['tee', '-a', FSTAB_PATH], fstab_line(plan.fstab_entry)))
+            # systemd generates mount units from fstab
+            commands.append((['systemctl', 'daemon-reload'], None))
+        if plan.mount is not None:
+            self._console.print(f'Mounting {plan.mount.source} to {plan.mount.mount_point}')
+            os.makedirs(plan.mount.mount_point, exist_ok=True)
+            commands.append((['bindfs', '-u', username, '-g', username,
+                              plan.mount.source, plan.mount.mount_point], None))
+        if len(commands) > 0:
+            command_runner().run_batch(commands, privileged=True).check_returncode()
+
+        for link_path, target in plan.symlinks:
+            self._console.print(f'Symlinking {link_path}')
+            os.makedirs(dirname(link_path), exist_ok=True)
+            # A wrong symlink is replaced atomically
+            temp_path = f'{link_path}.{os.getpid()}.tmp'
+            os.symlink(target, temp_path)
+            os.replace(temp_path, link_path)
@@ -0,0 +1,67 @@
+import json
+import os
+from os.path import join
+from typing import Iterable, Literal
+
+Subsystem = Literal['packages', 'services', 'ufw']
+
+
+class SyncState:
+    """Persistent bookkeeping of past syncs (e.g. the config commit last applied per subsystem)"""
+
+    def __init__(self, directory: str):
+        self._path = join(directory, 'state.json')
+        self._state: dict | None = None
+
+    def applied_commit(self, subsystem: Subsystem) -> str | None:
+        """Returns the config commit the subsystem was last synced successfully with"""
+        return self._data().get('applied_commits', {}).get(subsystem)
+
+    def set_applied_commit(self, subsystem: Subsystem, commit: str) -> None:
+        """Records the config commit the subsystem was synced successfully with"""
+        self._data().setdefault('applied_commits', {})[subsystem] = commit
+        self._save()
+
+    def synced_fingerprint(self, subsystem: Subsystem) -> str | None:
+        """Returns the sync fingerprint recorded after the subsystem was last fully synced"""
+        return self._data().get('synced_fingerprints', {}).get(subsystem)
+
+    def set_synced_fingerprint(self, subsystems: list[Subsystem], fingerprint: str) -> None:
+        """Records the sync fingerprint after the subsystems were fully synced"""
+        for subsystem in subsystems:
+            self._data().setdefault('synced_fingerprints', {})[subsystem] = fingerprint
+        self._save()
+
+    def outdated_packages(self) -> list[list[str]] | None:
+        """
+        Returns the outdated packages (name and versions) since the last full sync, None if they
+        weren't looked up yet
+        """
+        return self._data().get('outdated_packages')
+
+    def set_outdated_packages(self, packages: Iterable[tuple[str, str, str]] | None) -> None:
+        """
+        Records the outdated packages since a full sync, they don't change with the fingerprint.
+        None marks them as unknown.
+        """
+        if packages is None:
+            self._data().pop('outdated_packages', None)
+        else:
+            self._data()['outdated_packages'] = [list(package) for package in packages]
+        self._save()
+
+    def _data(self) -> dict:
+        if self._state is None:
+            try:
+                with open(self._path, 'rt', encoding='utf-8') as state_file:
+                    self._state = json.load(state_file)
+            except (IOError, ValueError):
+                self._state = {}
+        return self._state
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        temp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wt', encoding='utf-8') as state_file:
+            json.dump(self._state, state_file, indent=2)
+        os.replace(temp_path, self._path)
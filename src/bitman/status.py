@@ -0,0 +1,101 @@
+import time
+from contextlib import contextmanager
+from typing import Generator, Literal, NamedTuple
+
+from bitman.config.ufw_rule import UfwRule
+from bitman.nft.ruleset import NftRulesetDiff
+from bitman.package_sync import PackageSyncStatus
+from bitman.services_sync import ServiceSyncStatus
+from bitman.trace import span
+from bitman.ufw_sync import UfwSyncStatus
+
+
+class StatusReport(NamedTuple):
+    """The drift of every subsystem from the config, computed without printing or prompting"""
+    packages: PackageSyncStatus | None
+    services: ServiceSyncStatus | None
+    firewall_backend: Literal['ufw', 'nftables'] | None
+    # None if the firewall wasn't checked or UFW is disabled and couldn't be queried
+    ufw: UfwSyncStatus | None
+    nftables: NftRulesetDiff | None
+    durations: dict[str, float]
+
+    def firewall_available(self) -> bool:
+        """Returns whether the firewall state could be queried"""
+        return self.ufw is not None or self.nftables is not None
+
+    def drift(self) -> dict[tuple[str, str], int]:
+        """Returns the number of differences per subsystem and kind"""
+        drift: dict[tuple[str, str], int] = {}
+        if self.packages is not None:
+            drift[('packages', 'additional')] = len(self.packages.additional)
+            drift[('packages', 'missing_arch')] = len(self.packages.missing_arch)
+            drift[('packages', 'missing_aur')] = len(self.packages.missing_aur)
+            drift[('packages', 'outdated')] = len(self.packages.outdated)
+        if self.services is not None:
+            for kind, services in self.services._asdict().items():
+                drift[('services', kind)] = len(services)
+        if self.ufw is not None:
+            drift[('firewall', 'default_rules')] = len(self.ufw.default_rules)
+            drift[('firewall', 'missing')] = len(self.ufw.missing)
+            drift[('firewall', 'to_delete')] = len(self.ufw.to_delete)
+        if self.nftables is not None:
+            drift[('firewall', 'table_missing')] = int(self.nftables.table_missing)
+            drift[('firewall', 'policies')] = len(self.nftables.policies)
+            drift[('firewall', 'set_elements')] = sum(
+                len(set_diff.added) + len(set_diff.removed) for set_diff in self.nftables.sets)
+            drift[('firewall', 'rules_changed')] = int(self.nftables.rules_changed)
+        return drift
+
+    def to_json(self) -> dict:
+        totals: dict[str, int] = {}
+        for (subsystem, _), count in self.drift().items():
+            totals[subsystem] = totals.get(subsystem, 0) + count
+
+        firewall = None
+        if self.firewall_backend is not None:
+            firewall = {'backend': self.firewall_backend, 'available': self.firewall_available()}
+            if self.ufw is not None:
+                firewall['default_rules'] = [
+                    {'type': rule.type, 'rule': rule.rule} for rule in self.ufw.default_rules]
+                firewall['missing'] = [_ufw_rule_to_json(rule) for rule in self.ufw.missing]
+                firewall['to_delete'] = [_ufw_rule_to_json(rule) for rule in self.ufw.to_delete]
+            if self.nftables is not None:
+                firewall['table_missing'] = self.nftables.table_missing
+                firewall['policies'] = self.nftables.policies
+                firewall['sets'] = [set_diff._asdict() for set_diff in self.nftables.sets]
+                firewall['rules_changed'] = self.nftables.rules_changed
+
+        return {
+            'packages': None if self.packages is None else {
+                'additional': sorted(self.packages.additional),
+                'missing_arch': sorted(self.packages.missing_arch),
+                'missing_aur': sorted(self.packages.missing_aur),
+                'outdated': [package._asdict() for package in self.packages.outdated],
+            },
+            'services': None if self.services is None else self.services._asdict(),
+            'firewall': firewall,
+            'drift': totals,
+            'durations': self.durations,
+        }
+
+
+def _ufw_rule_to_json(rule: UfwRule) -> dict:
+    return {'type': rule.type, 'rule': rule.rule, 'proto': rule.proto, 'port': rule.port,
+            'from_ip': rule.from_ip}
+
+
+class PhaseTimer:
+    """Measures the duration of named phases, which are also recorded as trace spans"""
+
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            with span(f'{name} status', 'phase'):
+                yield
+        finally:
+            self.durations[name] = time.perf_counter() - start
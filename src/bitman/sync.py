@@ -1,14 +1,41 @@
+from __future__ import annotations
 from argparse import Namespace
-from rich.prompt import Prompt
-from rich.console import Console
+from contextlib import contextmanager
+from functools import cached_property
+from os.path import basename
+import time
+from subprocess import CalledProcessError
+from typing import TYPE_CHECKING, Generator
+from bitman.config.layers import HOOKS_DIRECTORY, LAYERS_FILE
 from bitman.config.system_config import SystemConfig
-from bitman.package.pacman import Pacman
-from bitman.package.yay import Yay
+from bitman.fingerprint import observed_state_fingerprint, sync_fingerprint
+from bitman.git import GitRepository
+from bitman.history import DurationHistory
+from bitman.journal import SyncJournal, SyncJournalException
+from bitman.nft import Nft
+from bitman.nft_sync import NftSync
+from bitman.package.pacman import OutdatedPackage, Pacman
+from bitman.package.yay import Yay, YayNotInstalledException
 from bitman.package_sync import PackageSync, PackageSyncStatus
+from bitman.plan import SyncPlan, SyncPlanException
+from bitman.prompt import confirm
+from bitman.root import in_root, is_alternate_root
+from bitman.runner import command_runner
+from bitman.scheduler import Scheduler, Task
 from bitman.service import Systemd
 from bitman.services_sync import ServiceSyncStatus, ServicesSync
+from bitman.state import Subsystem, SyncState
+from bitman.status import PhaseTimer, StatusReport
+from bitman.trace import span
 from bitman.ufw import Ufw
-from bitman.ufw_sync import UfwSync
+from bitman.ufw.files import UfwFiles
+from bitman.ufw_sync import UfwSync, UfwSyncStatus
+
+if TYPE_CHECKING:
+    from rich.console import Console
+
+
+NFTABLES_CONFIG_PATH = '/etc/nftables.conf'
 
 
 class SyncScope():
@@ -32,20 +59,52 @@ class SyncScope():
     def ufw(self) -> bool:
         return self._ufw
 
+    def subsystems(self) -> list[Subsystem]:
+        return [subsystem for subsystem, enabled in
+                (('packages', self._packages), ('services', self._services), ('ufw', self._ufw))
+                if enabled]
+
+
+def subsystems_of(file_path: str) -> set[Subsystem]:
+    """Returns which subsystems are affected by a change to a file of the config repository"""
+    name = basename(file_path)
+    if name == LAYERS_FILE:
+        return {'packages', 'services', 'ufw'}
+    if name in ('arch.packages', 'aur.packages') or HOOKS_DIRECTORY in file_path.split('/')[:-1]:
+        return {'packages'}
+    if name == 'services.conf':
+        return {'services'}
+    if name == 'ufw.conf':
+        return {'ufw'}
+    return set()
+
 
 class Sync:
-    def __init__(self, system_config: SystemConfig, pacman: Pacman, yay: Yay, systemd: Systemd, ufw: Ufw):
+    def __init__(self, system_config: SystemConfig, pacman: Pacman, yay: Yay, systemd: Systemd,
+                 ufw: Ufw, nft: Nft, config_repository: GitRepository, state: SyncState,
+                 journal: SyncJournal | None = None, history: DurationHistory | None = None):
         self._system_config = system_config
         self._pacman = pacman
         self._yay = yay
         self._systemd = systemd
         self._ufw = ufw
-        self._console = Console()
+        self._nft = nft
+        self._config_repository = config_repository
+        self._state = state
+        self._journal = journal
+        self._history = history
+        self._changed_since: dict[str, set[Subsystem] | None] = {}
+
+    @cached_property
+    def _console(self) -> Console:
+        from rich.console import Console
+        return Console()
 
-    def package_status(self) -> PackageSyncStatus:
+    def package_status(self, upgrade: bool = False, outdated: bool = False) -> PackageSyncStatus:
         """
         Returns which additional packages are installed and which are missing compared to the ones
-        configured using bitman
+        configured using bitman. Outdated packages are only looked up with `outdated` or `upgrade`,
+        with `upgrade` the system is upgraded.
         """
         required_arch_packages = set(self._system_config.arch_packages())
         required_aur_packages = set(self._system_config.aur_packages())
@@ -58,7 +117,12 @@ class Sync:
             required_arch_packages.union(required_aur_packages)
         )
 
-        return PackageSyncStatus(list(additional_packages), list(missing_arch_packages), list(missing_aur_packages), list(required_arch_packages) + list(required_aur_packages))
+        # Installed versions come from the index, available ones from a single pacman query
+        outdated_packages = tuple(self._pacman.outdated_packages(required_arch_packages)) \
+            if outdated or upgrade else ()
+
+        return PackageSyncStatus(list(additional_packages), list(missing_arch_packages), list(missing_aur_packages), list(required_arch_packages) + list(required_aur_packages),
+                                 outdated_packages, upgrade)
 
     def service_status(self) -> ServiceSyncStatus:
         """
@@ -88,47 +152,455 @@ class Sync:
 
         return ServiceSyncStatus(system_services_to_disable, system_services_to_enable, user_services_to_disable, user_services_to_enable)
 
+    def status_report(self, scope: SyncScope, force: bool = False) -> StatusReport:
+        """
+        Computes the drift of every subsystem in scope without printing anything or prompting. A
+        disabled UFW is reported as unavailable instead of being enabled. If nothing changed since
+        the subsystems were last fully synced, they are reported in sync unless `force` is set.
+        """
+        timer = PhaseTimer()
+        if not force:
+            with timer.phase('fingerprint'):
+                unchanged = self._unchanged_since_sync(scope)
+            if unchanged:
+                return self._synced_report(scope, timer.durations)
+
+        packages = None
+        if scope.packages:
+            with timer.phase('packages'):
+                packages = self.package_status(outdated=True)
+
+        services = None
+        if scope.services:
+            with timer.phase('services'):
+                services = self.service_status()
+
+        backend = None
+        ufw = None
+        nftables = None
+        if scope.ufw:
+            with timer.phase('firewall'):
+                backend = self._system_config.firewall_backend()
+                if is_alternate_root():
+                    # The firewall of an alternate root isn't running, it can't be queried
+                    pass
+                elif backend == 'nftables':
+                    nftables = NftSync(self._nft, None, self._system_config).status()
+                elif self._ufw.is_enabled():
+                    ufw = UfwSync(self._ufw, None, self._system_config).status()
+
+        return StatusReport(packages, services, backend, ufw, nftables, timer.durations)
+
+    def _synced_report(self, scope: SyncScope, durations: dict[str, float]) -> StatusReport:
+        packages = None
+        if scope.packages:
+            required = [*self._system_config.arch_packages(), *self._system_config.aur_packages()]
+            stored = self._state.outdated_packages()
+            if stored is None:
+                # The last sync didn't look them up, they stay valid until the fingerprint changes
+                outdated = tuple(
+                    self._pacman.outdated_packages(self._system_config.arch_packages()))
+                self._state.set_outdated_packages(outdated)
+            else:
+                outdated = tuple(OutdatedPackage(*package) for package in stored)
+            packages = PackageSyncStatus([], [], [], required, outdated)
+        services = ServiceSyncStatus([], [], [], []) if scope.services else None
+        backend = self._system_config.firewall_backend() if scope.ufw else None
+        ufw = UfwSyncStatus([], [], []) if backend == 'ufw' else None
+        return StatusReport(packages, services, backend, ufw, None, durations)
+
+    def print_status(self, scope: SyncScope, force: bool = False) -> None:
+        """
+        Prints the status of every subsystem in scope. Like `status_report`, subsystems which
+        didn't change since they were last fully synced are reported in sync unless `force` is set.
+        """
+        if not force and self._unchanged_since_sync(scope):
+            self._console.print('Nothing changed since the last sync (use [bold]--force[/bold] to '
+                                'check anyway)', style='green')
+            report = self._synced_report(scope, {})
+            if report.packages is not None:
+                PackageSync(report.packages, self._console).print_status()
+            if report.services is not None:
+                self._console.print('All services are in sync', style='green')
+            if report.ufw is not None:
+                self._console.print('All ufw rules in sync', style='green')
+            return
+
+        if scope.packages:
+            PackageSync(self.package_status(outdated=True), self._console).print_status()
+        if scope.services:
+            ServicesSync(self.service_status(), self._console).print_status(self._systemd,
+                                                                            self._system_config)
+        if scope.ufw:
+            self.print_ufw_status()
+
     def print_ufw_status(self) -> None:
+        if self._system_config.firewall_backend() == 'nftables':
+            sync = NftSync(self._nft, self._console, self._system_config)
+            sync.print_summary()
+            return
         sync = UfwSync(self._ufw, self._console, self._system_config)
         sync.print_summary()
 
-    def run(self, scope: SyncScope) -> None:
-        """Runs a sync which will remove additional and install missing packages"""
+    def plan(self, scope: SyncScope, upgrade: bool = False) -> SyncPlan:
+        """Computes every change a sync of the given scope would make"""
+        packages = None
+        if scope.packages:
+            with span('package status', 'phase'):
+                packages = self.package_status(upgrade)
+
+        services = None
+        if scope.services:
+            with span('service status', 'phase'):
+                services = self.service_status()
+
+        ufw = None
+        nftables = None
+        if scope.ufw:
+            with span('firewall status', 'phase'):
+                if self._system_config.firewall_backend() == 'nftables':
+                    sync = NftSync(self._nft, self._console, self._system_config)
+                    ruleset = sync.compiled_ruleset()
+                    nftables = None if sync.status(ruleset).is_empty() else ruleset.render()
+                else:
+                    ufw = UfwSync(self._ufw, self._console, self._system_config).status()
+
+        return SyncPlan(observed_state_fingerprint(), self._config_commit(),
+                        packages, services, ufw, nftables)
+
+    def print_plan(self, plan: SyncPlan) -> None:
+        """Prints the changes of a plan"""
+        if plan.packages is not None:
+            PackageSync(plan.packages, self._console).print_summary()
+        if plan.services is not None:
+            ServicesSync(plan.services, self._console).print_summary()
+        if plan.ufw is not None:
+            UfwSync(self._ufw, self._console, self._system_config).print_summary(plan.ufw)
+        if plan.nftables is not None:
+            self._console.print('The nftables ruleset will be reloaded', style='yellow')
+
+    def apply(self, plan: SyncPlan) -> None:
+        """
+        Applies a previously computed plan without querying the system again. Fails if the system
+        changed since the plan was computed.
+        """
+        if plan.fingerprint != observed_state_fingerprint():
+            raise SyncPlanException(
+                'The system changed since the plan was created, please create a new plan')
 
+        self._apply(plan.packages, plan.services, plan.ufw, plan.nftables,
+                    plan.ufw is not None or plan.nftables is not None, plan.config_commit)
+
+    def run(self,
+            scope: SyncScope,
+            full: bool = False,
+            force: bool = False,
+            upgrade: bool = False) -> None:
+        """
+        Runs a sync which will remove additional and install missing packages, with `upgrade` the
+        system is upgraded if configured packages are outdated. Subsystems whose config didn't
+        change since they were last synced successfully are skipped unless `full` is set. All
+        confirmed changes are applied together, independent ones concurrently. If neither the
+        system nor the config changed since the last full sync, nothing is checked at all unless
+        `full` or `force` is set.
+        """
+        if self._journal is not None and self._journal.load() is not None:
+            self._console.print('The last sync did not finish, [bold]bitman sync --resume[/bold] '
+                                'continues it. Starting a new sync instead', style='yellow')
+
+        # Outdated packages don't change the fingerprint, an upgrade has to check them
+        if not force and not full and not (upgrade and scope.packages):
+            with self._phase('fingerprint'):
+                unchanged = self._unchanged_since_sync(scope)
+            if unchanged:
+                self._console.print(
+                    'Nothing changed since the last sync, skipping '
+                    '(use [bold]--force[/bold] to check anyway)', style='green')
+                return
+
+        with self._phase('config commit'):
+            commit = self._config_commit()
+
+        # Only a sync which checked and synced every subsystem in scope records the fingerprint
+        complete = True
+        packages = None
         if scope.packages:
-            self._run_packages()
+            if self._skip_unchanged('packages', commit, full or upgrade):
+                complete = False
+            else:
+                packages = self._confirmed_packages(upgrade)
+                complete = complete and packages is not None
 
+        services = None
         if scope.services:
-            self._run_services()
+            if self._skip_unchanged('services', commit, full):
+                complete = False
+            else:
+                services = self._confirmed_services()
+                complete = complete and services is not None
 
+        ufw = None
+        nftables = None
+        firewall = False
         if scope.ufw:
-            self._run_ufw()
+            if self._skip_unchanged('ufw', commit, full):
+                complete = False
+            elif is_alternate_root():
+                # The firewall config of an alternate root is always written completely
+                firewall = True
+            else:
+                firewall, ufw, nftables = self._confirmed_firewall()
+                complete = complete and firewall
 
-    def _run_ufw(self) -> None:
-        sync = UfwSync(self._ufw, self._console, self._system_config)
-        sync.run()
+        fingerprint_subsystems = []
+        if complete and self._fingerprint_covers(scope):
+            fingerprint_subsystems = scope.subsystems()
+        with self._phase('apply'):
+            self._apply(packages, services, ufw, nftables, firewall, commit,
+                        fingerprint_subsystems)
+        self._save_history()
 
-    def _run_packages(self) -> None:
-        status = self.package_status()
+    def resume(self) -> None:
+        """
+        Continues the last sync which didn't finish, e.g. because a hook failed or the process was
+        killed. Its recorded changes are applied without querying the system again, tasks which
+        already completed are skipped.
+        """
+        entry = None if self._journal is None else self._journal.load()
+        if entry is None:
+            raise SyncJournalException('There is no interrupted sync to resume')
 
-        sync = PackageSync(status, self._console)
-        sync.print_summary()
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.started))
+        self._console.print(f'Resuming the sync started at {started}, {len(entry.completed)} of '
+                            f'{len(entry.tasks)} steps completed', style='yellow')
+        plan = entry.plan
+        with self._phase('apply'):
+            self._apply(plan.packages, plan.services, plan.ufw, plan.nftables, entry.firewall,
+                        plan.config_commit, entry.fingerprint_subsystems, set(entry.completed))
+        self._save_history()
 
-        answer = Prompt.ask('Do you want to continue?', choices=[
-                            'yes', 'no'], default='yes', case_sensitive=False)
-        if answer != 'yes':
-            return
+    def install(self, arch_packages: list[str], aur_packages: list[str]) -> None:
+        """
+        Installs the given packages (those which aren't installed explicitly yet) and runs only
+        their hooks, without checking the rest of the system
+        """
+        installed_arch = set(self._pacman.explicitly_installed_packages())
+        installed_aur = set(self._pacman.foreign_installed_packages())
+        status = PackageSyncStatus(
+            [],
+            [package for package in arch_packages if package not in installed_arch],
+            [package for package in aur_packages if package not in installed_aur],
+            [*arch_packages, *aur_packages])
+        PackageSync(status, self._console).print_summary()
+        with self._phase('install'):
+            self._apply(status, None, None, None, False, None)
+        self._save_history()
 
-        sync.run(self._pacman, self._yay, self._system_config.hooks_directory())
+    @contextmanager
+    def _phase(self, name: str) -> Generator[None, None, None]:
+        """Traces a phase and records its duration in the history"""
+        with span(name, 'phase'):
+            if self._history is None:
+                yield
+                return
+            with self._history.phase(name):
+                yield
 
-    def _run_services(self) -> None:
-        status = self.service_status()
-        sync = ServicesSync(status, self._console)
-        sync.print_summary()
+    def _save_history(self) -> None:
+        if self._history is not None:
+            self._history.save()
+
+    def _fingerprint_covers(self, scope: SyncScope) -> bool:
+        """The nftables ruleset lives in the kernel only, its changes can't be fingerprinted"""
+        return not scope.ufw or self._system_config.firewall_backend() != 'nftables'
+
+    def _unchanged_since_sync(self, scope: SyncScope) -> bool:
+        """Returns whether neither the system nor the config changed since the last full sync"""
+        if not self._fingerprint_covers(scope):
+            return False
+        synced = {self._state.synced_fingerprint(subsystem) for subsystem in scope.subsystems()}
+        if None in synced or len(synced) != 1:
+            return False
+        return synced.pop() == sync_fingerprint(self._system_config.config_files())
+
+    def _apply(self,
+               packages: PackageSyncStatus | None,
+               services: ServiceSyncStatus | None,
+               ufw: UfwSyncStatus | None,
+               nftables: str | None,
+               firewall: bool,
+               commit: str | None,
+               fingerprint_subsystems: list[Subsystem] | None = None,
+               completed: set[str] | None = None) -> None:
+        tasks: dict[Subsystem, list[Task]] = {}
+        install_task_keys: tuple[str, ...] = ()
+        missing_packages: set[str] = set()
+
+        if packages is not None:
+            package_sync = PackageSync(packages, self._console)
+            tasks['packages'] = package_sync.tasks(
+                self._pacman, self._yay, self._system_config.hooks_directory())
+            install_task_keys = package_sync.install_task_keys()
+            missing_packages = set(packages.missing_arch).union(packages.missing_aur)
+
+        if services is not None:
+            tasks['services'] = ServicesSync(services, self._console).tasks(
+                self._systemd, install_task_keys)
 
-        answer = Prompt.ask('Do you want to continue?', choices=[
-                            'yes', 'no'], default='yes', case_sensitive=False)
-        if answer != 'yes':
+        if firewall:
+            tasks['ufw'] = self._firewall_tasks(ufw, nftables, install_task_keys, missing_packages)
+
+        all_tasks = [task for subsystem_tasks in tasks.values() for task in subsystem_tasks]
+        completed = set() if completed is None else completed
+        journal = self._journal if len(all_tasks) > 0 else None
+        if journal is not None:
+            keys = [task.key for task in all_tasks]
+            journal.begin(SyncPlan('', commit, packages, services, ufw, nftables), firewall,
+                          fingerprint_subsystems or [], keys,
+                          [key for key in keys if key in completed])
+
+        if len(all_tasks) > 0:
+            # Authenticate before the progress display starts, so sudo can prompt for a password
+            command_runner().authenticate()
+
+        scheduler = Scheduler(self._console, completed=completed,
+                              on_complete=None if journal is None else journal.complete,
+                              history=self._history)
+        try:
+            scheduler.run(all_tasks)
+        except BaseException as e:
+            if isinstance(e, YayNotInstalledException):
+                self._console.print("Could not install AUR packages, [bold]yay[/bold] is not "
+                                    "installed", style='red')
+            if journal is not None:
+                self._console.print('The sync did not finish, [bold]bitman sync --resume[/bold] '
+                                    'continues with the first incomplete step', style='red')
+            raise
+        finally:
+            for subsystem, subsystem_tasks in tasks.items():
+                if all(task.key in scheduler.completed for task in subsystem_tasks):
+                    self._record_applied(subsystem, commit)
+
+        if journal is not None:
+            journal.finish()
+        if fingerprint_subsystems:
+            with span('fingerprint', 'phase'):
+                if packages is not None and 'packages' in fingerprint_subsystems:
+                    # Outdated packages are only looked up (and then upgraded) by upgrades
+                    self._state.set_outdated_packages(() if packages.upgrade else None)
+                self._state.set_synced_fingerprint(
+                    fingerprint_subsystems, sync_fingerprint(self._system_config.config_files()))
+
+    def _firewall_tasks(self,
+                        ufw: UfwSyncStatus | None,
+                        nftables: str | None,
+                        install_task_keys: tuple[str, ...],
+                        missing_packages: set[str]) -> list[Task]:
+        if is_alternate_root():
+            return [Task('firewall-files', 'firewall', 'Writing firewall config',
+                         self._write_firewall_files, install_task_keys)]
+        if ufw is not None and not ufw.is_synced():
+            sync = UfwSync(self._ufw, self._console, self._system_config)
+            depends_on = install_task_keys if 'ufw' in missing_packages else ()
+            return [Task('ufw', 'firewall', 'Syncing UFW rules', lambda: sync.apply(ufw),
+                         depends_on)]
+        if nftables is not None:
+            sync = NftSync(self._nft, self._console, self._system_config)
+            depends_on = install_task_keys if 'nftables' in missing_packages else ()
+            return [Task('nftables', 'firewall', 'Loading nftables ruleset',
+                         lambda: sync.apply(nftables), depends_on)]
+        return []
+
+    def _write_firewall_files(self) -> None:
+        """Writes the firewall config into an alternate root and enables it on boot"""
+        if self._system_config.firewall_backend() == 'nftables':
+            ruleset = NftSync(self._nft, None, self._system_config).compiled_ruleset().render()
+            # The root's /etc belongs to root
+            command_runner().run(['tee', in_root(NFTABLES_CONFIG_PATH)], input=ruleset,
+                                 privileged=True).check_returncode()
+            self._systemd.enable_service('nftables.service')
             return
 
-        sync.run(self._systemd)
+        UfwFiles().write(tuple(self._system_config.default_ufw_rules()),
+                         list(self._system_config.ufw_rules()))
+        self._systemd.enable_service('ufw.service')
+
+    def _config_commit(self) -> str | None:
+        try:
+            return self._config_repository.head_commit()
+        except (CalledProcessError, OSError):
+            return None
+
+    def _skip_unchanged(self, subsystem: Subsystem, commit: str | None, full: bool) -> bool:
+        if full or commit is None:
+            return False
+
+        applied_commit = self._state.applied_commit(subsystem)
+        if applied_commit is None:
+            return False
+
+        if applied_commit not in self._changed_since:
+            try:
+                changed_files = self._config_repository.changed_files(applied_commit)
+                self._changed_since[applied_commit] = set().union(
+                    *[subsystems_of(file_path) for file_path in changed_files])
+            except (CalledProcessError, OSError):
+                self._changed_since[applied_commit] = None
+
+        changed = self._changed_since[applied_commit]
+        if changed is None or subsystem in changed:
+            return False
+
+        self._console.print(
+            f'Config for {subsystem} unchanged since {applied_commit[:10]}, skipping '
+            '(use [bold]--full[/bold] to check for drift)', style='green')
+        return True
+
+    def _record_applied(self, subsystem: Subsystem, commit: str | None) -> None:
+        if commit is not None:
+            self._state.set_applied_commit(subsystem, commit)
+
+    def _confirmed_firewall(self) -> tuple[bool, UfwSyncStatus | None, str | None]:
+        if self._system_config.firewall_backend() == 'nftables':
+            sync = NftSync(self._nft, self._console, self._system_config)
+            with self._phase('firewall status'):
+                ruleset = sync.compiled_ruleset()
+                status = sync.status(ruleset)
+            with span('firewall summary', 'render'):
+                changed = sync.print_summary(status)
+            if not changed:
+                return True, None, None
+            if not self._confirmed():
+                return False, None, None
+            return True, None, ruleset.render()
+
+        sync = UfwSync(self._ufw, self._console, self._system_config)
+        with self._phase('firewall status'):
+            status = sync.status()
+        if status is None:
+            return False, None, None
+        with span('firewall summary', 'render'):
+            changed = sync.print_summary(status)
+        if not changed:
+            return True, status, None
+        if not self._confirmed():
+            return False, None, None
+        return True, status, None
+
+    def _confirmed_packages(self, upgrade: bool) -> PackageSyncStatus | None:
+        with self._phase('package status'):
+            status = self.package_status(upgrade)
+        with span('package summary', 'render'):
+            PackageSync(status, self._console).print_summary()
+        return status if self._confirmed() else None
+
+    def _confirmed_services(self) -> ServiceSyncStatus | None:
+        with self._phase('service status'):
+            status = self.service_status()
+        with span('service summary', 'render'):
+            ServicesSync(status, self._console).print_summary()
+        return status if self._confirmed() else None
+
+    def _confirmed(self) -> bool:
+        with span('confirmation', 'prompt'):
+            return confirm('Do you want to continue?', non_interactive_answer=True)
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Generator
+
+
+class Tracer:
+    """
+    Collects spans as Chrome trace events, the written file can be opened in chrome://tracing or
+    https://ui.perfetto.dev
+    """
+
+    def __init__(self):
+        self._events: list[dict] = []
+        self._lock = threading.Lock()
+        self._threads: set[int] = set()
+        self._pid = os.getpid()
+        self._start = time.perf_counter_ns()
+
+    def add(self, name: str, category: str, start: int, end: int, args: dict[str, Any]) -> None:
+        """Adds a finished span, start and end are `time.perf_counter_ns()` values"""
+        thread_id = threading.get_ident()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self._start) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': self._pid,
+            'tid': thread_id,
+            'args': args,
+        }
+        with self._lock:
+            if thread_id not in self._threads:
+                self._threads.add(thread_id)
+                self._events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self._pid,
+                    'tid': thread_id,
+                    'args': {'name': threading.current_thread().name},
+                })
+            self._events.append(event)
+
+    def save(self, file_path: str) -> None:
+        """Writes all spans as trace event JSON"""
+        with self._lock:
+            events = list(self._events)
+        with open(file_path, 'wt', encoding='utf-8') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+_tracer: Tracer | None = None
+
+
+def enable_tracing() -> Tracer:
+    """Starts collecting spans for the rest of the process"""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+@contextmanager
+def span(name: str, category: str, **args: Any) -> Generator[dict[str, Any], None, None]:
+    """
+    Records the enclosed block as a span if tracing is enabled. The yielded dict can be used to
+    add arguments which are only known at the end of the span.
+    """
+    if _tracer is None:
+        yield args
+        return
+
+    start = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        _tracer.add(name, category, start, time.perf_counter_ns(), args)
@@ -1,7 +1,7 @@
-import subprocess
 from typing import Generator, Tuple
 
 from bitman.config.ufw_rule import UfwRule, DefaultUfwRule
+from bitman.runner import command_runner
 
 
 class Ufw:
@@ -21,43 +21,19 @@ class Ufw:
     def reload(self) -> None:
         self._rules = None
         self._default_rules = None
-        result = subprocess.run(
-            ['sudo', 'ufw', 'reload'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', 'reload'], privileged=True)
         result.check_returncode()
 
     def enable(self) -> None:
-        result = subprocess.run(
-            ['sudo', 'ufw', 'enable'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', 'enable'], privileged=True)
         result.check_returncode()
 
     def disable(self) -> None:
-        result = subprocess.run(
-            ['sudo', 'ufw', 'disable'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', 'disable'], privileged=True)
         result.check_returncode()
 
     def reset(self) -> None:
-        result = subprocess.run(
-            ['sudo', 'ufw', 'reset'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', 'reset'], privileged=True)
         result.check_returncode()
 
     def rules(self) -> Generator[UfwRule, None, None]:
@@ -88,13 +64,8 @@ class Ufw:
         for rule in rules:
             if rule is None:
                 raise UfwDeleteRuleException("Invalid rule index")
-            result = subprocess.run(
-                ['sudo', 'ufw', '--force', 'delete', str(rule.index)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                encoding='utf-8',
-                check=False
-            )
+            result = command_runner().run(['ufw', '--force', 'delete', str(rule.index)],
+                                          privileged=True)
             result.check_returncode()
 
     def missing_rules(self, rules_should_exist: list[UfwRule]) -> set[UfwRule]:
@@ -117,45 +88,23 @@ class Ufw:
         return result
 
     def add_rule(self, rule: UfwRule) -> None:
-        result = subprocess.run(
-            ['sudo', 'ufw', rule.rule, rule.type, 'from', rule.from_ip,
-                'proto', rule.proto, 'to', 'any', 'port', rule.port],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', rule.rule, rule.type, 'from', rule.from_ip,
+                                       'proto', rule.proto, 'to', 'any', 'port', rule.port],
+                                      privileged=True)
         result.check_returncode()
 
     def set_default_rule(self, rule: DefaultUfwRule) -> None:
-        result = subprocess.run(
-            ['sudo', 'ufw', 'default', rule.rule, 'incoming' if rule.type == 'in' else 'outgoing'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        direction = 'incoming' if rule.type == 'in' else 'outgoing'
+        result = command_runner().run(['ufw', 'default', rule.rule, direction], privileged=True)
         result.check_returncode()
 
     def _verbose_status(self) -> str:
-        result = subprocess.run(
-            ['sudo', 'ufw', 'status', 'verbose'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', 'status', 'verbose'], privileged=True)
         result.check_returncode()
         return result.stdout
 
     def _numbered_status(self) -> str:
-        result = subprocess.run(
-            ['sudo', 'ufw', 'status', 'numbered'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding='utf-8',
-            check=False
-        )
+        result = command_runner().run(['ufw', 'status', 'numbered'], privileged=True)
         result.check_returncode()
         return result.stdout
 
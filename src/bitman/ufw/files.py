@@ -0,0 +1,114 @@
+import re
+from os.path import isfile
+
+from bitman.config.ufw_rule import DefaultUfwRule, UfwRule
+from bitman.root import AlternateRootException, in_root
+from bitman.runner import command_runner
+
+USER_RULES_PATH = '/etc/ufw/user.rules'
+USER6_RULES_PATH = '/etc/ufw/user6.rules'
+UFW_CONF_PATH = '/etc/ufw/ufw.conf'
+DEFAULTS_PATH = '/etc/default/ufw'
+
+_CHAINS = [
+    'user-input', 'user-output', 'user-forward',
+    'before-logging-input', 'before-logging-output', 'before-logging-forward',
+    'user-logging-input', 'user-logging-output', 'user-logging-forward',
+    'after-logging-input', 'after-logging-output', 'after-logging-forward',
+    'logging-deny', 'logging-allow', 'user-limit', 'user-limit-accept',
+]
+_LIMIT = '-m limit --limit 3/min --limit-burst 10'
+
+
+class UfwFiles:
+    """
+    Writes UFW rules into the config files of an alternate root (in the format `ufw` itself
+    writes), so they are loaded when the system boots. The ufw package must be installed there.
+    The files belong to root, they are written by the privileged helper in a single batch.
+    """
+
+    def write(self, default_rules: tuple[DefaultUfwRule, DefaultUfwRule],
+              rules: list[UfwRule]) -> None:
+        if not isfile(in_root(DEFAULTS_PATH)):
+            raise AlternateRootException(
+                f'{in_root(DEFAULTS_PATH)} does not exist, is ufw installed?')
+
+        defaults = _read(in_root(DEFAULTS_PATH))
+        for rule in default_rules:
+            key = 'DEFAULT_INPUT_POLICY' if rule.type == 'in' else 'DEFAULT_OUTPUT_POLICY'
+            defaults = set_variable(defaults, key, '"DROP"' if rule.rule == 'deny' else '"ACCEPT"')
+        files = {
+            USER_RULES_PATH: render_user_rules(rules, ipv6=False),
+            USER6_RULES_PATH: render_user_rules(rules, ipv6=True),
+            DEFAULTS_PATH: defaults,
+            UFW_CONF_PATH: set_variable(_read(in_root(UFW_CONF_PATH)), 'ENABLED', 'yes'),
+        }
+        command_runner().run_batch([(['tee', in_root(file_path)], content)
+                                    for file_path, content in files.items()],
+                                   privileged=True).check_returncode()
+
+
+def render_user_rules(rules: list[UfwRule], ipv6: bool) -> str:
+    """Renders rules as user.rules (or user6.rules) file"""
+    prefix = 'ufw6' if ipv6 else 'ufw'
+    anywhere = '::/0' if ipv6 else '0.0.0.0/0'
+    lines = ['*filter', *[f':{prefix}-{chain} - [0:0]' for chain in _CHAINS], '### RULES ###', '']
+
+    for rule in rules:
+        if rule.from_ip != 'any' and (':' in rule.from_ip) != ipv6:
+            continue
+        source = anywhere if rule.from_ip == 'any' else rule.from_ip
+        target = 'ACCEPT' if rule.rule == 'allow' else 'DROP'
+        chain = f'{prefix}-user-input' if rule.type == 'in' else f'{prefix}-user-output'
+        lines.append(f'### tuple ### {rule.rule} {rule.proto} {rule.port} {anywhere} any '
+                     f'{source} {rule.type}')
+        for proto in (('tcp', 'udp') if rule.proto == 'any' else (rule.proto,)):
+            source_match = '' if rule.from_ip == 'any' else f' -s {rule.from_ip}'
+            lines.append(f'-A {chain} -p {proto} {_port_match(rule.port)}{source_match} '
+                         f'-j {target}')
+        lines.append('')
+
+    lines += [
+        '### END RULES ###',
+        '',
+        '### LOGGING ###',
+        f'-A {prefix}-after-logging-input -j LOG --log-prefix "[UFW BLOCK] " {_LIMIT}',
+        f'-A {prefix}-after-logging-forward -j LOG --log-prefix "[UFW BLOCK] " {_LIMIT}',
+        f'-I {prefix}-logging-deny -m conntrack --ctstate INVALID -j RETURN {_LIMIT}',
+        f'-A {prefix}-logging-deny -j LOG --log-prefix "[UFW BLOCK] " {_LIMIT}',
+        f'-A {prefix}-logging-allow -j LOG --log-prefix "[UFW ALLOW] " {_LIMIT}',
+        '### END LOGGING ###',
+        '',
+        '### RATE LIMITING ###',
+        f'-A {prefix}-user-limit -m limit --limit 3/minute -j LOG '
+        '--log-prefix "[UFW LIMIT BLOCK] "',
+        f'-A {prefix}-user-limit -j REJECT',
+        f'-A {prefix}-user-limit-accept -j ACCEPT',
+        '### END RATE LIMITING ###',
+        'COMMIT',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def _port_match(port: int | str) -> str:
+    port = str(port)
+    if re.fullmatch(r'\d+', port):
+        return f'--dport {port}'
+    if re.fullmatch(r'[\d:,]+', port):
+        return f'-m multiport --dports {port}'
+    raise AlternateRootException(f'UFW port {port} can\'t be written to an alternate root, use '
+                                 'port numbers instead of service names')
+
+
+def set_variable(content: str, key: str, value: str) -> str:
+    """Sets a KEY=value line in the content of a shell style config file"""
+    line = f'{key}={value}'
+    pattern = re.compile(rf'^{key}=.*$', re.MULTILINE)
+    if pattern.search(content):
+        return pattern.sub(line, content)
+    return content + ('' if content.endswith('\n') or content == '' else '\n') + line + '\n'
+
+
+def _read(file_path: str) -> str:
+    with open(file_path, 'rt', encoding='utf-8') as config_file:
+        return config_file.read()
@@ -1,22 +1,41 @@
-from rich.console import Console
-from rich.prompt import Prompt
+from __future__ import annotations
+from typing import TYPE_CHECKING, NamedTuple
 
 from bitman.config.system_config import SystemConfig
+from bitman.config.ufw_rule import DefaultUfwRule, UfwRule
+from bitman.prompt import confirm
 from bitman.ufw import Ufw
 
+if TYPE_CHECKING:
+    from rich.console import Console
+
+
+class UfwSyncStatus(NamedTuple):
+    default_rules: list[DefaultUfwRule]
+    missing: list[UfwRule]
+    to_delete: list[UfwRule]
+
+    def is_synced(self) -> bool:
+        """Returns whether the UFW rules match the configuration"""
+        return len(self.default_rules) == 0 and len(self.missing) == 0 and len(self.to_delete) == 0
+
 
 class UfwSync:
-    def __init__(self, ufw: Ufw, console: Console, system_config: SystemConfig):
+    def __init__(self, ufw: Ufw, console: Console | None, system_config: SystemConfig):
+        """The console may be None if nothing is printed, e.g. when only computing the status"""
         self._ufw = ufw
         self._console = console
         self._system_config = system_config
 
-    def print_summary(self) -> bool:
+    def status(self) -> UfwSyncStatus | None:
+        """
+        Returns which UFW rules differ from the configuration, or None if UFW is disabled and
+        shouldn't be enabled to query its state
+        """
         if not self._ufw.is_enabled():
-            answer = Prompt.ask('UFW needs to be enabled to query the current UFW state, do you want to enable it?', choices=[
-                'yes', 'no'], default='yes', case_sensitive=False)
-            if answer != 'yes':
-                return False
+            if not confirm('UFW needs to be enabled to query the current UFW state, do you want '
+                           'to enable it?', non_interactive_answer=False):
+                return None
 
             self._console.print('Enable ufw', style='bold yellow')
             self._ufw.enable()
@@ -25,61 +44,68 @@ class UfwSync:
         expected_default_rules = list(self._system_config.default_ufw_rules())
         expected_rules = list(self._system_config.ufw_rules())
 
-        unsynced_default_rules = self._ufw.default_not_equal(expected_default_rules)
-        missing_rules = self._ufw.missing_rules(expected_rules)
-        rules_to_delete = self._ufw.rules_to_delete(expected_rules)
+        return UfwSyncStatus(
+            self._ufw.default_not_equal(expected_default_rules),
+            list(self._ufw.missing_rules(expected_rules)),
+            list(self._ufw.rules_to_delete(expected_rules))
+        )
+
+    def print_summary(self, status: UfwSyncStatus | None = None) -> bool:
+        """Prints the differences to the configuration, returns whether there are any"""
+        if status is None:
+            status = self.status()
+            if status is None:
+                return False
 
-        if len(unsynced_default_rules) == 0 and len(missing_rules) == 0 and len(rules_to_delete) == 0:
+        if status.is_synced():
             self._console.print('All ufw rules in sync', style='green')
             return False
-        if len(unsynced_default_rules) != 0:
+        if len(status.default_rules) != 0:
             self._console.print('Unsynced default rules', style='bold yellow')
             self._console.print(
-                *[f'[bold]·[/bold] {rule}' for rule in unsynced_default_rules], sep='\n')
-        if len(missing_rules) != 0:
+                *[f'[bold]·[/bold] {rule}' for rule in status.default_rules], sep='\n')
+        if len(status.missing) != 0:
             self._console.print('Missing rules', style='bold yellow')
             self._console.print(
-                *[f'[bold]·[/bold] {rule}' for rule in missing_rules], sep='\n')
-        if len(rules_to_delete) != 0:
+                *[f'[bold]·[/bold] {rule}' for rule in status.missing], sep='\n')
+        if len(status.to_delete) != 0:
             self._console.print('Rules to delete', style='bold yellow')
             self._console.print(
-                *[f'[bold]·[/bold] {rule}' for rule in rules_to_delete], sep='\n')
+                *[f'[bold]·[/bold] {rule}' for rule in status.to_delete], sep='\n')
         return True
 
-    def run(self) -> None:
-        is_not_synced = self.print_summary()
-
-        if not is_not_synced:
-            return
+    def run(self) -> bool:
+        """Syncs the UFW rules, returns whether they are in sync afterwards"""
+        status = self.status()
+        if status is None:
+            return False
 
-        answer = Prompt.ask('Do you want to continue?', choices=[
-                            'yes', 'no'], default='yes', case_sensitive=False)
-        if answer != 'yes':
-            return
+        if not self.print_summary(status):
+            return True
 
-        expected_default_rules = list(self._system_config.default_ufw_rules())
-        expected_rules = list(self._system_config.ufw_rules())
+        if not confirm('Do you want to continue?', non_interactive_answer=True):
+            return False
 
-        unsynced_default_rules = self._ufw.default_not_equal(expected_default_rules)
-        missing_rules = self._ufw.missing_rules(expected_rules)
-        rules_to_delete = self._ufw.rules_to_delete(expected_rules)
+        self.apply(status)
+        return True
 
-        if len(unsynced_default_rules) == 0 and len(missing_rules) == 0 and len(rules_to_delete) == 0:
-            self._console.print('All ufw rules in sync', style='green')
+    def apply(self, status: UfwSyncStatus) -> None:
+        """Applies previously computed differences without querying UFW again"""
+        if status.is_synced():
             return
 
-        if len(unsynced_default_rules) != 0:
+        if len(status.default_rules) != 0:
             self._console.print('Syncing default rules', style='bold yellow')
-            for rule in unsynced_default_rules:
+            for rule in status.default_rules:
                 self._console.print(f"Set default to: {rule}", style='yellow')
                 self._ufw.set_default_rule(rule)
 
-        if len(rules_to_delete) != 0:
+        if len(status.to_delete) != 0:
             self._console.print('Deleting rules', style='bold yellow')
-            self._ufw.delete_rules(list(rules_to_delete))
-        if len(missing_rules) != 0:
+            self._ufw.delete_rules(list(status.to_delete))
+        if len(status.missing) != 0:
             self._console.print('Add missing rules', style='bold yellow')
-            for rule in missing_rules:
+            for rule in status.missing:
                 self._console.print(f"Add rule: {rule}", style='yellow')
                 self._ufw.add_rule(rule)
 